@@ -3,27 +3,279 @@ import hashlib
 import json
 import threading
 import random
-from transaction import get_recent_transactions, clear_pool
+import os
+from collections import deque, defaultdict
+from transaction import TransactionMessage, get_block_template, confirm_transactions, restore_transactions
 from peer_discovery import known_peers, peer_config
 from outbox import enqueue_message, gossip_message
 from utils import generate_message_id
-from peer_manager import record_offense
+from peer_manager import record_offense, peer_status
+from block_store import BlockStore, OrphanPool, build_locator, make_header
+from block_log import BlockLog, fits_index
+from merkle import block_merkle_root, tx_leaf_id, merkle_proof, verify_proof
 
-received_blocks = []  # 本地区块链
+received_blocks = BlockStore()  # 本地区块链（带索引）
 header_store = []     # 轻节点区块头
-orphan_blocks = {}    # 孤块池
+header_ids = set()    # header_store中的区块ID，供连续性检查和去重使用，只通过`store_header`更新
+block_log = None      # 磁盘区块日志，见`load_chain`
 
-def request_block_sync(self_id):
+# === Orphan pool ===
+MAX_ORPHANS = 1000
+ORPHAN_TTL = 600  # seconds
+PARENT_REQUEST_INTERVAL = 10  # seconds between GETBLOCKs for the same missing parent
+orphan_blocks = OrphanPool(MAX_ORPHANS, ORPHAN_TTL)  # 孤块池（按父块ID索引）
+parent_requests = {}  # {missing parent block_id: last request time}
+
+# === Header sync ===
+MAX_HEADERS_PER_MSG = 500  # page size of BLOCK_HEADERS responses
+HEADER_SYNC_TIMEOUT = 10  # seconds to wait for a page before failing over to the next peer
+header_sync = {"peer": None, "deadline": 0, "tried": set(), "seen": set(), "done": True}
+sync_lock = threading.Lock()
+
+# === Block download ===
+DOWNLOAD_WINDOW = 128  # blocks requested but not yet applied, across all peers
+DOWNLOAD_PER_PEER = 8  # blocks in flight per peer, below message_handler.INBOUND_RATE_LIMIT so a full reply is never throttled
+DOWNLOAD_TIMEOUT = 10  # seconds before an in-flight block is requested from another peer
+DOWNLOAD_MAX_ATTEMPTS = 5
+download_queue = deque()  # block ids still to request, in header order
+download_order = deque()  # requested block ids in header order, applied from the front
+download_inflight = {}  # {block_id: (peer_id, deadline)}
+download_buffer = {}  # {block_id: block} arrived ahead of its predecessors
+download_attempts = {}  # {block_id: [peer_id, ...]} scheduled blocks and the peers that failed to deliver them
+download_lock = threading.RLock()
+
+# === Merkle proofs ===
+tx_locations = {}  # {tx_id: block_id} for transactions in the main chain of this full node, see `index_transactions`
+proof_results = {}  # {tx_id: True / False} proofs checked by this light node
+
+# === Pending GETBLOCK requests ===
+PENDING_REQUEST_TTL = 30  # seconds
+pending_block_requests = {}  # {block_id: {requester_id: expiry}}
+pending_lock = threading.Lock()
+
+def load_chain(data_dir, self_id):
+    # 打开 <data_dir>/<self_id> 下的区块日志，从索引恢复本地链，之后接收的区块都会写入日志
+    # 全节点从索引恢复区块树，启动时读一遍主链区块体重建tx_locations，之后区块体由`get_block_by_id`按需读取
+    # 轻节点直接由索引重建区块头
+    global block_log
+    block_log = BlockLog(os.path.join(data_dir, str(self_id)))
+    if peer_config[self_id].get("light", False):
+        for header in block_log.headers():
+            header_store.append(header)
+            header_ids.add(header["block_id"])
+        count = len(header_store)
+    else:
+        received_blocks.attach(block_log)
+        tx_locations.clear()
+        index_transactions(received_blocks.chain)
+        count = len(received_blocks)
+    print(f"[{self_id}] Loaded {count} blocks from {block_log.data_dir}")
+    return count
+
+def request_block_sync(self_id, check_interval=1):
+    # 从一个节点分页同步区块头，超时则换下一个节点，直到同步完成或没有可用节点
+    start_header_sync(self_id)
+    while check_header_sync(self_id) | check_downloads(self_id):
+        time.sleep(check_interval)
+
+def local_locator(self_id):
+    # 轻节点用区块头列表，全节点用主链
+    if peer_config[self_id].get("light", False):
+        return build_locator([header["block_id"] for header in header_store])
+    return received_blocks.locator()
+
+def sync_candidates(self_id):
+    # 可提供区块头的全节点，ALIVE 的优先，跳过已确认不可达的节点
+    candidates = [
+        peer_id for peer_id in known_peers
+        if peer_id != self_id and peer_id in peer_config
+        and not peer_config[peer_id].get("light", False)
+        and peer_status.get(peer_id) != "UNREACHABLE"
+    ]
+    return sorted(candidates, key=lambda peer_id: peer_status.get(peer_id) != "ALIVE")
+
+def start_header_sync(self_id):
+    with sync_lock:
+        header_sync.update(peer=None, deadline=0, tried=set(), seen=set(), done=False)
+        return _next_sync_peer(self_id)
+
+def _next_sync_peer(self_id):
+    # 选择下一个未尝试过的节点并从本地定位器开始请求（调用者需持有sync_lock）
+    for peer_id in sync_candidates(self_id):
+        if peer_id not in header_sync["tried"]:
+            header_sync["tried"].add(peer_id)
+            header_sync["peer"] = peer_id
+            send_header_request(self_id, peer_id, local_locator(self_id))
+            return peer_id
+    print(f"[{self_id}] Header sync stopped: no more peers to try")
+    header_sync.update(peer=None, done=True)
+    return None
+
+def send_header_request(self_id, peer_id, locator):
     # 构建GET_BLOCK_HEADERS消息
     msg = {
         "type": "GET_BLOCK_HEADERS",
         "sender": self_id,
+        "locator": locator,
+        "max_count": MAX_HEADERS_PER_MSG,
         "message_id": generate_message_id(),
     }
-    # 发送到所有已知节点
-    for peer in known_peers:
-        if peer != self_id:
-            enqueue_message(peer, known_peers[peer][0], known_peers[peer][1], msg)
+    header_sync["deadline"] = time.time() + HEADER_SYNC_TIMEOUT
+    enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], msg)
+
+def check_header_sync(self_id, now=None):
+    # 当前节点超时未响应时换下一个节点；返回同步是否仍在进行
+    now = now or time.time()
+    with sync_lock:
+        if not header_sync["done"] and now > header_sync["deadline"]:
+            print(f"[{self_id}] Header sync with {header_sync['peer']} timed out, trying another peer")
+            _next_sync_peer(self_id)
+        return not header_sync["done"]
+
+def handle_block_headers(msg, self_id):
+    # 处理一页区块头：检查连续性，轻节点保存区块头，全节点请求缺失区块；来自同步节点且还有更多时请求下一页
+    headers = msg.get("headers", [])
+    sender = msg.get("sender")
+    with sync_lock:
+        known = header_sync["seen"]
+        page_ids = {header["block_id"] for header in headers}
+        for header in headers:
+            prev_id = header["previous_block_id"]
+            if not fits_index(header):
+                print(f"[{self_id}] Malformed header {header['block_id']!r} in the received message, message dropped.")
+                return False
+            if (prev_id != "GENESIS" and prev_id not in received_blocks and prev_id not in header_ids
+                    and prev_id not in page_ids and prev_id not in known):
+                print(f"[{self_id}] Orphaned blocks in the received message, message dropped.")
+                return False
+        if sender == header_sync["peer"] and not header_sync["done"]:
+            known.update(page_ids)
+            if msg.get("more") and headers:
+                send_header_request(self_id, sender, [headers[-1]["block_id"]] + local_locator(self_id))
+            else:
+                header_sync.update(peer=None, done=True)
+                print(f"[{self_id}] Header sync with {sender} complete")
+
+    if peer_config[self_id].get("light", False):
+        for header in headers:
+            if header["block_id"] not in header_ids:
+                store_header(header)
+    else:
+        schedule_downloads([header["block_id"] for header in headers], self_id)
+    return True
+
+def store_header(header):
+    # 轻节点保存一个区块头并写入区块日志
+    header_store.append(header)
+    header_ids.add(header["block_id"])
+    if block_log is not None:
+        block_log.append(header)
+
+def download_peers(self_id):
+    # ALIVE 的全节点；还没有心跳结果时退回到所有未确认不可达的全节点
+    candidates = sync_candidates(self_id)
+    alive = [peer_id for peer_id in candidates if peer_status.get(peer_id) == "ALIVE"]
+    return alive or candidates
+
+def schedule_downloads(block_ids, self_id):
+    # 按区块头顺序加入下载队列，已有或已在下载中的跳过
+    with download_lock:
+        for block_id in block_ids:
+            if block_id in received_blocks or block_id in download_attempts:
+                continue
+            download_attempts[block_id] = []
+            download_queue.append(block_id)
+            download_order.append(block_id)
+        _fill_window(self_id)
+
+def _fill_window(self_id, now=None):
+    # 在窗口内把排队的区块分给负载最低的节点，每个节点一条GETBLOCK（调用者需持有download_lock）
+    now = now or time.time()
+    peers = download_peers(self_id)
+    load = defaultdict(int)
+    for peer_id, _ in download_inflight.values():
+        load[peer_id] += 1
+    assigned = defaultdict(list)
+    skipped = []
+    while download_queue and len(download_inflight) + len(download_buffer) < DOWNLOAD_WINDOW:
+        block_id = download_queue.popleft()
+        choices = [peer_id for peer_id in peers if load[peer_id] < DOWNLOAD_PER_PEER]
+        # 优先选择还没失败过的节点；都失败过时仍然重试
+        choices = [peer_id for peer_id in choices if peer_id not in download_attempts[block_id]] or choices
+        if not choices:
+            skipped.append(block_id)
+            if all(load[peer_id] >= DOWNLOAD_PER_PEER for peer_id in peers):
+                break
+            continue
+        peer_id = min(choices, key=lambda p: load[p])
+        load[peer_id] += 1
+        download_inflight[block_id] = (peer_id, now + DOWNLOAD_TIMEOUT)
+        assigned[peer_id].append(block_id)
+    download_queue.extendleft(reversed(skipped))
+    for peer_id, block_ids in assigned.items():
+        enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], create_getblock(self_id, block_ids))
+
+def is_download_requested(block_id):
+    # 该区块是否由下载调度器请求且仍在等待
+    return block_id in download_inflight
+
+def on_block_downloaded(block, self_id, verified=None):
+    # 下载调度器请求的区块到达：校验后暂存，并按区块头顺序依次交给`handle_block`
+    # verified为已有的校验结果（见`message_handler`的校验阶段），None时在此校验
+    # 返回False表示不是调度器请求的区块，按普通BLOCK处理
+    block_id = block.get("block_id")
+    with download_lock:
+        if block_id not in download_inflight:
+            return False
+        peer_id, _ = download_inflight.pop(block_id)
+        if block_id not in download_attempts:
+            return False
+        if verified is None:
+            verified = verify_block(block)
+        if not verified:
+            record_offense(block.get("sender"))
+            _retry_download(block_id, peer_id)
+        else:
+            download_buffer[block_id] = block
+        _apply_downloaded(self_id)
+        _fill_window(self_id)
+    return True
+
+def _apply_downloaded(self_id):
+    # 从队首开始应用已到达的区块，遇到尚未到达的区块即停止（调用者需持有download_lock）
+    while download_order:
+        block_id = download_order[0]
+        if block_id in download_buffer:
+            handle_block(download_buffer.pop(block_id), self_id, verified=True)
+        elif block_id not in received_blocks and block_id in download_attempts:
+            return
+        # 已应用、已经通过其他途径收到或已放弃
+        download_order.popleft()
+        download_attempts.pop(block_id, None)
+        download_inflight.pop(block_id, None)
+
+def _retry_download(block_id, peer_id):
+    # 记下失败的节点并放回队首；多次失败后放弃，之后的区块作为孤块等待父块
+    failed = download_attempts[block_id]
+    failed.append(peer_id)
+    if len(failed) >= DOWNLOAD_MAX_ATTEMPTS:
+        print(f"Giving up downloading block {block_id} after {len(failed)} attempts")
+        del download_attempts[block_id]
+        return
+    download_queue.appendleft(block_id)
+
+def check_downloads(self_id, now=None):
+    # 超时的请求换节点重发；返回是否还有未完成的下载
+    now = now or time.time()
+    with download_lock:
+        for block_id, (peer_id, deadline) in list(download_inflight.items()):
+            if deadline < now:
+                del download_inflight[block_id]
+                if block_id not in received_blocks and block_id in download_attempts:
+                    _retry_download(block_id, peer_id)
+        _apply_downloaded(self_id)
+        _fill_window(self_id, now)
+        return bool(download_order)
 
 def block_generation(self_id, MALICIOUS_MODE, interval=40):
     from inv_message import create_inv
@@ -39,18 +291,20 @@ def block_generation(self_id, MALICIOUS_MODE, interval=40):
     threading.Thread(target=mine, daemon=True).start()
 
 def create_dummy_block(peer_id, MALICIOUS_MODE):
-    # 获取交易
-    txs = get_recent_transactions()
+    # 按优先级选取不超过区块大小上限的交易
+    txs = get_block_template()
     if not txs:
         print(f"No transactions to include in block from {peer_id}")
         return None
-    # 上一个区块ID
-    prev_block_id = received_blocks[-1]["block_id"] if received_blocks else "GENESIS"
+    # 上一个区块ID（当前最高区块）
+    tip = received_blocks.tip()
+    prev_block_id = tip["block_id"] if tip else "GENESIS"
     block = {
         "type": "BLOCK",
         "sender": peer_id,
         "timestamp": time.time(),
         "previous_block_id": prev_block_id,
+        "merkle_root": block_merkle_root(txs),
         "transactions": txs
     }
     # 计算区块ID
@@ -58,73 +312,242 @@ def create_dummy_block(peer_id, MALICIOUS_MODE):
         block["block_id"] = hashlib.sha256(str(time.time() + random.random()).encode()).hexdigest()
     else:
         block["block_id"] = compute_block_hash(block)
-    # 清空交易池并存储区块
-    clear_pool()
+    # 存储区块；`receive_block`只把打包进区块的交易移出交易池，其余留待下一个区块
     receive_block(block, peer_id)
     return block
 
 def compute_block_hash(block):
-    # 计算区块哈希（不含block_id）
-    block_copy = dict(block)
-    block_copy.pop("block_id", None)
-    block_str = json.dumps(block_copy, sort_keys=True)
+    # 计算区块哈希：只覆盖区块头（不含block_id和交易列表），交易通过merkle_root承诺
+    # 没有merkle_root的区块按其交易列表计算
+    header = {key: value for key, value in block.items() if key not in ("block_id", "transactions")}
+    if "merkle_root" not in header:
+        header["merkle_root"] = block_merkle_root(block.get("transactions", []))
+    block_str = json.dumps(header, sort_keys=True)
     return hashlib.sha256(block_str.encode()).hexdigest()
 
-def handle_block(msg, self_id):
-    # 校验区块ID
+def verify_block(block, check_transactions=True):
+    # 区块ID与区块头一致，且交易列表与merkle_root一致
+    # check_transactions=False时只校验区块头和merkle_root，由调用者逐笔调用`transaction_valid`（见message_handler的校验阶段）
+    # Merkle叶子是交易声明的tx_id，所以每笔交易的tx_id都必须与交易内容一致，否则改动交易内容而保留tx_id的区块也能通过
+    # （没有merkle_root的旧区块同样如此，其区块哈希按交易的tx_id推导merkle_root）
+    # 区块头字段必须放得进区块日志的索引记录（见`block_log.index_fields`），否则写盘时才失败会丢掉孤块和下载缓冲
+    if not fits_index(block):
+        return False
+    try:
+        if compute_block_hash(block) != block.get("block_id"):
+            return False
+        if "merkle_root" in block and block_merkle_root(block.get("transactions", [])) != block["merkle_root"]:
+            return False
+    except (TypeError, ValueError):
+        return False
+    return not check_transactions or transactions_valid(block.get("transactions", []))
+
+def transaction_valid(tx):
+    try:
+        return isinstance(tx, dict) and bool(tx.get("tx_id")) and TransactionMessage.from_dict(tx).is_valid()
+    except (KeyError, TypeError, ValueError):
+        return False
+
+def transactions_valid(transactions):
+    return all(transaction_valid(tx) for tx in transactions)
+
+def handle_block(msg, self_id, verified=False):
+    # 校验区块ID（调用者已经校验过时跳过，避免重复哈希）
     block_id = msg.get("block_id")
-    expected_hash = compute_block_hash(msg)
-    if block_id != expected_hash:
+    if not verified and not verify_block(msg):
         record_offense(msg.get("sender"))
-        print(f"Invalid block ID {block_id} from {msg.get('sender')}, expected {expected_hash}")
+        print(f"Invalid block {block_id} from {msg.get('sender')}: block ID or Merkle root does not match")
         return False
     # 是否已存在
-    if any(b["block_id"] == block_id for b in received_blocks):
+    if block_id in received_blocks:
         return False
     # 上一个区块是否存在
     prev_id = msg.get("previous_block_id")
-    if prev_id != "GENESIS" and not any(b["block_id"] == prev_id for b in received_blocks):
-        orphan_blocks[block_id] = msg
+    if prev_id != "GENESIS" and prev_id not in received_blocks:
+        if orphan_blocks.add(msg):
+            request_missing_parent(orphan_blocks.missing_root(block_id), msg.get("sender"), self_id)
         return False
     # 添加区块
     receive_block(msg, self_id)
-    # 检查能否接回孤块
-    to_remove = []
-    for orphan_id, orphan_block in orphan_blocks.items():
-        if orphan_block["previous_block_id"] == block_id:
-            receive_block(orphan_block, self_id)
-            to_remove.append(orphan_id)
-    for oid in to_remove:
-        orphan_blocks.pop(oid, None)
-    
+    # 接回以该区块为祖先的整条孤块链（BFS，每个孤块只处理一次）
+    connect_orphans(block_id, self_id)
+    return True
+
+def connect_orphans(block_id, self_id):
+    # 父块入链后，逐层取出其子孙孤块并入链，返回接回的数量
+    parent_requests.pop(block_id, None)
+    connected = 0
+    frontier = deque([block_id])
+    while frontier:
+        parent_id = frontier.popleft()
+        for orphan in orphan_blocks.pop_children(parent_id):
+            if orphan["block_id"] in received_blocks:
+                continue
+            receive_block(orphan, self_id)
+            parent_requests.pop(orphan["block_id"], None)
+            frontier.append(orphan["block_id"])
+            connected += 1
+    if connected:
+        print(f"[{self_id}] Reconnected {connected} orphan block(s) after {block_id}")
+    return connected
+
+def request_missing_parent(parent_id, source_id, self_id):
+    # 主动向区块来源（未知时向所有已知节点）请求缺失的父块，同一父块在间隔内只请求一次
+    if parent_id == "GENESIS" or parent_id in received_blocks:
+        return False
+    now = time.time()
+    if now - parent_requests.get(parent_id, 0) < PARENT_REQUEST_INTERVAL:
+        return False
+    parent_requests[parent_id] = now
+    if len(parent_requests) > MAX_ORPHANS:
+        for stale_id in [pid for pid, t in parent_requests.items() if now - t >= PARENT_REQUEST_INTERVAL]:
+            del parent_requests[stale_id]
+    getblock_msg = create_getblock(self_id, [parent_id])
+    if source_id in peer_config and source_id != self_id:
+        targets = [source_id]
+    else:
+        targets = [peer_id for peer_id in known_peers if peer_id != self_id and peer_id in peer_config]
+    for peer_id in targets:
+        enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], getblock_msg)
     return True
 
+def handle_reorg(disconnected_ids, connected_ids):
+    # 主链切换到另一分支：断开区块中的交易放回交易池，新主链上已确认的交易移出交易池
+    connected_txs = set()
+    for block_id in connected_ids:
+        block = received_blocks.get(block_id) or {}
+        connected_txs.update(tx.get("tx_id") for tx in block.get("transactions", []) if isinstance(tx, dict))
+    restored = []
+    for block_id in disconnected_ids:
+        block = received_blocks.get(block_id) or {}
+        restored += [tx for tx in block.get("transactions", []) if isinstance(tx, dict) and tx.get("tx_id") not in connected_txs]
+    restore_transactions(restored)
+    confirm_transactions(connected_txs)
+    index_transactions(disconnected_ids, connect=False)
+    index_transactions(connected_ids)
+    print(f"🔀 Reorg: disconnected {len(disconnected_ids)} block(s), connected {len(connected_ids)}, new tip {received_blocks.tip_id}")
+
+received_blocks.on_reorg = handle_reorg
+
+def index_transactions(block_ids, connect=True):
+    # 维护tx_locations：只索引主链区块中的交易，分叉上的区块等重组接上主链时才加入，断开时移除
+    for block_id in block_ids:
+        block = received_blocks.get(block_id) or {}
+        for tx in block.get("transactions", []):
+            tx_id = tx_leaf_id(tx)
+            if connect:
+                tx_locations[tx_id] = block_id
+            elif tx_locations.get(tx_id) == block_id:
+                del tx_locations[tx_id]
+
 def receive_block(block, self_id):
     # 存储区块或区块头
     is_light = peer_config[self_id].get("light", False)
     if not is_light:
-        received_blocks.append(block)
+        if received_blocks.append(block):
+            # 进入主链的区块：增量移除其中已确认的交易并索引（分叉上的区块等重组时由`handle_reorg`处理）
+            if received_blocks.is_canonical(block["block_id"]):
+                index_transactions([block["block_id"]])
+                confirm_transactions([tx.get("tx_id") for tx in block.get("transactions", []) if isinstance(tx, dict)])
+        serve_pending_requests(block)
     else:
-        header = {
-            "sender": block["sender"],
-            "timestamp": block["timestamp"],
-            "block_id": block["block_id"],
-            "previous_block_id": block["previous_block_id"]
-        }
-        header_store.append(header)
-
-def create_getblock(sender_id, requested_ids):
-    # 构建GETBLOCK消息
-    return {
+        store_header(make_header(block))
+
+def create_getblock(sender_id, requested_ids, compact=False):
+    # 构建GETBLOCK消息；compact表示新区块可以用CMPCTBLOCK回复（见`compact_block.py`）
+    msg = {
         "type": "GETBLOCK",
         "sender": sender_id,
         "block_ids": requested_ids,
         "message_id": generate_message_id()
     }
+    if compact:
+        msg["compact"] = True
+    return msg
 
 def get_block_by_id(block_id)->dict:
     # 根据ID查找区块
-    for block in received_blocks:
-        if block["block_id"] == block_id:
-            return block
-    return None
\ No newline at end of file
+    return received_blocks.get(block_id)
+
+def create_getproof(sender_id, tx_id, block_id=None):
+    # 构建GETPROOF消息，block_id未知时由全节点查找交易所在区块
+    msg = {
+        "type": "GETPROOF",
+        "sender": sender_id,
+        "tx_id": tx_id,
+        "message_id": generate_message_id()
+    }
+    if block_id:
+        msg["block_id"] = block_id
+    return msg
+
+def request_proof(self_id, tx_id, block_id=None):
+    # 轻节点向一个全节点请求交易的Merkle证明，结果见`proof_results`
+    candidates = sync_candidates(self_id)
+    if not candidates:
+        return None
+    peer_id = candidates[0]
+    enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], create_getproof(self_id, tx_id, block_id))
+    return peer_id
+
+def create_proof(sender_id, tx_id, block_id=None):
+    # 为交易生成PROOF消息；找不到交易时proof为None
+    block = get_block_by_id(block_id or tx_locations.get(tx_id))
+    proof = None
+    if block is not None:
+        tx_ids = [tx_leaf_id(tx) for tx in block.get("transactions", [])]
+        if tx_id in tx_ids:
+            proof = merkle_proof(tx_ids, tx_ids.index(tx_id))
+    return {
+        "type": "PROOF",
+        "sender": sender_id,
+        "tx_id": tx_id,
+        "block_id": block["block_id"] if block else block_id,
+        "proof": proof,
+        "message_id": generate_message_id()
+    }
+
+def handle_proof(msg):
+    # 用本地区块头中的merkle_root校验证明，只需 O(log n) 个哈希
+    tx_id = msg.get("tx_id")
+    header = next((h for h in reversed(header_store) if h["block_id"] == msg.get("block_id")), None)
+    if header is None:
+        header = received_blocks.get(msg.get("block_id"))
+    valid = bool(header and msg.get("proof") and "merkle_root" in header
+                 and verify_proof(tx_id, msg["proof"], header["merkle_root"]))
+    proof_results[tx_id] = valid
+    print(f"{'✅' if valid else '❌'} Merkle proof for tx {tx_id} in block {msg.get('block_id')}: {'valid' if valid else 'invalid'}")
+    return valid
+
+def park_block_request(block_id, requester, ttl=PENDING_REQUEST_TTL):
+    # 记录一个暂时无法满足的GETBLOCK请求，区块到达时由`serve_pending_requests`发送
+    # 同一请求者重复请求只刷新过期时间；返回True表示该区块此前无人等待，调用者需要去其他节点获取
+    now = time.time()
+    with pending_lock:
+        expire_pending_requests(now)
+        requesters = pending_block_requests.setdefault(block_id, {})
+        first = not requesters
+        requesters[requester] = now + ttl
+    return first
+
+def expire_pending_requests(now=None):
+    # 清理过期的等待请求（调用者需持有pending_lock）
+    now = now or time.time()
+    for block_id in list(pending_block_requests.keys()):
+        requesters = pending_block_requests[block_id]
+        for requester, expiry in list(requesters.items()):
+            if expiry < now:
+                del requesters[requester]
+        if not requesters:
+            del pending_block_requests[block_id]
+
+def serve_pending_requests(block):
+    # 新区块到达后，发送给所有仍在等待它的请求者
+    now = time.time()
+    with pending_lock:
+        requesters = pending_block_requests.pop(block["block_id"], {})
+    for requester, expiry in requesters.items():
+        if expiry < now or requester not in peer_config:
+            continue
+        print(f"Sending parked BLOCK {block['block_id']} to {requester}")
+        enqueue_message(requester, peer_config[requester]["ip"], peer_config[requester]["port"], block)
@@ -4,31 +4,41 @@ import hashlib
 from unittest.mock import patch
 
 import block_handler
+from transaction import TransactionMessage, add_transaction, clear_pool, tx_pool, is_known_transaction
 
 class TestBlockHandler(unittest.TestCase):
     def setUp(self):
         # 重置全局变量
         block_handler.received_blocks.clear()
         block_handler.header_store.clear()
+        block_handler.header_ids.clear()
         block_handler.orphan_blocks.clear()
+        block_handler.pending_block_requests.clear()
+        block_handler.parent_requests.clear()
+        block_handler.header_sync.update(peer=None, done=True)
+        block_handler.tx_locations.clear()
+        block_handler.proof_results.clear()
+        for state in (block_handler.download_queue, block_handler.download_order, block_handler.download_inflight,
+                      block_handler.download_buffer, block_handler.download_attempts):
+            state.clear()
         # 模拟 full 节点
         block_handler.peer_config.clear()
-        block_handler.peer_config.update({"type": "full"})
+        block_handler.peer_config.update({"type": "full", "peer1": {"light": False}, "peerX": {"light": False}})
 
     def test_create_dummy_block_normal(self):
         # 模拟有交易
-        with patch("block_handler.get_recent_transactions", return_value=[{"id": "tx1"}, {"id": "tx2"}]):
-            with patch("block_handler.clear_pool") as mock_clear_pool:
+        with patch("block_handler.get_block_template", return_value=[{"tx_id": "tx1"}, {"tx_id": "tx2"}]):
+            with patch("block_handler.confirm_transactions") as mock_confirm:
                 block = block_handler.create_dummy_block("peer1", MALICIOUS_MODE=False)
                 self.assertIsNotNone(block)
-                self.assertEqual(block["peer_id"], "peer1")
+                self.assertEqual(block["sender"], "peer1")
                 self.assertIn("block_id", block)
                 self.assertEqual(block_handler.received_blocks[-1], block)
-                mock_clear_pool.assert_called()
+                mock_confirm.assert_called_with(["tx1", "tx2"])
 
     def test_create_dummy_block_malicious(self):
         # 恶意模式生成区块ID不等于正常哈希
-        with patch("block_handler.get_recent_transactions", return_value=[{"id": "tx1"}]):
+        with patch("block_handler.get_block_template", return_value=[{"tx_id": "tx1"}]):
             block = block_handler.create_dummy_block("peerX", MALICIOUS_MODE=True)
             expected_hash = block_handler.compute_block_hash(block)
             self.assertNotEqual(block["block_id"], expected_hash)
@@ -122,16 +132,251 @@ class TestBlockHandler(unittest.TestCase):
         self.assertEqual(msg["block_ids"], ["id1", "id2"])
 
     def test_request_block_sync(self):
-        # 检查是否向所有 known_peers（非自己）发送了请求
-        with patch("block_handler.known_peers", ["self", "peerA", "peerB"]):
+        # 只向一个全节点请求，超时后换下一个节点，轻节点与自己不会被选中
+        block_handler.peer_config.update({
+            "self": {"light": False},
+            "peerA": {"ip": "127.0.0.1", "port": 5001},
+            "peerB": {"ip": "127.0.0.1", "port": 5002},
+            "lightC": {"ip": "127.0.0.1", "port": 5003, "light": True}
+        })
+        with patch("block_handler.known_peers", ["self", "peerA", "peerB", "lightC"]):
             with patch("block_handler.enqueue_message") as mock_enqueue:
                 with patch("block_handler.generate_message_id", return_value="mid"):
-                    block_handler.request_block_sync("self")
-                    # 应对 peerA, peerB 各发一次
-                    targets = [call[0][1] for call in mock_enqueue.call_args_list]
-                    self.assertIn("peerA", targets)
-                    self.assertIn("peerB", targets)
-                    self.assertNotIn("self", targets)
+                    first = block_handler.start_header_sync("self")
+                    self.assertEqual(mock_enqueue.call_count, 1)
+                    self.assertEqual(mock_enqueue.call_args[0][0], first)
+                    self.assertEqual(mock_enqueue.call_args[0][3]["locator"], [])
+                    self.assertTrue(block_handler.check_header_sync("self", time.time() + 60))
+                    targets = [call[0][0] for call in mock_enqueue.call_args_list]
+                    self.assertEqual(set(targets), {"peerA", "peerB"})
+                    # 没有更多节点可尝试
+                    self.assertFalse(block_handler.check_header_sync("self", time.time() + 120))
+
+    def test_header_sync_pages(self):
+        block_handler.peer_config.update({"self": {"light": False}, "peerA": {"ip": "127.0.0.1", "port": 5001}})
+        remote = block_handler.BlockStore()
+        remote.extend({"sender": "p", "timestamp": i, "block_id": f"b{i}", "previous_block_id": f"b{i - 1}" if i else "GENESIS"} for i in range(25))
+        block_handler.received_blocks.extend(remote[:3])
+        with patch("block_handler.known_peers", ["self", "peerA"]), patch("block_handler.enqueue_message") as mock_enqueue:
+            block_handler.start_header_sync("self")
+            pages = []
+            requested = []
+            while True:
+                sent = [call[0][3] for call in mock_enqueue.call_args_list]
+                mock_enqueue.reset_mock()
+                requested += [block_id for m in sent if m["type"] == "GETBLOCK" for block_id in m["block_ids"]]
+                requests = [m for m in sent if m["type"] == "GET_BLOCK_HEADERS"]
+                if not requests:
+                    break
+                headers, more = remote.headers_after(requests[0]["locator"], 10)
+                pages.append(len(headers))
+                self.assertTrue(block_handler.handle_block_headers({"sender": "peerA", "headers": headers, "more": more}, "self"))
+        # 从共同祖先 b2 之后开始，分三页取完
+        self.assertEqual(pages, [10, 10, 2])
+        # 缺失区块按顺序交给下载调度器，单个节点最多同时请求 DOWNLOAD_PER_PEER 个
+        self.assertEqual(list(block_handler.download_order), [f"b{i}" for i in range(3, 25)])
+        self.assertEqual(requested, [f"b{i}" for i in range(3, 3 + block_handler.DOWNLOAD_PER_PEER)])
+        self.assertFalse(block_handler.check_header_sync("self"))
+
+    def test_light_header_sync_continues_stored_headers(self):
+        # 轻节点已有区块头 b0-b4 时，从 b4 之后开始的一页应被接受
+        block_handler.peer_config.update({"self": {"light": True}})
+        headers = [{"sender": "p", "timestamp": i, "block_id": f"b{i}", "previous_block_id": f"b{i - 1}" if i else "GENESIS"} for i in range(10)]
+        for header in headers[:5]:
+            block_handler.store_header(header)
+        self.assertTrue(block_handler.handle_block_headers({"sender": "peerA", "headers": headers[5:]}, "self"))
+        self.assertEqual([header["block_id"] for header in block_handler.header_store], [f"b{i}" for i in range(10)])
+        self.assertFalse(block_handler.handle_block_headers({"sender": "peerA", "headers": [dict(headers[7], previous_block_id="x")]}, "self"))
+
+    def test_park_block_request_dedup(self):
+        self.assertTrue(block_handler.park_block_request("b1", "peerA"))
+        self.assertFalse(block_handler.park_block_request("b1", "peerA"))
+        self.assertFalse(block_handler.park_block_request("b1", "peerB"))
+        self.assertEqual(set(block_handler.pending_block_requests["b1"]), {"peerA", "peerB"})
+
+    def test_pending_request_served_on_arrival(self):
+        block_handler.peer_config.update({
+            "self": {"light": False},
+            "peerA": {"ip": "127.0.0.1", "port": 5001},
+            "peerB": {"ip": "127.0.0.1", "port": 5002}
+        })
+        block_handler.park_block_request("b1", "peerA")
+        block_handler.park_block_request("b1", "peerB", ttl=-1)  # 已过期
+        block = {"sender": "p", "timestamp": 1, "previous_block_id": "GENESIS", "block_id": "b1"}
+        with patch("block_handler.enqueue_message") as mock_enqueue:
+            block_handler.receive_block(block, "self")
+        mock_enqueue.assert_called_once_with("peerA", "127.0.0.1", 5001, block)
+        self.assertNotIn("b1", block_handler.pending_block_requests)
+
+    def _chain(self, length):
+        blocks = []
+        prev_id = "GENESIS"
+        for i in range(length):
+            block = {"sender": "p", "timestamp": i, "previous_block_id": prev_id, "transactions": []}
+            block["block_id"] = block_handler.compute_block_hash(block)
+            blocks.append(block)
+            prev_id = block["block_id"]
+        return blocks
+
+    def test_orphan_chain_reconnected_in_one_pass(self):
+        block_handler.peer_config.update({"self": {"light": False}, "p": {"ip": "127.0.0.1", "port": 5001}})
+        blocks = self._chain(50)
+        with patch("block_handler.enqueue_message") as mock_enqueue:
+            for block in blocks[1:]:
+                self.assertFalse(block_handler.handle_block(block, "self"))
+            self.assertEqual(len(block_handler.orphan_blocks), 49)
+            # 每个孤块都指向同一个缺失的根，只请求一次
+            mock_enqueue.assert_called_once()
+            self.assertEqual(mock_enqueue.call_args[0][3]["block_ids"], [blocks[0]["block_id"]])
+            self.assertTrue(block_handler.handle_block(blocks[0], "self"))
+        self.assertEqual(block_handler.received_blocks.ids(), [b["block_id"] for b in blocks])
+        self.assertEqual(len(block_handler.orphan_blocks), 0)
+        self.assertEqual(block_handler.parent_requests, {})
+
+    def test_reorg_moves_transactions_back_to_pool(self):
+        block_handler.peer_config.update({"self": {"light": False}})
+        tx_a = {"type": "TX", "tx_id": "ta", "from": "1", "to": "2", "amount": 1, "timestamp": 1.0}
+        tx_a["tx_id"] = TransactionMessage.from_dict(tx_a).compute_hash()
+        tx_b = dict(tx_a, amount=2)
+        tx_b["tx_id"] = TransactionMessage.from_dict(tx_b).compute_hash()
+        genesis = {"block_id": "g", "previous_block_id": "GENESIS", "transactions": []}
+        block_handler.received_blocks.extend([genesis, {"block_id": "a1", "previous_block_id": "g", "transactions": [tx_a, tx_b]}])
+        with patch("block_handler.restore_transactions") as mock_restore, patch("block_handler.confirm_transactions") as mock_confirm:
+            block_handler.received_blocks.append({"block_id": "b1", "previous_block_id": "g", "transactions": [tx_b]})
+            mock_restore.assert_not_called()
+            block_handler.received_blocks.append({"block_id": "b2", "previous_block_id": "b1", "transactions": []})
+        mock_restore.assert_called_once_with([tx_a])
+        mock_confirm.assert_called_once_with({tx_b["tx_id"]})
+
+    def test_accepted_block_confirms_pool_transactions(self):
+        block_handler.peer_config.update({"self": {"light": False}})
+        clear_pool()
+        txs = [TransactionMessage("1", "2", i, 1.0 + i) for i in range(4)]
+        for tx in txs:
+            add_transaction(tx)
+        genesis = self._chain(1)[0]
+        side = dict(genesis, timestamp=99, transactions=[txs[3].to_dict()])
+        side["block_id"] = block_handler.compute_block_hash(side)
+        block = {"sender": "p", "timestamp": 1, "previous_block_id": genesis["block_id"], "transactions": [tx.to_dict() for tx in txs[:2]]}
+        block["block_id"] = block_handler.compute_block_hash(block)
+        block_handler.receive_block(genesis, "self")
+        block_handler.receive_block(side, "self")  # 等高分叉，不在主链上
+        block_handler.receive_block(block, "self")
+        self.assertEqual(list(tx_pool), txs[2:])
+        self.assertTrue(is_known_transaction(txs[0].id))
+        clear_pool()
+
+    def test_parallel_download_applies_in_order(self):
+        block_handler.peer_config.update({
+            "self": {"light": False},
+            "peerA": {"ip": "127.0.0.1", "port": 5001},
+            "peerB": {"ip": "127.0.0.1", "port": 5002}
+        })
+        blocks = self._chain(6)
+        ids = [b["block_id"] for b in blocks]
+        with patch("block_handler.known_peers", ["self", "peerA", "peerB"]), \
+             patch("block_handler.DOWNLOAD_PER_PEER", 2), \
+             patch("block_handler.enqueue_message") as mock_enqueue:
+            block_handler.schedule_downloads(ids, "self")
+            # 两个节点各分到两个区块，每个节点一条GETBLOCK
+            requests = {call[0][0]: call[0][3]["block_ids"] for call in mock_enqueue.call_args_list}
+            self.assertEqual(sorted(requests), ["peerA", "peerB"])
+            self.assertEqual(sorted(requests["peerA"] + requests["peerB"]), sorted(ids[:4]))
+            # 乱序到达，只有前面的区块都到齐后才应用
+            by_id = {b["block_id"]: b for b in blocks}
+            self.assertTrue(block_handler.on_block_downloaded(by_id[ids[1]], "self"))
+            self.assertEqual(len(block_handler.received_blocks), 0)
+            self.assertTrue(block_handler.on_block_downloaded(by_id[ids[0]], "self"))
+            self.assertEqual(block_handler.received_blocks.ids(), ids[:2])
+            # 超时的区块改由另一个节点下载
+            late_peer, _ = block_handler.download_inflight[ids[2]]
+            mock_enqueue.reset_mock()
+            self.assertTrue(block_handler.check_downloads("self", time.time() + 60))
+            retried = [call[0][0] for call in mock_enqueue.call_args_list if ids[2] in call[0][3]["block_ids"]]
+            self.assertEqual(len(retried), 1)
+            self.assertNotEqual(retried[0], late_peer)
+            for block_id in ids[2:]:
+                if block_id not in block_handler.download_inflight:
+                    block_handler.check_downloads("self")
+                block_handler.on_block_downloaded(by_id[block_id], "self")
+        self.assertEqual(block_handler.received_blocks.ids(), ids)
+        self.assertFalse(block_handler.check_downloads("self"))
+        self.assertFalse(block_handler.on_block_downloaded(blocks[0], "self"))
+
+    def test_block_hash_covers_header_and_merkle_root(self):
+        txs = [TransactionMessage("1", "2", i, 1.0 + i).to_dict() for i in range(5)]
+        block = {"type": "BLOCK", "sender": "p", "timestamp": 1, "previous_block_id": "GENESIS",
+                 "merkle_root": block_handler.block_merkle_root(txs), "transactions": txs}
+        block["block_id"] = block_handler.compute_block_hash(block)
+        self.assertTrue(block_handler.verify_block(block))
+        # 区块哈希与交易列表无关，篡改交易由merkle_root发现
+        tampered = dict(block, transactions=txs[:-1])
+        self.assertEqual(block_handler.compute_block_hash(tampered), block["block_id"])
+        self.assertFalse(block_handler.verify_block(tampered))
+
+    def test_tampered_transaction_body_rejected(self):
+        txs = [TransactionMessage("1", "2", i, 1.0 + i).to_dict() for i in range(4)]
+        forged = [dict(txs[0], amount=10 ** 9)] + txs[1:]  # 保留tx_id，改动交易内容
+        for with_root in (True, False):
+            block = {"type": "BLOCK", "sender": "p", "timestamp": 1, "previous_block_id": "GENESIS", "transactions": forged}
+            if with_root:
+                block["merkle_root"] = block_handler.block_merkle_root(forged)
+            block["block_id"] = block_handler.compute_block_hash(block)
+            self.assertFalse(block_handler.verify_block(block))
+            self.assertTrue(block_handler.verify_block(dict(block, transactions=txs)))
+        with patch("block_handler.record_offense") as mock_offense:
+            self.assertFalse(block_handler.handle_block(block, "self"))
+        mock_offense.assert_called_once_with("p")
+
+    def test_merkle_proof_for_light_node(self):
+        block_handler.peer_config.update({"full": {"light": False}, "light": {"light": True}})
+        txs = [TransactionMessage("1", "2", i, 1.0 + i).to_dict() for i in range(6)]
+        block = {"type": "BLOCK", "sender": "p", "timestamp": 1, "previous_block_id": "GENESIS",
+                 "merkle_root": block_handler.block_merkle_root(txs), "transactions": txs}
+        block["block_id"] = block_handler.compute_block_hash(block)
+        block_handler.receive_block(block, "full")
+        block_handler.receive_block(block, "light")
+        self.assertEqual(block_handler.header_store[-1]["merkle_root"], block["merkle_root"])
+        proof_msg = block_handler.create_proof("full", txs[4]["tx_id"])
+        self.assertEqual(proof_msg["block_id"], block["block_id"])
+        self.assertTrue(block_handler.handle_proof(proof_msg))
+        self.assertTrue(block_handler.proof_results[txs[4]["tx_id"]])
+        missing = block_handler.create_proof("full", "unknown")
+        self.assertIsNone(missing["proof"])
+        self.assertFalse(block_handler.handle_proof(missing))
+
+    def test_tx_locations_follow_main_chain(self):
+        import tempfile
+        block_handler.peer_config.update({"self": {"light": False}})
+        txs = [TransactionMessage("1", "2", i, 1.0 + i).to_dict() for i in range(3)]
+        def make(prev_id, timestamp, body):
+            block = {"sender": "p", "timestamp": timestamp, "previous_block_id": prev_id,
+                     "merkle_root": block_handler.block_merkle_root(body), "transactions": body}
+            block["block_id"] = block_handler.compute_block_hash(block)
+            return block
+        genesis = make("GENESIS", 0, [])
+        a1 = make(genesis["block_id"], 1, [txs[0], txs[1]])
+        b1 = make(genesis["block_id"], 2, [txs[1], txs[2]])
+        b2 = make(b1["block_id"], 3, [])
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with patch("block_handler.block_log", None), \
+             patch.object(block_handler.received_blocks, "log", None), \
+             patch.object(block_handler.received_blocks, "blocks", block_handler.received_blocks.blocks):
+            block_handler.load_chain(tmp.name, "self")
+            self.addCleanup(block_handler.received_blocks.clear)
+            for block in (genesis, a1, b1):
+                block_handler.receive_block(block, "self")
+            # 等高分叉上的交易不进索引
+            self.assertEqual(block_handler.tx_locations, {txs[0]["tx_id"]: a1["block_id"], txs[1]["tx_id"]: a1["block_id"]})
+            block_handler.receive_block(b2, "self")
+            self.assertEqual(block_handler.tx_locations, {txs[1]["tx_id"]: b1["block_id"], txs[2]["tx_id"]: b1["block_id"]})
+            self.assertIsNone(block_handler.create_proof("self", txs[0]["tx_id"])["proof"])
+            block_handler.block_log.close()
+            block_handler.tx_locations.clear()
+            block_handler.load_chain(tmp.name, "self")
+            self.addCleanup(block_handler.block_log.close)
+        self.assertEqual(block_handler.tx_locations, {txs[1]["tx_id"]: b1["block_id"], txs[2]["tx_id"]: b1["block_id"]})
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
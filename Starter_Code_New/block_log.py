@@ -0,0 +1,181 @@
+import os
+import json
+import mmap
+import struct
+import threading
+from codec import encode_frame
+
+# === On-disk block storage ===
+# <data_dir>/blocks-00000.log ...  append-only segments, one record per block: u32 length | JSON body
+# <data_dir>/blocks.idx            fixed-size index records, memory-mapped; the header holds the record count
+# A block is written to its segment and fsynced first, and only counted in the index afterwards, so even after an
+# OS crash or power loss the index never points at a torn record. Unreferenced bytes at the end of a segment are
+# simply ignored.
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes, roll over to a new segment file after this
+INDEX_MAGIC = b"BLKIDX02"
+INDEX_HEADER = struct.Struct("<8sQ")  # magic, record count
+# block_id, previous_block_id, sender, merkle_root (raw, zero if absent), timestamp, height, segment, offset, length
+INDEX_RECORD = struct.Struct("<64s64s32s32sdIHQI")
+INDEX_GROW = 4096  # records added to the index file each time it fills up
+BODY_HEADER = struct.Struct("<I")
+FIELD_LIMITS = (("block_id", 64), ("previous_block_id", 64), ("sender", 32))  # bytes available in an index record
+
+def index_fields(block):
+    # 索引记录中的 block_id, previous_block_id, sender, merkle_root, timestamp
+    # 放不下或时间戳不是数字时抛出ValueError，`BlockLog.append`在写入任何数据之前调用
+    fields = []
+    for key, limit in FIELD_LIMITS:
+        value = str(block.get(key, "")).encode()
+        if len(value) > limit:
+            raise ValueError(f"{key} {value!r} does not fit in a block index record")
+        fields.append(value)
+    try:
+        root = bytes.fromhex(block.get("merkle_root") or "")
+    except (TypeError, ValueError):
+        root = b""
+    if len(root) != 32:
+        root = b""
+    try:
+        timestamp = float(block.get("timestamp", 0))
+    except (TypeError, ValueError):
+        raise ValueError(f"timestamp {block.get('timestamp')!r} is not a number")
+    return fields + [root, timestamp]
+
+def fits_index(block):
+    try:
+        index_fields(block)
+        return True
+    except ValueError:
+        return False
+
+class BlockLog:
+    # Append-only block log with a memory-mapped index by block_id and height.
+    # Only index records are scanned on open; block bodies are read from the segments on demand.
+    def __init__(self, data_dir, segment_size=SEGMENT_SIZE):
+        self.data_dir = data_dir
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        os.makedirs(data_dir, exist_ok=True)
+        self.positions = {}  # {block_id: index record number}
+        self._open_index()
+        self.segment = 0
+        self.segment_file = None
+        self.readers = {}  # {segment number: open file for reads}
+        for i in range(self.count):
+            self.positions[self.record(i)[0]] = i
+        if self.count:
+            self.segment = self.record(self.count - 1)[6]
+        self._open_segment(self.segment)
+
+    # === Index ===
+
+    def _open_index(self):
+        path = os.path.join(self.data_dir, "blocks.idx")
+        new = not os.path.exists(path) or os.path.getsize(path) < INDEX_HEADER.size
+        self.index_file = open(path, "a+b" if new else "r+b")
+        if new:
+            self.index_file.truncate(INDEX_HEADER.size + INDEX_GROW * INDEX_RECORD.size)
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        if new:
+            INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, 0)
+        magic, self.count = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a block index")
+        self.capacity = (len(self.index) - INDEX_HEADER.size) // INDEX_RECORD.size
+        self.count = min(self.count, self.capacity)
+
+    def _grow_index(self):
+        self.index.flush()
+        self.index.close()
+        self.capacity += INDEX_GROW
+        self.index_file.truncate(INDEX_HEADER.size + self.capacity * INDEX_RECORD.size)
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+
+    def record(self, i):
+        # (block_id, previous_block_id, sender, merkle_root, timestamp, height, segment, offset, length) of the i-th block
+        raw = INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_RECORD.size)
+        root = raw[3].hex() if raw[3].strip(b"\0") else None
+        return (_text(raw[0]), _text(raw[1]), _text(raw[2]), root) + raw[4:]
+
+    def records(self):
+        # 按写入顺序遍历索引记录（不读区块体）
+        for i in range(self.count):
+            yield self.record(i)
+
+    def headers(self):
+        # 由索引直接重建区块头，不读区块体
+        for block_id, prev_id, sender, root, timestamp, *_ in self.records():
+            header = {"sender": sender, "timestamp": timestamp, "block_id": block_id, "previous_block_id": prev_id}
+            if root:
+                header["merkle_root"] = root
+            yield header
+
+    # === Segments ===
+
+    def _segment_path(self, segment):
+        return os.path.join(self.data_dir, f"blocks-{segment:05d}.log")
+
+    def _open_segment(self, segment):
+        if self.segment_file:
+            self.segment_file.close()
+        self.segment = segment
+        self.segment_file = open(self._segment_path(segment), "ab")
+
+    def append(self, block, height=0):
+        # 写入区块体并追加索引记录；已存在返回False
+        block_id = block["block_id"]
+        *fields, root, timestamp = index_fields(block)
+        body = encode_frame(block)[:-1]  # the JSON frame without its newline, usually already encoded for relaying
+        with self.lock:
+            if block_id in self.positions:
+                return False
+            offset = self.segment_file.tell()
+            if offset and offset + BODY_HEADER.size + len(body) > self.segment_size:
+                self._open_segment(self.segment + 1)
+                offset = 0
+            self.segment_file.write(BODY_HEADER.pack(len(body)) + body)
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())  # 区块体落盘后才在索引中计数
+            if self.count == self.capacity:
+                self._grow_index()
+            INDEX_RECORD.pack_into(
+                self.index, INDEX_HEADER.size + self.count * INDEX_RECORD.size,
+                fields[0], fields[1], fields[2], root, timestamp,
+                height, self.segment, offset, len(body)
+            )
+            self.positions[block_id] = self.count
+            self.count += 1
+            INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, self.count)
+            return True
+
+    def read(self, block_id):
+        # 按需从段文件读取区块体
+        with self.lock:
+            i = self.positions.get(block_id)
+            if i is None:
+                return None
+            *_, segment, offset, length = self.record(i)
+            reader = self.readers.get(segment)
+            if reader is None:
+                reader = self.readers[segment] = open(self._segment_path(segment), "rb")
+            reader.seek(offset + BODY_HEADER.size)
+            return json.loads(reader.read(length))
+
+    def __contains__(self, block_id):
+        return block_id in self.positions
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        with self.lock:
+            self.index.flush()
+            self.index.close()
+            self.index_file.close()
+            self.segment_file.close()
+            for reader in self.readers.values():
+                reader.close()
+            self.readers.clear()
+
+def _text(raw):
+    return raw.rstrip(b"\0").decode()
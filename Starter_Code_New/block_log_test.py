@@ -0,0 +1,91 @@
+import unittest
+import tempfile
+import hashlib
+from unittest.mock import patch
+
+import block_log
+from block_log import BlockLog
+from block_store import BlockStore
+
+def make_chain(length):
+    blocks = []
+    prev_id = "GENESIS"
+    for i in range(length):
+        block_id = hashlib.sha256(str(i).encode()).hexdigest()
+        blocks.append({"type": "BLOCK", "sender": "5000", "timestamp": 1700000000.0 + i,
+                       "previous_block_id": prev_id, "transactions": [{"tx_id": str(i)}], "block_id": block_id})
+        prev_id = block_id
+    return blocks
+
+class TestBlockLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_reopen_restores_blocks(self):
+        blocks = make_chain(10)
+        log = BlockLog(self.tmp.name)
+        for height, block in enumerate(blocks, 1):
+            self.assertTrue(log.append(block, height))
+        self.assertFalse(log.append(blocks[0]))
+        log.close()
+
+        log = BlockLog(self.tmp.name)
+        self.addCleanup(log.close)
+        self.assertEqual(len(log), 10)
+        self.assertEqual(log.read(blocks[3]["block_id"]), blocks[3])
+        self.assertIsNone(log.read("unknown"))
+        headers = list(log.headers())
+        self.assertEqual(headers[-1], {"sender": "5000", "timestamp": blocks[-1]["timestamp"],
+                                       "block_id": blocks[-1]["block_id"], "previous_block_id": blocks[-2]["block_id"]})
+
+    def test_segments_roll_and_index_grows(self):
+        blocks = make_chain(30)
+        with patch.object(block_log, "INDEX_GROW", 8):
+            log = BlockLog(self.tmp.name, segment_size=1024)
+            for block in blocks:
+                log.append(block)
+            self.assertGreater(log.segment, 0)
+            log.close()
+            log = BlockLog(self.tmp.name, segment_size=1024)
+        self.addCleanup(log.close)
+        self.assertEqual([log.read(b["block_id"]) for b in blocks], blocks)
+        self.assertTrue(log.append(make_chain(31)[-1]))
+
+    def test_oversize_fields_rejected_before_write(self):
+        import os
+        from block_handler import verify_block, compute_block_hash
+        block = make_chain(1)[0]
+        log = BlockLog(self.tmp.name)
+        self.addCleanup(log.close)
+        for bad in (dict(block, sender="s" * 33), dict(block, timestamp="noon"), dict(block, previous_block_id="p" * 65)):
+            self.assertFalse(block_log.fits_index(bad))
+            with self.assertRaises(ValueError):
+                log.append(bad)
+            bad["block_id"] = compute_block_hash(bad)
+            self.assertFalse(verify_block(bad))
+        self.assertEqual(os.path.getsize(log._segment_path(0)), 0)
+        self.assertEqual(len(log), 0)
+        self.assertTrue(log.append(block))
+
+    def test_store_reads_bodies_on_demand(self):
+        blocks = make_chain(20)
+        log = BlockLog(self.tmp.name)
+        for block in blocks:
+            log.append(block)
+        store = BlockStore()
+        store.attach(log, cache_size=4)
+        self.addCleanup(log.close)
+        self.assertEqual(len(store), 20)
+        self.assertEqual(len(store.blocks), 0)
+        self.assertEqual(store.tip(), blocks[-1])
+        self.assertEqual(store.height_of(blocks[-1]["block_id"]), 20)
+        self.assertEqual(list(store), blocks)
+        self.assertLessEqual(len(store.blocks), 4)
+        new_block = dict(blocks[0], block_id="f" * 64, previous_block_id=blocks[-1]["block_id"])
+        self.assertTrue(store.append(new_block))
+        self.assertIn("f" * 64, log)
+        self.assertEqual(store.height_of("f" * 64), 21)
+
+if __name__ == "__main__":
+    unittest.main()
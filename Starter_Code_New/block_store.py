@@ -0,0 +1,284 @@
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from merkle import block_merkle_root
+
+BODY_CACHE_SIZE = 256  # 挂载磁盘日志后，内存中最多缓存的区块体数量
+LOCATOR_DENSE = 10     # 区块定位器中从 tip 往回连续包含的区块数，之后步长翻倍
+
+def build_locator(chain_ids):
+    # 区块定位器：从链尾往回取 block_id，前 LOCATOR_DENSE 个连续，之后步长每次翻倍，最后总是包含第一个区块
+    # 长度为 O(log n)，对方据此找到共同祖先
+    locator = []
+    step = 1
+    i = len(chain_ids) - 1
+    while i > 0:
+        locator.append(chain_ids[i])
+        if len(locator) >= LOCATOR_DENSE:
+            step *= 2
+        i -= step
+    if chain_ids:
+        locator.append(chain_ids[0])
+    return locator
+
+def make_header(block):
+    # 区块头带上merkle_root，轻节点据此校验交易的Merkle证明
+    return {
+        "sender": block["sender"],
+        "timestamp": block["timestamp"],
+        "block_id": block["block_id"],
+        "previous_block_id": block["previous_block_id"],
+        "merkle_root": block.get("merkle_root") or block_merkle_root(block.get("transactions", []))
+    }
+
+class BlockStore:
+    # 本地区块树的索引存储：保存所有合法区块（包括分叉），并增量维护主链
+    # - blocks: block_id -> block，O(1) 查找与成员判断（挂载磁盘日志后只作为最近区块的缓存）
+    # - parents / heights / by_height: 父块与高度索引
+    # - tip_id: 最高区块（高度相同时先到者优先），新区块在其上构建
+    # - chain: 从创世块到 tip 的主链 block_id，chain[h - 1] 为高度 h 的主链区块
+    # 迭代 / 下标 / len / ids 都针对主链；in / get 针对所有已保存的区块
+    # 支持 append / extend / clear / len / 迭代 / 下标 / in，可替代原来的 received_blocks 列表
+    def __init__(self):
+        self.blocks = {}                    # {block_id: block}
+        self.parents = {}                   # {block_id: previous_block_id}
+        self.heights = {}                   # {block_id: height}
+        self.by_height = defaultdict(list)  # {height: [block_id, ...]}
+        self.chain = []                     # [block_id, ...] canonical chain
+        self.tip_id = None
+        self.log = None                     # BlockLog, see `attach`
+        self.on_reorg = None                # callback(disconnected_ids, connected_ids)
+        self.lock = threading.RLock()
+
+    def attach(self, log, cache_size=BODY_CACHE_SIZE):
+        # 挂载磁盘日志：从索引重建区块树与主链（不读区块体），之后新区块先写入日志，区块体按需读取
+        with self.lock:
+            self.clear()
+            self.log = log
+            self.blocks = OrderedDict()
+            self.cache_size = cache_size
+            for block_id, prev_id, *_ in log.records():
+                self._index(block_id, prev_id)
+
+    def _index(self, block_id, prev_id):
+        # 加入区块树并更新主链；发生重组时返回 (断开的区块, 接上的区块)
+        height = self.heights.get(prev_id, 0) + 1
+        self.parents[block_id] = prev_id
+        self.heights[block_id] = height
+        self.by_height[height].append(block_id)
+        if self.tip_id is None or height > self.heights[self.tip_id]:
+            if prev_id == self.tip_id and self.tip_id is not None:
+                self.chain.append(block_id)  # 延长主链，O(1)
+                self.tip_id = block_id
+                return None
+            return self._switch_tip(block_id)
+        return None
+
+    def _switch_tip(self, new_tip):
+        # 回溯到与主链的分叉点，只替换分叉点之后的部分，代价与重组深度成正比
+        connected = []
+        block_id = new_tip
+        while block_id in self.heights and not self.is_canonical(block_id):
+            connected.append(block_id)
+            block_id = self.parents[block_id]
+        fork_height = self.heights.get(block_id, 0)
+        disconnected = self.chain[fork_height:]
+        connected.reverse()
+        del self.chain[fork_height:]
+        self.chain.extend(connected)
+        self.tip_id = new_tip
+        return (disconnected, connected) if disconnected else None
+
+    def is_canonical(self, block_id):
+        height = self.heights.get(block_id)
+        return height is not None and height <= len(self.chain) and self.chain[height - 1] == block_id
+
+    def _cache(self, block):
+        self.blocks[block["block_id"]] = block
+        if self.log is not None:
+            self.blocks.move_to_end(block["block_id"])
+            while len(self.blocks) > self.cache_size:
+                self.blocks.popitem(last=False)
+
+    def append(self, block):
+        # 存储区块并更新索引；已存在则返回False
+        with self.lock:
+            block_id = block["block_id"]
+            if block_id in self.heights:
+                return False
+            if self.log is not None:
+                self.log.append(block, self.heights.get(block.get("previous_block_id"), 0) + 1)
+            self._cache(block)
+            reorg = self._index(block_id, block.get("previous_block_id"))
+        if reorg and self.on_reorg is not None:
+            self.on_reorg(*reorg)
+        return True
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def clear(self):
+        # 只清空内存索引，不删除磁盘日志
+        with self.lock:
+            self.blocks.clear()
+            self.parents.clear()
+            self.heights.clear()
+            self.by_height.clear()
+            self.chain.clear()
+            self.tip_id = None
+
+    def get(self, block_id):
+        with self.lock:
+            block = self.blocks.get(block_id)
+            if block is None and self.log is not None and block_id in self.heights:
+                block = self.log.read(block_id)
+                if block is not None:
+                    self._cache(block)
+            elif block is not None and self.log is not None:
+                self.blocks.move_to_end(block_id)
+            return block
+
+    def height_of(self, block_id):
+        return self.heights.get(block_id)
+
+    def at_height(self, height):
+        # 某一高度上的所有区块（包括分叉）
+        with self.lock:
+            return [self.get(block_id) for block_id in self.by_height.get(height, [])]
+
+    def tip(self):
+        with self.lock:
+            return self.get(self.tip_id) if self.tip_id is not None else None
+
+    def ids(self):
+        # 返回主链区块ID（副本）
+        with self.lock:
+            return list(self.chain)
+
+    def locator(self):
+        with self.lock:
+            return build_locator(self.chain)
+
+    def headers_after(self, locator, max_count):
+        # 返回主链上位于定位器中第一个已知主链区块之后的至多 max_count 个区块头，以及之后是否还有更多
+        # 定位器中没有已知区块时从创世块开始
+        with self.lock:
+            start = 0
+            for block_id in locator or []:
+                if self.is_canonical(block_id):
+                    start = self.heights[block_id]
+                    break
+            ids = self.chain[start:start + max_count]
+            more = start + max_count < len(self.chain)
+            return [make_header(self.get(block_id)) for block_id in ids], more
+
+    def __contains__(self, item):
+        # 支持按 block_id 或区块字典判断
+        if isinstance(item, dict):
+            item = item.get("block_id")
+        return item in self.heights
+
+    def __len__(self):
+        return len(self.chain)
+
+    def __iter__(self):
+        # 按主链顺序逐个取区块；挂载日志时不会一次把整条链读入内存
+        for block_id in self.ids():
+            block = self.get(block_id)
+            if block is not None:
+                yield block
+
+    def __getitem__(self, index):
+        with self.lock:
+            if isinstance(index, slice):
+                return [self.get(block_id) for block_id in self.chain[index]]
+            return self.get(self.chain[index])
+
+class OrphanPool:
+    # 孤块池：按 previous_block_id 建索引，父块到达时可直接找到全部子块
+    # - blocks: block_id -> block
+    # - children: previous_block_id -> {block_id, ...}
+    # - added: block_id -> 加入时间，按插入顺序排列，用于按数量/时间淘汰最旧的孤块
+    # 兼容原来的 dict 用法（in / len / values / clear / pop）
+    def __init__(self, max_size=1000, max_age=600):
+        self.max_size = max_size
+        self.max_age = max_age  # seconds
+        self.blocks = {}
+        self.children = defaultdict(set)
+        self.added = OrderedDict()
+        self.lock = threading.RLock()
+
+    def add(self, block, now=None):
+        # 加入孤块并按上限淘汰；已存在返回False
+        now = now or time.time()
+        with self.lock:
+            block_id = block["block_id"]
+            if block_id in self.blocks:
+                return False
+            self.blocks[block_id] = block
+            self.children[block["previous_block_id"]].add(block_id)
+            self.added[block_id] = now
+            self.expire(now)
+            while len(self.blocks) > self.max_size:
+                self.pop(next(iter(self.added)))
+            return block_id in self.blocks
+
+    def expire(self, now=None):
+        # 删除超过 max_age 的孤块，返回删除数量
+        now = now or time.time()
+        removed = 0
+        with self.lock:
+            while self.added:
+                block_id, added = next(iter(self.added.items()))
+                if now - added <= self.max_age:
+                    break
+                self.pop(block_id)
+                removed += 1
+        return removed
+
+    def pop(self, block_id, default=None):
+        with self.lock:
+            block = self.blocks.pop(block_id, None)
+            if block is None:
+                return default
+            del self.added[block_id]
+            siblings = self.children.get(block["previous_block_id"])
+            if siblings is not None:
+                siblings.discard(block_id)
+                if not siblings:
+                    del self.children[block["previous_block_id"]]
+            return block
+
+    def pop_children(self, parent_id):
+        # 取出并返回以 parent_id 为父块的所有孤块
+        with self.lock:
+            return [self.pop(block_id) for block_id in list(self.children.get(parent_id, ()))]
+
+    def missing_root(self, block_id):
+        # 沿父链向上，返回这条孤块链缺失的最早祖先ID
+        with self.lock:
+            seen = set()
+            while block_id in self.blocks and block_id not in seen:
+                seen.add(block_id)
+                block_id = self.blocks[block_id]["previous_block_id"]
+            return block_id
+
+    def get(self, block_id):
+        return self.blocks.get(block_id)
+
+    def values(self):
+        with self.lock:
+            return list(self.blocks.values())
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.children.clear()
+            self.added.clear()
+
+    def __contains__(self, block_id):
+        return block_id in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
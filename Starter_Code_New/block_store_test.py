@@ -0,0 +1,98 @@
+import unittest
+
+from block_store import BlockStore, OrphanPool, build_locator
+
+def make_block(block_id, prev_id):
+    return {"block_id": block_id, "previous_block_id": prev_id, "transactions": []}
+
+class TestBlockStore(unittest.TestCase):
+    def setUp(self):
+        self.store = BlockStore()
+
+    def test_lookup_and_membership(self):
+        genesis = make_block("g", "GENESIS")
+        self.assertTrue(self.store.append(genesis))
+        self.assertFalse(self.store.append(genesis))
+        self.assertIn("g", self.store)
+        self.assertIn(genesis, self.store)
+        self.assertNotIn("x", self.store)
+        self.assertIs(self.store.get("g"), genesis)
+        self.assertIsNone(self.store.get("x"))
+        self.assertEqual(len(self.store), 1)
+
+    def test_heights_and_tip(self):
+        self.assertIsNone(self.store.tip())
+        self.store.extend([make_block("g", "GENESIS"), make_block("a", "g"), make_block("b", "g"), make_block("c", "a")])
+        self.assertEqual(self.store.height_of("g"), 1)
+        self.assertEqual(self.store.height_of("c"), 3)
+        self.assertEqual([b["block_id"] for b in self.store.at_height(2)], ["a", "b"])
+        self.assertEqual(self.store.tip()["block_id"], "c")
+
+    def test_list_compatibility(self):
+        blocks = [make_block("g", "GENESIS"), make_block("a", "g")]
+        self.store.extend(blocks)
+        self.assertEqual(list(self.store), blocks)
+        self.assertEqual(self.store[-1], blocks[-1])
+        self.assertEqual(self.store[:1], blocks[:1])
+        self.assertEqual(self.store.ids(), ["g", "a"])
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+        self.assertIsNone(self.store.tip())
+
+    def test_fork_and_reorg(self):
+        reorgs = []
+        self.store.on_reorg = lambda disconnected, connected: reorgs.append((disconnected, connected))
+        self.store.extend([make_block("g", "GENESIS"), make_block("a1", "g"), make_block("a2", "a1")])
+        # 等高分叉不切换主链
+        self.store.extend([make_block("b1", "g"), make_block("b2", "b1")])
+        self.assertEqual(self.store.ids(), ["g", "a1", "a2"])
+        self.assertIn("b2", self.store)
+        self.assertFalse(self.store.is_canonical("b1"))
+        self.assertEqual(reorgs, [])
+        # 更长的分支触发重组
+        self.store.append(make_block("b3", "b2"))
+        self.assertEqual(self.store.ids(), ["g", "b1", "b2", "b3"])
+        self.assertEqual(self.store.tip()["block_id"], "b3")
+        self.assertEqual(reorgs, [(["a1", "a2"], ["b1", "b2", "b3"])])
+        self.assertEqual([b["block_id"] for b in self.store], ["g", "b1", "b2", "b3"])
+        self.assertEqual(len(self.store), 4)
+
+    def test_locator_and_headers_after(self):
+        ids = [str(i) for i in range(100)]
+        locator = build_locator(ids)
+        self.assertEqual(locator[:10], ids[::-1][:10])
+        self.assertEqual(locator[-1], "0")
+        self.assertLess(len(locator), 20)
+        self.store.extend(dict(make_block(block_id, ids[i - 1] if i else "GENESIS"), sender="p", timestamp=i) for i, block_id in enumerate(ids))
+        headers, more = self.store.headers_after(["x", "41", "40"], 10)
+        self.assertEqual([h["block_id"] for h in headers], ids[42:52])
+        self.assertTrue(more)
+        headers, more = self.store.headers_after([], 200)
+        self.assertEqual(len(headers), 100)
+        self.assertFalse(more)
+
+class TestOrphanPool(unittest.TestCase):
+    def test_children_index(self):
+        pool = OrphanPool()
+        pool.add(make_block("a", "g"))
+        pool.add(make_block("b", "g"))
+        pool.add(make_block("c", "a"))
+        self.assertEqual(pool.missing_root("c"), "g")
+        self.assertEqual(sorted(b["block_id"] for b in pool.pop_children("g")), ["a", "b"])
+        self.assertEqual(pool.pop_children("g"), [])
+        self.assertIn("c", pool)
+        self.assertEqual(len(pool), 1)
+
+    def test_size_and_age_cap(self):
+        pool = OrphanPool(max_size=2, max_age=10)
+        pool.add(make_block("a", "x"), now=100)
+        pool.add(make_block("b", "x"), now=101)
+        pool.add(make_block("c", "x"), now=102)
+        self.assertNotIn("a", pool)
+        self.assertEqual(pool.expire(now=111.5), 1)
+        self.assertEqual([b["block_id"] for b in pool.values()], ["c"])
+        self.assertEqual([b["block_id"] for b in pool.pop_children("x")], ["c"])
+        self.assertEqual(pool.children, {})
+
+if __name__ == "__main__":
+    unittest.main()
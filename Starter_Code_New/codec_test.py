@@ -0,0 +1,139 @@
+import unittest
+import socket
+import hashlib
+from unittest.mock import patch
+
+import codec
+
+def sample_block():
+    txs = [{
+        "type": "TX",
+        "tx_id": hashlib.sha256(str(i).encode()).hexdigest(),
+        "from": "5001",
+        "to": "5002",
+        "amount": i,
+        "timestamp": 1700000000.5 + i
+    } for i in range(20)]
+    return {
+        "type": "BLOCK",
+        "sender": "5001",
+        "timestamp": 1700000100.25,
+        "previous_block_id": "GENESIS",
+        "transactions": txs,
+        "block_id": hashlib.sha256(b"block").hexdigest(),
+        "message_id": "3f1c7a52-9d4e-4b8a-a1f0-2c9b7e6d5a43",
+        "extra": {"nested": [None, True, False, -7, "text"]}
+    }
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        codec.peer_codecs.clear()
+        codec.frame_cache.clear()
+
+    def test_binary_roundtrip(self):
+        block = sample_block()
+        frame = codec.encode_frame(block, codec.BINARY_CODEC)
+        self.assertEqual(frame[0], codec.FRAME_MAGIC)
+        self.assertEqual(codec.decode_binary(frame[codec.FRAME_HEADER.size:]), block)
+
+    def test_binary_is_smaller_than_json(self):
+        block = sample_block()
+        json_size = len(codec.encode_frame(block))
+        binary_size = len(codec.encode_frame(block, codec.BINARY_CODEC))
+        self.assertLess(binary_size, json_size / 2)
+
+    def test_uppercase_hex_is_kept_as_string(self):
+        value = {"block_id": "AB" * 32}
+        self.assertEqual(codec.decode_binary(codec.encode_binary(value)), value)
+
+    def test_malformed_frame(self):
+        with self.assertRaises(ValueError):
+            codec.decode_binary(bytes([codec.T_DICT, 5]))
+        with self.assertRaises(ValueError):
+            codec.decode_binary(bytes([99]))
+
+    def _drain(self, reader):
+        messages = []
+        while True:
+            msg = reader.next_message()
+            if msg is None:
+                return messages
+            messages.append(msg)
+
+    def test_frame_reader_mixed_stream_in_chunks(self):
+        block = sample_block()
+        ping = {"type": "PING", "sender": "5000", "timestamp": 1.0}
+        data = codec.encode_frame(ping) + b"\n" + codec.encode_frame(block, codec.BINARY_CODEC) + codec.encode_frame(ping)
+        reader = codec.FrameReader(buffer_size=16)
+        messages = []
+        for i in range(0, len(data), 7):
+            reader.feed(data[i:i + 7])
+            messages += self._drain(reader)
+        self.assertEqual(messages, [ping, block, ping])
+        self.assertEqual(reader.start, reader.end)
+
+    def test_frame_reader_recv_from_socket(self):
+        block = sample_block()
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(codec.encode_frame(block, codec.BINARY_CODEC) * 3)
+            left.shutdown(socket.SHUT_WR)
+            reader = codec.FrameReader(buffer_size=64)
+            messages = []
+            while reader.recv_from(right):
+                messages += self._drain(reader)
+        self.assertEqual(messages, [block] * 3)
+
+    def test_frame_reader_rejects_oversized(self):
+        reader = codec.FrameReader(max_frame_size=100)
+        reader.feed(codec.FRAME_HEADER.pack(codec.FRAME_MAGIC, 101))
+        with self.assertRaises(codec.FrameTooLarge):
+            reader.next_message()
+        reader = codec.FrameReader(max_frame_size=100)
+        reader.feed(b"{" + b"x" * 200)
+        with self.assertRaises(codec.FrameTooLarge):
+            reader.next_message()
+
+    def test_frame_reader_skips_malformed(self):
+        good = codec.encode_frame({"type": "PING"}, codec.BINARY_CODEC)
+        bad = codec.FRAME_HEADER.pack(codec.FRAME_MAGIC, 2) + bytes([codec.T_DICT, 5])
+        reader = codec.FrameReader(buffer_size=8)
+        reader.feed(bad + b"{oops}\n" + good)
+        with self.assertRaises(ValueError):
+            reader.next_message()
+        with self.assertRaises(ValueError):
+            reader.next_message()
+        self.assertEqual(reader.next_message(), {"type": "PING"})
+        # 缓冲区仍可扩容
+        reader.feed(b"x" * 100)
+
+    def test_frame_cache(self):
+        block = sample_block()
+        frame = codec.encode_frame(block, codec.BINARY_CODEC)
+        self.assertIs(codec.encode_frame(block, codec.BINARY_CODEC), frame)
+        self.assertNotEqual(codec.encode_frame(block), frame)
+        self.assertEqual(len(codec.frame_cache), 2)
+        # 按对象缓存：ID相同但内容不同的消息不会拿到旧的编码
+        variant = dict(block, transactions=[])
+        encoded = codec.encode_frame(variant, codec.BINARY_CODEC)
+        self.assertEqual(codec.decode_binary(encoded[codec.FRAME_HEADER.size:]), variant)
+        self.assertIs(codec.encode_frame(block, codec.BINARY_CODEC), frame)
+
+    def test_negotiation(self):
+        self.assertEqual(codec.codec_for("10.0.0.1", 5000), codec.JSON_CODEC)
+        # 默认优先JSON；旧版本的二进制格式（KEY_TABLE不同）不会被选中
+        codec.set_peer_codec("10.0.0.1", 5000, ["json", "bin2"])
+        self.assertEqual(codec.codec_for("10.0.0.1", 5000), codec.JSON_CODEC)
+        with patch.object(codec, "SUPPORTED_CODECS", list(codec.SUPPORTED_CODECS)):
+            codec.prefer_codec("bin2")
+            codec.set_peer_codec("10.0.0.1", 5000, ["json", "bin2"])
+            self.assertEqual(codec.codec_for("10.0.0.1", 5000), codec.BINARY_CODEC)
+            codec.set_peer_codec("10.0.0.3", 5000, ["bin1", "json"])
+            self.assertEqual(codec.codec_for("10.0.0.3", 5000), codec.JSON_CODEC)
+            with self.assertRaises(ValueError):
+                codec.prefer_codec("bin1")
+        codec.set_peer_codec("10.0.0.2", 5000, None)
+        self.assertEqual(codec.codec_for("10.0.0.2", 5000), codec.JSON_CODEC)
+
+if __name__ == "__main__":
+    unittest.main()
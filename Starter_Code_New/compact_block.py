@@ -0,0 +1,105 @@
+import time
+import hashlib
+import threading
+from utils import generate_message_id
+from transaction import get_recent_transactions
+from block_handler import get_block_by_id, create_getblock, verify_block
+
+# === Compact block relay ===
+# CMPCTBLOCK: the block without its transactions plus one short ID per transaction.
+# The receiver fills the transactions from its own pool and asks for the rest with GETBLOCKTXN / BLOCKTXN.
+# Short IDs are the first SHORT_ID_BYTES of sha256(block_id + tx_id), so they differ per block and cannot be
+# ground against the pool in advance.
+SHORT_ID_BYTES = 6
+PARTIAL_BLOCK_TTL = 30  # seconds a block waiting for missing transactions is kept
+
+partial_blocks = {}  # {block_id: {"header", "transactions": [tx or None], "expiry"}}
+partial_lock = threading.Lock()
+
+def short_id(block_id, tx_id):
+    digest = hashlib.sha256((block_id + tx_id).encode()).digest()
+    return int.from_bytes(digest[:SHORT_ID_BYTES], "big")
+
+def create_cmpctblock(block, sender_id):
+    # 构建CMPCTBLOCK消息
+    header = {key: value for key, value in block.items() if key != "transactions"}
+    return {
+        "type": "CMPCTBLOCK",
+        "sender": sender_id,
+        "header": header,
+        "short_ids": [short_id(block["block_id"], tx.get("tx_id", "")) for tx in block.get("transactions", [])],
+        "message_id": generate_message_id()
+    }
+
+def create_getblocktxn(sender_id, block_id, indexes):
+    # 构建GETBLOCKTXN消息，indexes为缺失交易在区块中的位置
+    return {
+        "type": "GETBLOCKTXN",
+        "sender": sender_id,
+        "block_id": block_id,
+        "indexes": indexes,
+        "message_id": generate_message_id()
+    }
+
+def create_blocktxn(sender_id, block_id, transactions):
+    # 构建BLOCKTXN消息
+    return {
+        "type": "BLOCKTXN",
+        "sender": sender_id,
+        "block_id": block_id,
+        "transactions": transactions,
+        "message_id": generate_message_id()
+    }
+
+def handle_cmpctblock(msg, self_id):
+    # 用本地交易池重建区块
+    # 返回 (完整区块, None)；缺交易时返回 (None, GETBLOCKTXN消息)；无法重建时返回 (None, GETBLOCK消息)
+    header = msg.get("header", {})
+    block_id = header.get("block_id")
+    short_ids = msg.get("short_ids", [])
+    pool = {}
+    for tx in get_recent_transactions():
+        sid = short_id(block_id, tx["tx_id"])
+        pool[sid] = None if sid in pool else tx  # 冲突的短ID按缺失处理
+    transactions = [pool.get(sid) for sid in short_ids]
+    missing = [i for i, tx in enumerate(transactions) if tx is None]
+    if not missing:
+        return _complete(header, transactions, self_id)
+    now = time.time()
+    with partial_lock:
+        for stale_id in [bid for bid, partial in partial_blocks.items() if partial["expiry"] < now]:
+            del partial_blocks[stale_id]
+        partial_blocks[block_id] = {"header": header, "transactions": transactions, "expiry": now + PARTIAL_BLOCK_TTL}
+    print(f"[{self_id}] Compact block {block_id}: {len(short_ids) - len(missing)}/{len(short_ids)} transactions from pool")
+    return None, create_getblocktxn(self_id, block_id, missing)
+
+def handle_blocktxn(msg, self_id):
+    # 填入补发的交易；返回 (完整区块, None) 或无法重建时 (None, GETBLOCK消息)，不认识的区块返回 (None, None)
+    with partial_lock:
+        partial = partial_blocks.pop(msg.get("block_id"), None)
+    if partial is None:
+        return None, None
+    transactions = partial["transactions"]
+    supplied = iter(msg.get("transactions", []))
+    for i, tx in enumerate(transactions):
+        if tx is None:
+            transactions[i] = next(supplied, None)
+    if any(tx is None for tx in transactions):
+        return None, create_getblock(self_id, [partial["header"]["block_id"]])
+    return _complete(partial["header"], transactions, self_id)
+
+def _complete(header, transactions, self_id):
+    # 重建出的区块与区块头不符（短ID冲突）时退回到请求完整区块
+    block = dict(header, transactions=transactions)
+    if not verify_block(block):
+        print(f"[{self_id}] Compact block {block.get('block_id')} did not rebuild, requesting the full block")
+        return None, create_getblock(self_id, [block.get("block_id")])
+    return block, None
+
+def get_block_transactions(block_id, indexes):
+    # 返回区块中指定位置的交易，用于响应GETBLOCKTXN
+    block = get_block_by_id(block_id)
+    if block is None:
+        return None
+    txs = block.get("transactions", [])
+    return [txs[i] for i in indexes if isinstance(i, int) and 0 <= i < len(txs)]
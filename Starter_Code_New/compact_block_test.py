@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import patch
+
+import compact_block
+from block_handler import compute_block_hash
+from transaction import TransactionMessage
+
+def make_block(count):
+    txs = [TransactionMessage("5000", "5001", i, 1700000000.0 + i).to_dict() for i in range(count)]
+    block = {"type": "BLOCK", "sender": "5000", "timestamp": 1700000100.0, "previous_block_id": "GENESIS", "transactions": txs}
+    block["block_id"] = compute_block_hash(block)
+    return block
+
+class TestCompactBlock(unittest.TestCase):
+    def setUp(self):
+        compact_block.partial_blocks.clear()
+
+    def test_rebuild_from_pool(self):
+        block = make_block(10)
+        msg = compact_block.create_cmpctblock(block, "5000")
+        self.assertNotIn("transactions", msg["header"])
+        self.assertEqual(len(msg["short_ids"]), 10)
+        with patch("compact_block.get_recent_transactions", return_value=list(reversed(block["transactions"]))):
+            rebuilt, request = compact_block.handle_cmpctblock(msg, "5001")
+        self.assertIsNone(request)
+        self.assertEqual(rebuilt, block)
+
+    def test_missing_transactions_round_trip(self):
+        block = make_block(10)
+        msg = compact_block.create_cmpctblock(block, "5000")
+        with patch("compact_block.get_recent_transactions", return_value=block["transactions"][::2]):
+            rebuilt, request = compact_block.handle_cmpctblock(msg, "5001")
+        self.assertIsNone(rebuilt)
+        self.assertEqual(request["type"], "GETBLOCKTXN")
+        self.assertEqual(request["indexes"], [1, 3, 5, 7, 9])
+        with patch("compact_block.get_block_by_id", return_value=block):
+            txs = compact_block.get_block_transactions(block["block_id"], request["indexes"])
+        rebuilt, request = compact_block.handle_blocktxn(compact_block.create_blocktxn("5000", block["block_id"], txs), "5001")
+        self.assertIsNone(request)
+        self.assertEqual(rebuilt, block)
+        self.assertEqual(compact_block.partial_blocks, {})
+
+    def test_falls_back_to_full_block(self):
+        block = make_block(3)
+        msg = compact_block.create_cmpctblock(block, "5000")
+        with patch("compact_block.get_recent_transactions", return_value=block["transactions"][:1]):
+            compact_block.handle_cmpctblock(msg, "5001")
+        # 补发的交易不完整
+        rebuilt, request = compact_block.handle_blocktxn(compact_block.create_blocktxn("5000", block["block_id"], [block["transactions"][1]]), "5001")
+        self.assertIsNone(rebuilt)
+        self.assertEqual(request["type"], "GETBLOCK")
+        self.assertEqual(request["block_ids"], [block["block_id"]])
+        # 重建结果哈希不符
+        msg["header"]["timestamp"] += 1
+        with patch("compact_block.get_recent_transactions", return_value=block["transactions"]):
+            rebuilt, request = compact_block.handle_cmpctblock(msg, "5001")
+        self.assertIsNone(rebuilt)
+        self.assertEqual(request["type"], "GETBLOCK")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,7 @@ from threading import Thread
 from peer_manager import peer_status, rtt_tracker, blacklist
 from transaction import get_recent_transactions
 # from link_simulator import rate_limiter
-from message_handler import get_redundancy_stats
+from message_handler import get_redundancy_stats, get_dispatch_stats
 from peer_discovery import known_peers, peer_config, peer_flags
 import json
 from block_handler import received_blocks, orphan_blocks, header_store
@@ -31,10 +31,10 @@ def home():
 
 @app.route('/blocks')
 def blocks():
-    # 展示本地区块链（received_blocks）
+    # 展示本地主链（received_blocks，不含分叉）
     if peer_config[self_id].get("light", False):
         return jsonify(header_store)
-    return jsonify(received_blocks)
+    return jsonify(list(received_blocks))
 
 @app.route('/peers')
 def peers():
@@ -94,6 +94,11 @@ def redundancy_stats():
     # 展示冗余消息统计
     return jsonify({"redundancy": get_redundancy_stats()})
 
+@app.route('/dispatch')
+def dispatch_stats():
+    # 展示分发队列深度与各类消息处理延迟
+    return jsonify(get_dispatch_stats())
+
 @app.route('/blacklist')
 def blacklist_display():
     # 展示黑名单
@@ -122,5 +127,5 @@ def disp_peer_flags():
 
 @app.route('/drop_stats')
 def disp_drop_stats():
-    from outbox import drop_stats
-    return jsonify(drop_stats)
\ No newline at end of file
+    from outbox import get_drop_stats
+    return jsonify(get_drop_stats())
\ No newline at end of file
@@ -16,7 +16,7 @@ def create_inv(block_ids, sender_id):
 
 def get_inventory():
     # 返回本地区块链所有区块ID
-    return [block["block_id"] for block in received_blocks]
+    return received_blocks.ids()
 
 def broadcast_inventory(self_id):
     # 构建INV消息并广播
@@ -24,9 +24,11 @@ class TestInvMessage(unittest.TestCase):
 
     def test_get_inventory(self):
         # 添加区块到 received_blocks
-        inv_message.received_blocks.append({"block_id": "b1"})
-        inv_message.received_blocks.append({"block_id": "b2"})
-        inv_message.received_blocks.append({"block_id": "b3"})
+        inv_message.received_blocks.append({"block_id": "b1", "previous_block_id": "GENESIS"})
+        inv_message.received_blocks.append({"block_id": "b2", "previous_block_id": "b1"})
+        inv_message.received_blocks.append({"block_id": "b3", "previous_block_id": "b2"})
+        # 分叉上的区块不在主链中
+        inv_message.received_blocks.append({"block_id": "f2", "previous_block_id": "b1"})
         inventory = inv_message.get_inventory()
         self.assertEqual(inventory, ["b1", "b2", "b3"])
 
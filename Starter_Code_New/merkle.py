@@ -0,0 +1,73 @@
+import json
+import hashlib
+
+# === Merkle tree over transaction IDs ===
+# Leaves are sha256(0x00 | tx_id) and inner nodes sha256(0x01 | left | right), so a leaf can never pass for an inner node.
+# A node without a sibling is promoted to the next level unchanged instead of being paired with itself.
+# A proof is {"index": position of the tx, "size": number of txs, "hashes": sibling hashes from the leaf upwards}.
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+
+def tx_leaf_id(tx):
+    # Transactions carry their own `tx_id`; anything else is identified by the hash of its JSON form.
+    # The leaf trusts the claimed `tx_id`, so `block_handler.verify_block` checks each one against its transaction.
+    if isinstance(tx, dict) and tx.get("tx_id"):
+        return tx["tx_id"]
+    return hashlib.sha256(json.dumps(tx, sort_keys=True).encode()).hexdigest()
+
+def _leaf(tx_id):
+    # 叶子只接受字符串ID，其他类型（如JSON里的数字tx_id）以ValueError拒绝，调用者按校验失败处理
+    if not isinstance(tx_id, str):
+        raise ValueError(f"tx_id must be a string, got {type(tx_id).__name__}")
+    return hashlib.sha256(b"\x00" + tx_id.encode()).digest()
+
+def _node(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def _next_level(level):
+    return [_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+
+def merkle_root(tx_ids):
+    if not tx_ids:
+        return EMPTY_ROOT
+    level = [_leaf(tx_id) for tx_id in tx_ids]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+def block_merkle_root(transactions):
+    return merkle_root([tx_leaf_id(tx) for tx in transactions])
+
+def merkle_proof(tx_ids, index):
+    # Inclusion proof for tx_ids[index], O(log n) hashes.
+    if not 0 <= index < len(tx_ids):
+        raise IndexError(f"No transaction at position {index}")
+    level = [_leaf(tx_id) for tx_id in tx_ids]
+    hashes = []
+    i = index
+    while len(level) > 1:
+        sibling = i ^ 1
+        if sibling < len(level):
+            hashes.append(level[sibling].hex())
+        level = _next_level(level)
+        i //= 2
+    return {"index": index, "size": len(tx_ids), "hashes": hashes}
+
+def verify_proof(tx_id, proof, root):
+    # Check that `tx_id` is at `proof["index"]` of a tree with Merkle root `root`.
+    try:
+        index, size, hashes = int(proof["index"]), int(proof["size"]), list(proof["hashes"])
+        if not 0 <= index < size:
+            return False
+        h = _leaf(tx_id)
+        i, n = index, size
+        while n > 1:
+            if i ^ 1 < n:
+                if not hashes:
+                    return False
+                sibling = bytes.fromhex(hashes.pop(0))
+                h = _node(sibling, h) if i % 2 else _node(h, sibling)
+            i //= 2
+            n = (n + 1) // 2
+        return not hashes and h.hex() == root
+    except (KeyError, TypeError, ValueError):
+        return False
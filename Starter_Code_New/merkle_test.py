@@ -0,0 +1,49 @@
+import unittest
+import hashlib
+
+import merkle
+
+def tx_ids(n):
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(n)]
+
+class TestMerkle(unittest.TestCase):
+    def test_root(self):
+        self.assertEqual(merkle.merkle_root([]), merkle.EMPTY_ROOT)
+        ids = tx_ids(5)
+        self.assertEqual(merkle.merkle_root(ids), merkle.merkle_root(list(ids)))
+        self.assertNotEqual(merkle.merkle_root(ids), merkle.merkle_root(ids[::-1]))
+        # 奇数节点直接上移，不与自身配对，因此重复最后一笔交易会改变根
+        self.assertNotEqual(merkle.merkle_root(ids), merkle.merkle_root(ids + ids[-1:]))
+
+    def test_proofs_for_every_position(self):
+        for n in range(1, 12):
+            ids = tx_ids(n)
+            root = merkle.merkle_root(ids)
+            for i, tx_id in enumerate(ids):
+                proof = merkle.merkle_proof(ids, i)
+                self.assertLessEqual(len(proof["hashes"]), n.bit_length())
+                self.assertTrue(merkle.verify_proof(tx_id, proof, root), (n, i))
+
+    def test_invalid_proofs(self):
+        ids = tx_ids(7)
+        root = merkle.merkle_root(ids)
+        proof = merkle.merkle_proof(ids, 3)
+        self.assertFalse(merkle.verify_proof(ids[4], proof, root))
+        self.assertFalse(merkle.verify_proof(ids[3], dict(proof, index=2), root))
+        self.assertFalse(merkle.verify_proof(ids[3], dict(proof, hashes=proof["hashes"][:-1]), root))
+        self.assertFalse(merkle.verify_proof(ids[3], dict(proof, hashes=["zz"]), root))
+        self.assertFalse(merkle.verify_proof(ids[3], {}, root))
+        with self.assertRaises(IndexError):
+            merkle.merkle_proof(ids, 7)
+
+    def test_non_string_tx_id(self):
+        with self.assertRaises(ValueError):
+            merkle.block_merkle_root([{"tx_id": 1}])
+        self.assertFalse(merkle.verify_proof(7, {"index": 0, "size": 1, "hashes": []}, merkle.EMPTY_ROOT))
+        from block_handler import verify_block
+        block = {"block_id": "x", "previous_block_id": "GENESIS", "timestamp": 1, "transactions": [{"tx_id": 1}]}
+        self.assertFalse(verify_block(block))
+        self.assertFalse(verify_block(dict(block, merkle_root="y")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,19 @@
 import json
 import threading
 import time
-import hashlib
-import random
+import queue
+import os
 from collections import defaultdict
-from peer_discovery import handle_hello_message, known_peers, peer_config, peer_flags
-from block_handler import handle_block, get_block_by_id, create_getblock, received_blocks, header_store
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from peer_discovery import handle_hello_message, known_peers, peer_config
+from block_handler import handle_block, verify_block, transaction_valid, transactions_valid, get_block_by_id, create_getblock, received_blocks, park_block_request, handle_block_headers, on_block_downloaded, is_download_requested, create_proof, handle_proof, MAX_HEADERS_PER_MSG
 from inv_message import  create_inv, get_inventory
+from compact_block import create_cmpctblock, create_blocktxn, handle_cmpctblock, handle_blocktxn, get_block_transactions
 from block_handler import create_getblock
 from peer_manager import  update_peer_heartbeat, record_offense, create_pong, handle_pong, blacklist
-from transaction import add_transaction
+from reconcile import handle_reconcile, handle_getsketch
+from transaction import add_transaction, is_known_transaction, TransactionMessage, announce_transaction, handle_txinv, get_requested_transactions
 from outbox import enqueue_message, gossip_message
 
 
@@ -21,6 +25,38 @@ redundant_blocks = 0
 redundant_txs = 0
 message_redundancy = 0
 peer_inbound_timestamps = defaultdict(list)
+seen_lock = threading.Lock()
+
+
+# === Dispatch Worker Pool ===
+# The receiving thread only parses and deduplicates; handlers run on per-lane workers.
+# Control traffic has its own lane so PONG handling (and the RTT it measures) never waits behind blocks or TXs.
+# Block and TX lanes keep a single worker each so chain and pool updates stay in arrival order.
+DISPATCH_LANES = {
+    "control": {"types": {"PING", "PONG", "HELLO"}, "workers": 1, "queue_size": 1000},
+    "block": {"types": {"BLOCK", "INV", "GETBLOCK", "GET_BLOCK_HEADERS", "BLOCK_HEADERS", "CMPCTBLOCK", "GETBLOCKTXN", "BLOCKTXN", "GETPROOF", "PROOF"}, "workers": 1, "queue_size": 500},
+    "tx": {"types": {"TX", "TXS", "TXINV", "GETTX", "RECONCILE", "GETSKETCH"}, "workers": 1, "queue_size": 2000},
+    "other": {"types": set(), "workers": 1, "queue_size": 500},  # RELAY and unknown types
+}
+dispatch_queues = {}  # {lane: queue.Queue of (enqueue_time, msg, self_id, self_ip)}
+dispatch_drops = defaultdict(int)  # {lane: messages dropped because the lane queue was full}
+handler_stats = defaultdict(lambda: {"count": 0, "wait_ms": 0.0, "handle_ms": 0.0, "max_handle_ms": 0.0})  # per message type
+stats_lock = threading.Lock()
+
+# === Validation Stage ===
+# Workers of the block and TX lanes take up to VALIDATION_BATCH queued messages at a time and check the block / TX
+# hashes of the whole batch before handling the messages one by one in arrival order.
+# Hashing a transaction holds the GIL, so threads cannot share the work: batches with at least VALIDATION_PARALLEL_MIN
+# transactions send them in chunks of VALIDATION_CHUNK to a process pool, smaller ones are checked on the lane worker,
+# where they are faster than the cost of shipping them to another process. Without a second CPU there is no pool.
+VALIDATED_TYPES = {"BLOCK", "TX", "TXS"}
+VALIDATED_LANES = {"block", "tx"}
+VALIDATION_BATCH = 64
+VALIDATION_WORKERS = min(8, os.cpu_count() or 1)
+VALIDATION_PARALLEL_MIN = 2000  # transactions
+VALIDATION_CHUNK = 250  # transactions per process pool job
+validation_pool = None
+validation_stats = {"batches": 0, "parallel": 0, "messages": 0, "invalid": 0, "validate_ms": 0.0}
 
 
 # === Inbound Rate Limiting ===
@@ -55,22 +91,208 @@ def dispatch_message(msg, self_id, self_ip):
 
     ''' Read the message. '''
 
-    # Check if the message has been seen in `seen_message_ids` to prevent replay attacks. If yes, drop the message and add one to `message_redundancy`. If not, add the message ID to `seen_message_ids`.
-    if message_id in seen_message_ids:
-        message_redundancy += 1
-        print(f"[{self_id}] Message {message_id} already seen, dropping message")
-        return
-    else:
-        if message_id != "UNKNOWN": 
-            seen_message_ids[message_id] = time.time()
+    # Check if the message has been seen in `seen_message_ids` to prevent replay attacks. If yes, drop the message and add one to `message_redundancy`.
+    with seen_lock:
+        if message_id in seen_message_ids:
+            message_redundancy += 1
+            print(f"[{self_id}] Message {message_id} already seen, dropping message")
+            return
+    sender = msg.get("sender", msg.get("from"))
     # Check if the sender sends message too frequently using the function `is_inbound_limited`. If yes, drop the message.
-    if is_inbound_limited(msg.get("sender", msg.get("from"))):
-        print(f"[⚠️] {msg.get('sender', msg.get('from'))} is inbound limited, dropping message")
+    # 下载调度器请求的区块不限速：BLOCK的sender是矿工而不是回复的节点，一批回复很容易超过单个矿工的限额
+    if not (msg_type == "BLOCK" and is_download_requested(message_id)) and is_inbound_limited(sender):
+        print(f"[⚠️] {sender} is inbound limited, dropping message")
         return
     # Check if the sender exists in the `blacklist` of `peer_manager.py`. If yes, drop the message.
-    if msg.get("sender", msg.get("from")) in blacklist:
-        print(f"[⚠️] {msg['sender']} is in the blacklist, dropping message")
+    if sender in blacklist:
+        print(f"[⚠️] {sender} is in the blacklist, dropping message")
         return
+    # Only a message that passed the checks is recorded in `seen_message_ids`, so a dropped one can still be delivered again.
+    with seen_lock:
+        if message_id in seen_message_ids:
+            message_redundancy += 1
+            return
+        if message_id != "UNKNOWN":
+            seen_message_ids[message_id] = time.time()
+
+    # Hand the message to its lane if the worker pool is running, otherwise handle it on this thread.
+    if dispatch_queues:
+        lane = lane_of(msg_type)
+        try:
+            dispatch_queues[lane].put_nowait((time.time(), msg, self_id, self_ip))
+        except queue.Full:
+            dispatch_drops[lane] += 1
+            print(f"[{self_id}] Dispatch lane {lane} is full, dropping {msg_type}")
+        return
+    process_message(msg, self_id, self_ip)
+
+def lane_of(msg_type):
+    for lane, cfg in DISPATCH_LANES.items():
+        if msg_type in cfg["types"]:
+            return lane
+    return "other"
+
+def start_dispatch_workers():
+    # Create the bounded lane queues and their workers. Call before the socket server starts.
+    global validation_pool
+    if validation_pool is None and VALIDATION_WORKERS > 1:
+        # spawn rather than fork: the node already runs threads whose locks a forked child would inherit
+        validation_pool = ProcessPoolExecutor(max_workers=VALIDATION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    for lane, cfg in DISPATCH_LANES.items():
+        dispatch_queues[lane] = queue.Queue(maxsize=cfg["queue_size"])
+        for _ in range(cfg["workers"]):
+            threading.Thread(target=dispatch_worker, args=(dispatch_queues[lane], lane in VALIDATED_LANES), daemon=True).start()
+
+def dispatch_worker(lane_queue, validate=False):
+    while True:
+        batch = [lane_queue.get()]
+        if validate:
+            # Take whatever else is already queued, without waiting for more.
+            while len(batch) < VALIDATION_BATCH:
+                try:
+                    batch.append(lane_queue.get_nowait())
+                except queue.Empty:
+                    break
+        results = [None] * len(batch)
+        if validate:
+            try:
+                results = validate_batch([msg for _, msg, _, _ in batch])
+            except Exception as e:
+                # 校验阶段本身出错时整批按无效处理，lane的worker不能因此退出
+                print(f"Error validating a batch of {len(batch)} messages: {e}")
+                results = [False] * len(batch)
+        for (enqueued_at, msg, self_id, self_ip), valid in zip(batch, results):
+            started = time.time()
+            try:
+                process_message(msg, self_id, self_ip, valid)
+            except Exception as e:
+                print(f"[{self_id}] Error handling {msg.get('type')}: {e}")
+            finished = time.time()
+            with stats_lock:
+                stats = handler_stats[msg.get("type")]
+                stats["count"] += 1
+                stats["wait_ms"] += (started - enqueued_at) * 1000
+                stats["handle_ms"] += (finished - started) * 1000
+                stats["max_handle_ms"] = max(stats["max_handle_ms"], (finished - started) * 1000)
+
+def validate_message(msg):
+    # True / False for BLOCK messages, None for types without a hash to check.
+    # A valid TX gives the TransactionMessage that was hashed, so `process_message` pools it without serializing it again.
+    msg_type = msg.get("type")
+    try:
+        if msg_type == "BLOCK":
+            return verify_block(msg)
+        if msg_type == "TX":
+            if is_known_transaction(msg.get("tx_id")):
+                return None  # duplicate, dropped by `process_message` without hashing
+            tx = TransactionMessage.from_dict(msg)
+            return tx if msg.get("tx_id") and tx.is_valid() else False
+    except (KeyError, TypeError, ValueError):
+        return False
+    return None
+
+def validation_jobs(msg):
+    # The checks of one message as (function, argument) pairs.
+    # A block is split into its header / Merkle check and its transactions in chunks of VALIDATION_CHUNK, so the
+    # transactions of a large block are spread over the pool. Only `transactions_valid` jobs leave this process.
+    # A TXS batch skips the transactions already known, which `process_message` drops without hashing.
+    transactions = msg.get("transactions")
+    if msg.get("type") == "BLOCK" and isinstance(transactions, list):
+        return [(verify_block_header, msg)] + transaction_chunks(transactions)
+    if msg.get("type") == "TXS" and isinstance(transactions, list):
+        return transaction_chunks([tx for tx in transactions if not known_transaction(tx)])
+    return [(validate_message, msg)]
+
+def transaction_chunks(transactions):
+    return [(transactions_valid, transactions[i:i + VALIDATION_CHUNK]) for i in range(0, len(transactions), VALIDATION_CHUNK)]
+
+def known_transaction(tx):
+    try:
+        return isinstance(tx, dict) and is_known_transaction(tx.get("tx_id"))
+    except TypeError:  # unhashable tx_id
+        return False
+
+def verify_block_header(block):
+    return verify_block(block, check_transactions=False)
+
+def run_validation_job(job):
+    # 畸形的消息可能在任何一步抛出异常（如非字符串的tx_id），都算作校验失败
+    func, arg = job
+    try:
+        return func(arg)
+    except Exception:
+        return False
+
+def validate_batch(messages):
+    # A message is True only if all of its jobs passed (a TXS batch of known transactions has none).
+    # With enough transactions their chunks go to the process pool first, and the other jobs run here meanwhile.
+    started = time.time()
+    jobs = [validation_jobs(msg) for msg in messages]
+    flat = [job for message_jobs in jobs for job in message_jobs]
+    remote = [i for i, (func, _) in enumerate(flat) if func is transactions_valid]
+    parallel = (validation_pool is not None and len(remote) > 1
+                and sum(len(flat[i][1]) for i in remote) >= VALIDATION_PARALLEL_MIN)
+    flat_results = [None] * len(flat)
+    if parallel:
+        pending = submit_validation_jobs([flat[i] for i in remote])
+    for i, job in enumerate(flat):
+        if not (parallel and job[0] is transactions_valid):
+            flat_results[i] = run_validation_job(job)
+    if parallel:
+        for i, result in zip(remote, collect_validation_results(pending, [flat[i] for i in remote])):
+            flat_results[i] = result
+    flat_results = iter(flat_results)
+    results = []
+    for message_jobs in jobs:
+        values = [next(flat_results) for _ in message_jobs]
+        results.append(values[0] if len(values) == 1 and message_jobs[0][0] is validate_message else all(values))
+    with stats_lock:
+        validation_stats["batches"] += 1
+        validation_stats["parallel"] += parallel
+        validation_stats["messages"] += len(messages)
+        validation_stats["invalid"] += sum(result is False for result in results)
+        validation_stats["validate_ms"] += (time.time() - started) * 1000
+    return results
+
+def submit_validation_jobs(jobs):
+    try:
+        return validation_pool.map(run_validation_job, jobs)
+    except Exception as e:
+        print(f"Validation pool unavailable: {e}")
+        return None
+
+def collect_validation_results(pending, jobs):
+    # 进程池出错（如子进程被杀）时在本线程重新校验，不能把这批消息当作无效而惩罚发送者
+    if pending is not None:
+        try:
+            return list(pending)
+        except Exception as e:
+            print(f"Validation pool failed, validating {len(jobs)} jobs here: {e}")
+    return [run_validation_job(job) for job in jobs]
+
+def get_dispatch_stats():
+    # Return the queue depth of each lane and the average queueing and handling latency of each message type.
+    with stats_lock:
+        handlers = {
+            msg_type: {
+                "count": stats["count"],
+                "avg_wait_ms": stats["wait_ms"] / stats["count"],
+                "avg_handle_ms": stats["handle_ms"] / stats["count"],
+                "max_handle_ms": stats["max_handle_ms"]
+            }
+            for msg_type, stats in handler_stats.items() if stats["count"]
+        }
+        validation = dict(validation_stats)
+    return {
+        "queues": {lane: q.qsize() for lane, q in dispatch_queues.items()},
+        "dropped": dict(dispatch_drops),
+        "handlers": handlers,
+        "validation": validation
+    }
+
+def process_message(msg, self_id, self_ip, valid=None):
+    # `valid` is the result of the validation stage for BLOCK and TX messages, None if they were not validated yet.
+    msg_type = msg.get("type")
 
     #format in outbox.relay_or_direct_send
     if msg_type == "RELAY":
@@ -96,7 +318,14 @@ def dispatch_message(msg, self_id, self_ip):
 
         # Check the correctness of block ID. If incorrect, record the sender's offence using the function `record_offence` in `peer_manager.py`.
         # Call the function `handle_block` in `block_handler.py` to process the block.
-        success = handle_block(msg, self_id)
+        # Blocks requested by the sync download scheduler are validated there and applied in header order instead.
+        if on_block_downloaded(msg, self_id, valid):
+            return
+        if valid is False:
+            record_offense(msg.get("sender"))
+            print(f"[{self_id}] Invalid block {msg.get('block_id')} from {msg.get('sender')}. Offense recorded.")
+            return
+        success = handle_block(msg, self_id, verified=valid is True)
 
         if not success:
             print(f"[{self_id}] block message drop.")
@@ -108,23 +337,114 @@ def dispatch_message(msg, self_id, self_ip):
         # Broadcast the `INV` message to known peers using the function `gossip_message` in `outbox.py`.
         gossip_message(self_id, inv_msg)
 
+    #format in compact_block.create_cmpctblock
+    elif msg_type in ("CMPCTBLOCK", "BLOCKTXN"):
+
+        # Rebuild the block from the local transaction pool, then handle it like a `BLOCK` message.
+        # Missing transactions are requested with `GETBLOCKTXN`; a block that cannot be rebuilt is requested in full with `GETBLOCK`.
+        if msg_type == "CMPCTBLOCK":
+            if msg.get("header", {}).get("block_id") in received_blocks:
+                return
+            block, request = handle_cmpctblock(msg, self_id)
+        else:
+            block, request = handle_blocktxn(msg, self_id)
+        if request is not None and msg["sender"] in peer_config:
+            enqueue_message(msg["sender"], peer_config[msg["sender"]]["ip"], peer_config[msg["sender"]]["port"], request)
+        # The rebuilt block was already verified against its header, so `handle_block` does not hash it again.
+        if block is not None and handle_block(block, self_id, verified=True):
+            gossip_message(self_id, create_inv([block["block_id"]], self_id))
+
+    #format in compact_block.create_getblocktxn
+    elif msg_type == "GETBLOCKTXN":
+        transactions = get_block_transactions(msg.get("block_id"), msg.get("indexes", []))
+        if transactions is not None and msg["sender"] in peer_config:
+            blocktxn_msg = create_blocktxn(self_id, msg["block_id"], transactions)
+            enqueue_message(msg["sender"], peer_config[msg["sender"]]["ip"], peer_config[msg["sender"]]["port"], blocktxn_msg)
+
+    #format in block_handler.create_getproof
+    elif msg_type == "GETPROOF":
+
+        # Build the Merkle inclusion proof of the transaction and send it back in a `PROOF` message.
+        if msg["sender"] in peer_config:
+            proof_msg = create_proof(self_id, msg.get("tx_id"), msg.get("block_id"))
+            enqueue_message(msg["sender"], peer_config[msg["sender"]]["ip"], peer_config[msg["sender"]]["port"], proof_msg)
+
+    #format in block_handler.create_proof
+    elif msg_type == "PROOF":
+
+        # Check the proof against the Merkle root in the local block header.
+        handle_proof(msg)
+
     #format in transaction.start_transaction_generation
     elif msg_type == "TX":
-        from transaction import TransactionMessage
         # Check the correctness of transaction ID. If incorrect, record the sender's offence using the function `record_offence` in `peer_manager.py`.
-        rcv_tx_id = msg["tx_id"]
-        tx = TransactionMessage(msg["from"], msg["to"], msg["amount"], msg["timestamp"])
-        calc_tx_id = tx.compute_hash()
-        if rcv_tx_id!= calc_tx_id:
+        # The transaction is serialized and hashed once: `valid` is the TransactionMessage built by the validation stage,
+        # whose cached bytes are reused by `tx_pool`. Transactions already pooled or recently confirmed are dropped before any hashing.
+        if is_known_transaction(msg.get("tx_id")):
+            return
+        tx = valid if isinstance(valid, TransactionMessage) else TransactionMessage.from_dict(msg)
+        if valid is None:
+            valid = bool(msg.get("tx_id")) and tx.is_valid()
+        if not valid:
             record_offense(msg["from"])
-            print(f"[{self_id}] Invalid transaction ID {rcv_tx_id}, expected {calc_tx_id}. Offense recorded.")
+            print(f"[{self_id}] Invalid transaction ID {tx.id}, expected {tx.compute_hash()}. Offense recorded.")
             return
 
         # Add the transaction to `tx_pool` using the function `add_transaction` in `transaction.py`.
-        add_transaction(tx)
+        # Announce it to known peers in the next `TXINV` batch (`announce_transaction` in `transaction.py`); they fetch the body with `GETTX` only if they lack it.
+        if add_transaction(tx):
+            announce_transaction(tx.id)
+
+    #format in transaction.create_txs
+    elif msg_type == "TXS":
 
-        # Broadcast the transaction to known peers using the function `gossip_message` in `outbox.py`.
-        gossip_message(self_id, msg)
+        # Transactions requested with `GETTX`, batched in one message from the peer that relays them.
+        # `valid` is True only if every transaction passed the validation stage; otherwise each one is checked here so the good ones are still accepted.
+        for data in msg.get("transactions", []):
+            if not isinstance(data, dict) or is_known_transaction(data.get("tx_id")):
+                continue
+            if valid is not True and not transaction_valid(data):
+                record_offense(msg["sender"])
+                print(f"[{self_id}] Invalid transaction {data.get('tx_id')} from {msg['sender']}. Offense recorded.")
+                continue
+            tx = TransactionMessage.from_dict(data)
+            if add_transaction(tx):
+                announce_transaction(tx.id)
+
+    #format in transaction.create_txinv
+    elif msg_type == "TXINV":
+
+        # Request the announced transactions that are neither in `tx_pool`, recently confirmed nor already requested from another peer.
+        gettx_msg = handle_txinv(msg, self_id)
+        if gettx_msg:
+            target_ip, target_port = known_peers[msg["sender"]]
+            enqueue_message(msg["sender"], target_ip, target_port, gettx_msg)
+
+    #format in transaction.create_gettx
+    elif msg_type == "GETTX":
+
+        # Send the requested transactions found in `tx_pool` back to the sender in `TXS` batches.
+        target_ip, target_port = known_peers[msg["sender"]]
+        for txs_msg in get_requested_transactions(msg, self_id):
+            enqueue_message(msg["sender"], target_ip, target_port, txs_msg)
+
+    #format in reconcile.create_reconcile
+    elif msg_type == "RECONCILE":
+
+        # Subtract the sketch of the local pool from the sender's sketch (`handle_reconcile` in `reconcile.py`).
+        # Send back `GETTX` for the transactions only the sender has, `TXINV` for the ones only we have, or `GETSKETCH` if the sketch was too small.
+        target_ip, target_port = known_peers[msg["sender"]]
+        for reply in handle_reconcile(msg, self_id):
+            enqueue_message(msg["sender"], target_ip, target_port, reply)
+
+    #format in reconcile.create_getsketch
+    elif msg_type == "GETSKETCH":
+
+        # Send a bigger sketch of the local pool.
+        reconcile_msg = handle_getsketch(msg, self_id)
+        if reconcile_msg:
+            target_ip, target_port = known_peers[msg["sender"]]
+            enqueue_message(msg["sender"], target_ip, target_port, reconcile_msg)
 
     #format in peer_manager.start_ping_loop
     elif msg_type == "PING":
@@ -159,11 +479,12 @@ def dispatch_message(msg, self_id, self_ip):
         # Compare the local block IDs with those in the message.
         # If there are missing blocks, create a `GETBLOCK` message to request the missing blocks from the sender.
         # Send the `GETBLOCK` message to the sender using the function `enqueue_message` in `outbox.py`.
-        local_block_ids = get_inventory() # list of block_id
+        # 直接在区块索引上判断，不必为每条 INV 复制整份 inventory
         rcv_block_ids = msg.get("block_ids", [])
-        missing_block_ids = [block_id for block_id in rcv_block_ids if block_id not in local_block_ids]
+        missing_block_ids = [block_id for block_id in rcv_block_ids if block_id not in received_blocks]
         if missing_block_ids:
-            getblock_msg = create_getblock(self_id, missing_block_ids)
+            # 新公告的区块大多数交易已在本地交易池中，请求对方用CMPCTBLOCK回复
+            getblock_msg = create_getblock(self_id, missing_block_ids, compact=True)
             target_ip, target_port = known_peers[msg["sender"]]
             enqueue_message(msg["sender"], target_ip, target_port, getblock_msg)
 
@@ -205,75 +526,39 @@ def dispatch_message(msg, self_id, self_ip):
                     sender,
                     peer_config.get(sender)["ip"],
                     peer_config.get(sender)["port"],
-                    block
+                    create_cmpctblock(block, self_id) if msg.get("compact") else block
                 )
             except Exception as e:
                 print(f"🆘 Error calling enqueue_message: {e}, msg={msg}, peer_config_keys={list(peer_config.keys())}")
             
 
-        # 3. 如果有缺失区块，向其他 peer 请求
-        if missing_block_ids:
+        # 3. 缺失的区块登记到等待表，区块经`handle_block`到达时再发送给请求者，不阻塞分发线程
+        fetch_block_ids = [block_id for block_id in missing_block_ids if park_block_request(block_id, msg["sender"])]
+
+        # 4. 只为此前无人等待的区块向其他 peer 请求
+        if fetch_block_ids:
+            get_block_msg = create_getblock(self_id, fetch_block_ids)
             for peer_id in known_peers:
-                if peer_id == self_id:
+                if peer_id == self_id or peer_id == msg["sender"]:
                     continue
-                get_block_msg = create_getblock(self_id, missing_block_ids)
                 enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], get_block_msg)
 
-            # 4. 最多重试3次，每次等待10秒
-            retry_cnt = 0
-            while missing_block_ids and retry_cnt < 3:
-                retry_cnt += 1
-                print(f"[{self_id}] get block retry {retry_cnt} times, missing: {missing_block_ids}")
-                time.sleep(10)
-                found_block_ids = []
-                for block_id in missing_block_ids:
-                    block = get_block_by_id(block_id)
-                    if block:
-                        try:
-                            json.dumps(block)
-                        except Exception as e:
-                            print(f"[{self_id}] Block not serializable: {e}, block={block}")
-                            continue
-                        print(f"Sending BLOCK: {block['block_id']}")
-                        enqueue_message(
-                            msg["sender"],
-                            peer_config[msg["sender"]]["ip"],
-                            peer_config[msg["sender"]]["port"],
-                            block
-                        )
-                        found_block_ids.append(block_id)
-                # 移除已找到的区块
-                for block_id in found_block_ids:
-                    missing_block_ids.remove(block_id)
-                # 继续向其他 peer 请求剩余的
-                if missing_block_ids:
-                    for peer_id in known_peers:
-                        if peer_id == self_id:
-                            continue
-                        get_block_msg = create_getblock(self_id, missing_block_ids)
-                        enqueue_message(peer_id, peer_config[peer_id]["ip"], peer_config[peer_id]["port"], get_block_msg)
-
 
     #format in block_handler.request_block_sync
     elif msg_type == "GET_BLOCK_HEADERS":
         from utils import generate_message_id
         
-        # Read all block header in the local blockchain and store them in `headers`.
-        headers = []
-        for block in received_blocks:
-            header = {
-                "sender": block["sender"],
-                "timestamp": block["timestamp"],
-                "block_id": block["block_id"],
-                "previous_block_id": block["previous_block_id"]
-            }
-            headers.append(header)
+        # Read the block headers after the common ancestor given by the requester's block locator, at most `max_count` of them.
+        # Requests without a locator start from the genesis block; `more` tells the requester to ask for the next page.
+        max_count = min(int(msg.get("max_count") or MAX_HEADERS_PER_MSG), MAX_HEADERS_PER_MSG)
+        headers, more = received_blocks.headers_after(msg.get("locator", []), max_count)
 
         # Create a `BLOCK_HEADERS` message, which should include `{message type, sender's ID, headers}`.
         block_headers_msg = {
             "type": "BLOCK_HEADERS",
             "sender": self_id,
             "headers": headers,
+            "more": more,
             "message_id": generate_message_id()
         }
 
@@ -284,34 +569,11 @@ def dispatch_message(msg, self_id, self_ip):
     elif msg_type == "BLOCK_HEADERS":
         
         # Check if the previous block of each block exists in the local blockchain or the received block headers.
-        prev_exist = True
-        headers = msg.get("headers", [])
-        for header in headers:
-            if header["previous_block_id"] not in received_blocks:
-                prev_exist = False
-
         # If yes and the peer is lightweight, add the block headers to the local blockchain.
-        # If yes and the peer is full, check if there are missing blocks in the local blockchain. 
-        # If there are missing blocks, create a `GET_BLOCK` message and send it to the sender.
-        if prev_exist:
-            light = peer_flags[msg["sender"]]["light"]
-            if light:
-                for header in headers:
-                    header_store.append(header)
-            else:
-                missing_block_ids = []
-                for header in headers:
-                    if header["block_id"] not in received_blocks:
-                        missing_block_ids.append(header["block_id"])
-                
-                for block_id in missing_block_ids:
-                    get_block_msg = create_getblock(self_id, [block_id])
-                    enqueue_message(msg["sender"], peer_config[msg["sender"]]["ip"], peer_config[msg["sender"]]["port"], get_block_msg)
-
+        # If yes and the peer is full, request the missing blocks from the sender.
         # If not, drop the message since there are orphaned blocks in the received message and, thus, the message is invalid.
-        else:
-            print(f"[{self_id}] Orphaned blocks in the received message, message dropped.")
-            return
+        # Pages from the current sync peer also drive the next `GET_BLOCK_HEADERS`, see `handle_block_headers` in `block_handler.py`.
+        handle_block_headers(msg, self_id)
 
 
     else:
@@ -1,7 +1,14 @@
 # message_handler_test.py
 import unittest
 import time
+import hashlib
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import message_handler
+from transaction import clear_pool, confirm_transactions, tx_ids
 
 # from message_handler import is_inbound_limited
 # from message_handler import INBOUND_TIME_WINDOW
@@ -24,6 +31,10 @@ def is_inbound_limited(peer_id):
             return True
     return False
 
+def outcomes(results):
+    # 合法的TX校验结果是TransactionMessage对象，按True比较
+    return [None if result is None else bool(result) for result in results]
+
 class TestIsInboundLimited(unittest.TestCase):
     def setUp(self):
         """在每个测试用例前重置时间戳记录"""
@@ -86,5 +97,246 @@ class TestIsInboundLimited(unittest.TestCase):
         # 应该刚好达到限制
         self.assertTrue(is_inbound_limited("peer1"))
 
+class TestDispatchLanes(unittest.TestCase):
+    def setUp(self):
+        message_handler.seen_message_ids.clear()
+        message_handler.peer_inbound_timestamps.clear()
+        message_handler.handler_stats.clear()
+        patcher = patch.dict(message_handler.dispatch_queues, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lane_of(self):
+        self.assertEqual(message_handler.lane_of("PONG"), "control")
+        self.assertEqual(message_handler.lane_of("BLOCK"), "block")
+        self.assertEqual(message_handler.lane_of("TX"), "tx")
+        self.assertEqual(message_handler.lane_of("RELAY"), "other")
+
+    def test_control_not_blocked_by_slow_handler(self):
+        """慢的区块处理不应延迟PONG"""
+        handled = []
+        pong_done = threading.Event()
+        def fake_process(msg, self_id, self_ip, valid=None):
+            if msg["type"] == "GET_BLOCK_HEADERS":
+                time.sleep(0.5)
+            handled.append(msg["type"])
+            if msg["type"] == "PONG":
+                pong_done.set()
+        with patch("message_handler.process_message", side_effect=fake_process):
+            message_handler.start_dispatch_workers()
+            message_handler.dispatch_message({"type": "GET_BLOCK_HEADERS", "sender": "a", "message_id": "m1"}, "self", "127.0.0.1")
+            message_handler.dispatch_message({"type": "PONG", "sender": "b", "message_id": "m2"}, "self", "127.0.0.1")
+            self.assertTrue(pong_done.wait(0.3))
+            self.assertEqual(handled, ["PONG"])
+            deadline = time.time() + 2
+            while len(handled) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.05)
+        stats = message_handler.get_dispatch_stats()
+        self.assertEqual(stats["handlers"]["PONG"]["count"], 1)
+        self.assertGreaterEqual(stats["handlers"]["GET_BLOCK_HEADERS"]["max_handle_ms"], 400)
+
+    def test_duplicate_not_queued(self):
+        message_handler.dispatch_queues["control"] = message_handler.queue.Queue()
+        msg = {"type": "PING", "sender": "a", "message_id": "dup"}
+        message_handler.dispatch_message(msg, "self", "127.0.0.1")
+        message_handler.dispatch_message(msg, "self", "127.0.0.1")
+        self.assertEqual(message_handler.dispatch_queues["control"].qsize(), 1)
+
+    def test_requested_block_burst_not_throttled(self):
+        # 下载回复里的区块都由同一个矿工签发，不能被按矿工限速，被限速丢弃的消息也不能记为已见
+        message_handler.dispatch_queues["block"] = message_handler.queue.Queue()
+        blocks = [{"type": "BLOCK", "sender": "miner", "block_id": f"b{i}", "message_id": f"b{i}"} for i in range(16)]
+        inflight = {block["block_id"]: ("peerB", time.time() + 10) for block in blocks}
+        with patch.dict("block_handler.download_inflight", inflight, clear=True):
+            for block in blocks:
+                message_handler.dispatch_message(block, "self", "127.0.0.1")
+        self.assertEqual(message_handler.dispatch_queues["block"].qsize(), 16)
+        unrequested = {"type": "BLOCK", "sender": "miner", "block_id": "x", "message_id": "x"}
+        for _ in range(message_handler.INBOUND_RATE_LIMIT):
+            message_handler.is_inbound_limited("miner")
+        message_handler.dispatch_message(unrequested, "self", "127.0.0.1")
+        self.assertNotIn("x", message_handler.seen_message_ids)
+        message_handler.peer_inbound_timestamps.clear()
+        message_handler.dispatch_message(unrequested, "self", "127.0.0.1")
+        self.assertEqual(message_handler.dispatch_queues["block"].qsize(), 17)
+
+class TestValidationStage(unittest.TestCase):
+    def setUp(self):
+        message_handler.validation_stats.update(batches=0, parallel=0, messages=0, invalid=0, validate_ms=0.0)
+        clear_pool()
+        patcher = patch("message_handler.validation_pool", ThreadPoolExecutor(max_workers=4))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _txs(self, count):
+        from transaction import TransactionMessage
+        return [TransactionMessage("a", "b", i, 1.0 + i).to_dict() for i in range(count)]
+
+    def test_batch_results_in_order(self):
+        txs = self._txs(20)
+        txs[3] = dict(txs[3], amount=999)
+        txs[7] = dict(txs[7], tx_id=None)
+        messages = txs + [{"type": "PING"}]
+        results = message_handler.validate_batch(messages)
+        expected = [i not in (3, 7) for i in range(20)] + [None]
+        self.assertEqual(outcomes(results), expected)
+        self.assertEqual(results[0].id, txs[0]["tx_id"])
+        self.assertEqual(message_handler.validation_stats["invalid"], 2)
+
+    def test_worker_handles_batch_in_arrival_order(self):
+        txs = self._txs(10)
+        txs[5] = dict(txs[5], amount=999)
+        lane_queue = message_handler.queue.Queue()
+        for tx in txs:
+            lane_queue.put((time.time(), tx, "self", "127.0.0.1"))
+        handled = []
+        done = threading.Event()
+        def fake_process(msg, self_id, self_ip, valid=None):
+            handled.append((msg["tx_id"], bool(valid)))
+            if len(handled) == len(txs):
+                done.set()
+        with patch("message_handler.process_message", side_effect=fake_process):
+            threading.Thread(target=message_handler.dispatch_worker, args=(lane_queue, True), daemon=True).start()
+            self.assertTrue(done.wait(2))
+        self.assertEqual(handled, [(tx["tx_id"], i != 5) for i, tx in enumerate(txs)])
+        self.assertEqual(message_handler.validation_stats["batches"], 1)
+
+    def test_invalid_results_record_offense(self):
+        tx = self._txs(1)[0]
+        block = {"type": "BLOCK", "sender": "miner", "block_id": "bad", "previous_block_id": "GENESIS", "transactions": []}
+        with patch("message_handler.record_offense") as mock_offense, \
+             patch("message_handler.add_transaction") as mock_add, \
+             patch("message_handler.handle_block") as mock_handle:
+            message_handler.process_message(tx, "self", "127.0.0.1", valid=False)
+            message_handler.process_message(block, "self", "127.0.0.1", valid=False)
+        self.assertEqual([call[0][0] for call in mock_offense.call_args_list], ["a", "miner"])
+        mock_add.assert_not_called()
+        mock_handle.assert_not_called()
+
+    def test_block_transactions_checked_in_stage(self):
+        from block_handler import compute_block_hash, block_merkle_root
+        txs = self._txs(5)
+        blocks = []
+        for body in (txs, [dict(txs[0], amount=10 ** 9)] + txs[1:]):
+            block = {"type": "BLOCK", "sender": "miner", "timestamp": 1, "previous_block_id": "GENESIS",
+                     "merkle_root": block_merkle_root(body), "transactions": body}
+            block["block_id"] = compute_block_hash(block)
+            blocks.append(block)
+        results = message_handler.validate_batch(blocks + [txs[0], {"type": "PING"}])
+        self.assertEqual(outcomes(results), [True, False, True, None])
+        with patch("message_handler.record_offense") as mock_offense, \
+             patch("message_handler.on_block_downloaded", return_value=False), \
+             patch("message_handler.handle_block") as mock_handle:
+            message_handler.process_message(blocks[1], "self", "127.0.0.1", valid=results[1])
+        mock_offense.assert_called_once_with("miner")
+        mock_handle.assert_not_called()
+
+    def test_malformed_block_rejected_without_killing_lane(self):
+        # 非字符串的tx_id会在计算Merkle根时抛出非ValueError的异常，应当只让这个区块无效
+        block = {"type": "BLOCK", "sender": "miner", "timestamp": 1, "previous_block_id": "GENESIS",
+                 "block_id": "x", "merkle_root": "y", "transactions": [{"tx_id": 1}]}
+        self.assertEqual(message_handler.validate_batch([block]), [False])
+        lane_queue = message_handler.queue.Queue()
+        txs = self._txs(1)
+        lane_queue.put((time.time(), block, "self", "127.0.0.1"))
+        handled = []
+        done = threading.Event()
+        def fake_process(msg, self_id, self_ip, valid=None):
+            handled.append((msg["type"], valid))
+            if len(handled) == 2:
+                done.set()
+        with patch("message_handler.process_message", side_effect=fake_process), \
+             patch("message_handler.validate_batch", side_effect=[RuntimeError("boom"), [True]]):
+            threading.Thread(target=message_handler.dispatch_worker, args=(lane_queue, True), daemon=True).start()
+            time.sleep(0.1)
+            lane_queue.put((time.time(), txs[0], "self", "127.0.0.1"))
+            self.assertTrue(done.wait(2))
+        self.assertEqual(handled, [("BLOCK", False), ("TX", True)])
+
+    def test_gettx_reply_survives_dispatch(self):
+        # 一次GETTX响应的所有交易都来自同一个转发节点，不应被按交易发起者限速或当作已见消息丢弃
+        from transaction import TransactionMessage, add_transaction, create_gettx, get_requested_transactions
+        txs = [TransactionMessage("origin", "b", i, 1.0 + i) for i in range(15)]
+        for tx in txs:
+            add_transaction(tx)
+        replies = get_requested_transactions(create_gettx("self", [tx.id for tx in txs]), "peerB")
+        clear_pool()
+        with patch.dict(message_handler.dispatch_queues, {}, clear=True), \
+             patch.dict(message_handler.peer_inbound_timestamps, {}, clear=True), \
+             patch("message_handler.announce_transaction"):
+            for reply in replies:
+                message_handler.dispatch_message(reply, "self", "127.0.0.1")
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(len(tx_ids), 15)
+
+    def test_txs_batch_with_forged_transaction(self):
+        from transaction import create_txs
+        txs = self._txs(3)
+        msg = create_txs("peerB", [txs[0], dict(txs[1], amount=999), txs[2]])
+        self.assertEqual(message_handler.validate_batch([msg]), [False])
+        with patch("message_handler.record_offense") as mock_offense, patch("message_handler.announce_transaction"):
+            message_handler.process_message(msg, "self", "127.0.0.1", valid=False)
+        mock_offense.assert_called_once_with("peerB")
+        self.assertEqual(set(tx_ids), {txs[0]["tx_id"], txs[2]["tx_id"]})
+
+    def test_transaction_serialized_once(self):
+        import json
+        tx = self._txs(1)[0]
+        with patch("transaction.json.dumps", wraps=json.dumps) as mock_dumps, \
+             patch("message_handler.announce_transaction") as mock_announce:
+            valid = message_handler.validate_batch([tx])[0]
+            message_handler.process_message(tx, "self", "127.0.0.1", valid)
+        self.assertEqual(mock_dumps.call_count, 1)
+        mock_announce.assert_called_once_with(tx["tx_id"])
+
+    def test_known_transactions_skip_hashing(self):
+        txs = self._txs(2)
+        confirm_transactions([txs[0]["tx_id"]])
+        with patch("transaction.hashlib.sha256", wraps=hashlib.sha256) as mock_sha:
+            self.assertIsNone(message_handler.validate_message(txs[0]))
+            self.assertEqual(mock_sha.call_count, 0)
+        with patch("message_handler.announce_transaction") as mock_announce:
+            message_handler.process_message(txs[0], "self", "127.0.0.1")
+            message_handler.process_message(txs[1], "self", "127.0.0.1")
+            message_handler.process_message(txs[1], "self", "127.0.0.1")
+        self.assertNotIn(txs[0]["tx_id"], tx_ids)
+        self.assertIn(txs[1]["tx_id"], tx_ids)
+        mock_announce.assert_called_once_with(txs[1]["tx_id"])
+
+    def _blocks(self, bodies):
+        from block_handler import compute_block_hash, block_merkle_root
+        blocks = []
+        for body in bodies:
+            block = {"type": "BLOCK", "sender": "miner", "timestamp": len(blocks), "previous_block_id": "GENESIS",
+                     "merkle_root": block_merkle_root(body), "transactions": body}
+            block["block_id"] = compute_block_hash(block)
+            blocks.append(block)
+        return blocks
+
+    def test_large_batch_validated_in_chunks_on_processes(self):
+        # 交易数达到阈值时按块分片交给进程池，结果与串行校验一致
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        txs = self._txs(30)
+        blocks = self._blocks([txs[:15], txs[15:29] + [dict(txs[29], amount=10 ** 9)]])
+        messages = blocks + [txs[0], {"type": "PING"}]
+        expected = [True, False, True, None]
+        self.assertEqual(outcomes(message_handler.validate_batch(messages)), expected)
+        self.assertEqual(message_handler.validation_stats["parallel"], 0)
+        pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+        self.addCleanup(pool.shutdown)
+        with patch("message_handler.VALIDATION_PARALLEL_MIN", 20), patch("message_handler.VALIDATION_CHUNK", 4), \
+             patch("message_handler.validation_pool", pool):
+            self.assertEqual(len(message_handler.validation_jobs(blocks[0])), 1 + 4)
+            self.assertEqual(outcomes(message_handler.validate_batch(messages)), expected)
+        self.assertEqual(message_handler.validation_stats["parallel"], 1)
+
+    def test_broken_pool_falls_back_to_serial(self):
+        blocks = self._blocks([self._txs(10)])
+        message_handler.validation_pool.shutdown()
+        with patch("message_handler.VALIDATION_PARALLEL_MIN", 1), patch("message_handler.VALIDATION_CHUNK", 2):
+            self.assertEqual(message_handler.validate_batch(blocks), [True])
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,15 +6,18 @@ import argparse
 import time
 import traceback
 from peer_discovery import start_peer_discovery, known_peers, peer_flags, peer_config
-from block_handler import block_generation, request_block_sync
+from block_handler import block_generation, request_block_sync, load_chain
 # from message_handler import cleanup_seen_messages
-from socket_server import start_socket_server
+from socket_server import start_socket_server, start_async_socket_server
+from message_handler import start_dispatch_workers
 from dashboard import start_dashboard
 from peer_manager import start_peer_monitor, start_ping_loop, rtt_tracker
-from outbox import send_from_queue
+from outbox import send_from_queue, configure_network
 # from link_simulator import start_dynamic_capacity_adjustment
 from inv_message import broadcast_inventory
-from transaction import transaction_generation
+from transaction import transaction_generation, configure_mempool, start_tx_relay
+from reconcile import start_reconciliation
+from codec import prefer_codec
 
 def main():
     
@@ -24,6 +27,8 @@ def main():
     parser.add_argument("--config", default="config.json")
     parser.add_argument("--fanout", type=int, help="Override fanout for this peer")
     parser.add_argument("--mode", default="normal", help="Node mode: normal or malicious")
+    parser.add_argument("--server", default="threaded", choices=["threaded", "async"], help="Inbound server: threaded listener or asyncio")
+    parser.add_argument("--data-dir", help="Persist blocks under this directory and reload them on restart")
     args = parser.parse_args()
     MALICIOUS_MODE = args.mode == 'malicious'
 
@@ -57,6 +62,16 @@ def main():
     peer_config.clear()
     peer_config.update({k: v.copy() for k, v in config["peers"].items()})
 
+    # Emulated link conditions (latency, jitter, drop probability, bandwidth)
+    configure_network(config)
+
+    # Mempool caps and block template size
+    configure_mempool(config)
+
+    # Wire codec for outbound messages: JSON unless this node opts into the binary codec
+    if self_info.get("codec"):
+        prefer_codec(self_info["codec"])
+
     if args.fanout:
         peer_config[self_id]["fanout"] = args.fanout
         print(f"[{self_id}] Overriding fanout to {args.fanout}", flush=True)
@@ -64,9 +79,18 @@ def main():
     ip = self_info["ip"]
     port = self_info["port"]
 
-    # Start socket and listen for incoming messages
-    print(f"[{self_id}] Starting socket server on {ip}:{port}", flush=True)
-    start_socket_server(self_id, ip, port)
+    # Restore the local chain from disk before any block can arrive
+    if args.data_dir:
+        load_chain(args.data_dir, self_id)
+
+    # Start the dispatch worker pool, then the socket to listen for incoming messages
+    print(f"[{self_id}] Starting dispatch workers", flush=True)
+    start_dispatch_workers()
+    print(f"[{self_id}] Starting {args.server} socket server on {ip}:{port}", flush=True)
+    if args.server == "async":
+        start_async_socket_server(self_id, ip, port)
+    else:
+        start_socket_server(self_id, ip, port)
 
     # Peer Discovery
     print(f"[{self_id}] Starting peer discovery", flush=True)
@@ -86,6 +110,10 @@ def main():
         print(f"[{self_id}] Starting transaction and block generation", flush=True)
         transaction_generation(self_id)
         block_generation(self_id, MALICIOUS_MODE)
+        # Batched TXINV announcements of new transactions
+        start_tx_relay(self_id)
+        # Periodic mempool reconciliation with one neighbour (`reconcile_interval` in config.json)
+        start_reconciliation(self_id)
 
     print(f"[{self_id}] Starting broadcast inventory thread", flush=True)
     threading.Thread(target=broadcast_inventory, args=(self_id,), daemon=True).start()
@@ -1,10 +1,14 @@
 import socket
+import select
 import threading
 import time
 import json
 import random
+import heapq
+import itertools
 from collections import defaultdict, deque
 from threading import Lock
+from codec import encode_frame, codec_for, JSON_CODEC
 
 # === Per-peer Rate Limiting ===
 RATE_LIMIT = 100  # max messages
@@ -15,18 +19,49 @@ MAX_RETRIES = 3
 RETRY_INTERVAL = 5  # seconds
 QUEUE_LIMIT = 50
 
+# === Outbox Memory Budget ===
+PEER_QUEUE_BYTES = 1024 * 1024  # queued bytes allowed per target peer
+GLOBAL_QUEUE_BYTES = 8 * 1024 * 1024  # queued bytes allowed across all peers
+SATURATION_RATIO = 0.8  # a peer above this share of its budget is skipped by `gossip_message`
+SUPERSEDABLE = {"PING", "HELLO", "GET_BLOCK_HEADERS"}  # a newer message replaces the queued one to the same peer
+PRIORITY_RANK = {"HIGH": 0, "MEDIUM": 1, "LOW": 2}
+
+# === Send Batching ===
+# A lane coalesces up to BATCH_MAX_MESSAGES / BATCH_MAX_BYTES queued messages into one write.
+# If the most urgent queued message is MEDIUM or LOW, the lane waits up to its flush delay for more to arrive.
+BATCH_MAX_MESSAGES = 32
+BATCH_MAX_BYTES = 64 * 1024
+BATCH_FLUSH_DELAY = {"HIGH": 0, "MEDIUM": 0.02, "LOW": 0.1}  # seconds
+
 # Priority levels
-PRIORITY_HIGH = {"PING", "PONG", "BLOCK", "INV", "GET_BLOCK_HEADERS", "GETBLOCK", "BLOCK_HEADERS"}
-PRIORITY_MEDIUM = {"TX", "HELLO"}
+PRIORITY_HIGH = {"PING", "PONG", "BLOCK", "INV", "GET_BLOCK_HEADERS", "GETBLOCK", "BLOCK_HEADERS", "CMPCTBLOCK", "GETBLOCKTXN", "BLOCKTXN"}
+PRIORITY_MEDIUM = {"TX", "TXS", "TXINV", "GETTX", "RECONCILE", "GETSKETCH", "HELLO", "GETPROOF", "PROOF"}
 PRIORITY_LOW = {"RELAY"}
+TX_TYPES = {"TX", "TXS", "TXINV", "GETTX", "RECONCILE", "GETSKETCH"}  # transaction relay, never sent to lightweight peers
 
 DROP_PROB = 0.05
 LATENCY_MS = (20, 100)
 SEND_RATE_LIMIT = 100  # messages per second
 
+# === Link Emulation ===
+# Conditions of an emulated link. `network.default` and `network.links.<peer_id>` in config.json override them.
+default_link = {
+    "latency_ms": sum(LATENCY_MS) / 2,
+    "jitter_ms": (LATENCY_MS[1] - LATENCY_MS[0]) / 2,
+    "drop_prob": DROP_PROB,
+    "bandwidth_kbps": 0  # 0 means unlimited
+}
+link_conditions = {}  # {(ip, port): conditions}
+delay_links = {}  # {(ip, port): DelayLink}
+
 drop_stats = {
     "BLOCK": 0,
     "TX": 0,
+    "TXS": 0,
+    "TXINV": 0,
+    "GETTX": 0,
+    "RECONCILE": 0,
+    "GETSKETCH": 0,
     "HELLO": 0,
     "PING": 0,
     "PONG": 0,
@@ -34,14 +69,34 @@ drop_stats = {
     "RELAY": 0,
     "GET_BLOCK_HEADERS": 0,
     "GETBLOCK": 0,
-    "BLOCK_HEADERS": 0
+    "BLOCK_HEADERS": 0,
+    "CMPCTBLOCK": 0,
+    "GETBLOCKTXN": 0,
+    "BLOCKTXN": 0,
+    "GETPROOF": 0,
+    "PROOF": 0
 }
+# Why messages were dropped, on top of the per-type counts in `drop_stats`
+drop_reasons = defaultdict(int)
 
-# Queues per peer and priority
+# Queues per peer and priority, items are (ip, port, message, attempt, size)
 queues = defaultdict(lambda: defaultdict(deque))
-retries = defaultdict(int)
+queue_bytes = defaultdict(int)  # {target_id: queued bytes}
+total_queue_bytes = 0
 lock = threading.Lock()
 
+# === Sender Engine State ===
+# A lane thread exists only while its target has traffic: after LANE_IDLE_TIMEOUT seconds with an empty queue it
+# removes itself from `lanes`, and the next `_push` to that target starts a new one.
+LANE_IDLE_TIMEOUT = 30  # seconds
+lanes = {}  # {target_id: threading.Event} wakes the sender thread of each target peer
+sender_self_id = None  # set once `send_from_queue` starts the engine
+sender_stop = threading.Event()  # set by `stop_sender`
+sender_threads = []  # lane and retry timer threads that are still running
+retry_heap = []  # [(due_time, seq, target_id, ip, port, message, attempt)]
+retry_cv = threading.Condition()
+retry_seq = itertools.count()
+
 # === Sending Rate Limiter ===
 class RateLimiter:
     def __init__(self, rate=SEND_RATE_LIMIT):
@@ -51,7 +106,7 @@ class RateLimiter:
         self.last_check = time.time()
         self.lock = Lock()
 
-    def allow(self):
+    def allow(self, n=1):
         with self.lock:
             now = time.time()
             elapsed = now - self.last_check
@@ -59,13 +114,95 @@ class RateLimiter:
             self.tokens = min(self.tokens, self.capacity)
             self.last_check = now
 
-            if self.tokens >= 1:
-                self.tokens -= 1
+            if self.tokens >= n:
+                self.tokens -= n
                 return True
             return False
 
 rate_limiter = RateLimiter()
 
+# === Persistent Connection Pool ===
+CONNECT_TIMEOUT = 3  # seconds
+POOL_IDLE_TIMEOUT = 30  # seconds, must stay below the receiver's CONN_IDLE_TIMEOUT
+
+class ConnectionPool:
+    # Keep one long-lived TCP connection per (ip, port) and reuse it for every message to that peer.
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, connect_timeout=CONNECT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.conns = {}       # {(ip, port): [sock, last_used]}
+        self.key_locks = defaultdict(Lock)  # serialize writes on the same connection
+        self.lock = Lock()
+
+    def send(self, ip, port, data):
+        key = (ip, port)
+        self.evict_idle()
+        with self.key_locks[key]:
+            sock = self._acquire(key)
+            try:
+                sock.sendall(data)
+            except OSError:
+                # The pooled connection went stale, reconnect once and fail over to a fresh socket.
+                self.discard(ip, port)
+                sock = self._acquire(key)
+                try:
+                    sock.sendall(data)
+                except OSError:
+                    self.discard(ip, port)
+                    raise
+            with self.lock:
+                if key in self.conns:
+                    self.conns[key][1] = time.time()
+
+    def _acquire(self, key):
+        # Reuse the pooled connection if the peer has not closed it, otherwise connect lazily.
+        with self.lock:
+            entry = self.conns.get(key)
+        if entry is not None:
+            if self._is_alive(entry[0]):
+                return entry[0]
+            self.discard(*key)
+        sock = socket.create_connection(key, timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.conns[key] = [sock, time.time()]
+        return sock
+
+    @staticmethod
+    def _is_alive(sock):
+        # The receiver never writes back, so a readable socket means EOF or an error.
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return True
+            return sock.recv(1, socket.MSG_PEEK) != b""
+        except (OSError, ValueError):
+            return False
+
+    def discard(self, ip, port):
+        with self.lock:
+            entry = self.conns.pop((ip, port), None)
+        if entry is not None:
+            try:
+                entry[0].close()
+            except OSError:
+                pass
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            idle = [key for key, (_, last_used) in self.conns.items() if now - last_used > self.idle_timeout]
+        for key in idle:
+            self.discard(*key)
+
+    def close_all(self):
+        with self.lock:
+            keys = list(self.conns.keys())
+        for key in keys:
+            self.discard(*key)
+
+connection_pool = ConnectionPool()
+
 def enqueue_message(target_id, ip, port, message):
     from peer_manager import blacklist, rtt_tracker
 
@@ -73,22 +210,98 @@ def enqueue_message(target_id, ip, port, message):
     # Check if the receiver exists in the `blacklist`. If yes, drop the message.
     # Classify the priority of the sending messages based on the message type using the function `classify_priority`.
     # Add the message to the queue (`queues`) if the length of the queue is within the limit `QUEUE_LIMIT`, or otherwise, drop the message.
+    # Return whether the message was queued, so callers can skip saturated peers.
     if is_rate_limited(target_id):
-        return
+        return False
     if target_id in blacklist:
-        return
+        return False
     priority = classify_priority(message)
 
     if message["type"] == "HELLO":
         print(f"🟢 Hello from {target_id}")
 
+    return _push(target_id, ip, port, message, priority)
+
+def _push(target_id, ip, port, message, priority, attempt=0):
+    # Add the message to the queue (`queues`) within the count limit `QUEUE_LIMIT` and the byte budgets, then wake the peer's sender lane.
+    global total_queue_bytes
+    size = message_size(message, codec_for(ip, port))
     with lock:
-        if len(queues[target_id][priority]) < QUEUE_LIMIT:
-            queues[target_id][priority].append((ip, port, message))
-        else:
+        peer_queues = queues[target_id]
+        if message["type"] in SUPERSEDABLE:
+            _remove_superseded(target_id, peer_queues[priority], message["type"])
+        if len(peer_queues[priority]) >= QUEUE_LIMIT:
             print(f"[{target_id}]🈲 Drop due to queue limit")
-            drop_stats[message["type"]] += 1
-            return
+            record_drop(message, "queue_full")
+            _forget_if_empty(target_id)
+            return False
+        # Make room by shedding queued messages of lower priority, the oldest first.
+        while queue_bytes[target_id] + size > PEER_QUEUE_BYTES:
+            if not _shed_lower(target_id, priority):
+                print(f"[{target_id}]🈲 Drop due to peer memory budget")
+                record_drop(message, "peer_bytes")
+                _forget_if_empty(target_id)
+                return False
+        while total_queue_bytes + size > GLOBAL_QUEUE_BYTES:
+            victim = max((pid for pid in queues if _has_lower(pid, priority)), key=lambda pid: queue_bytes[pid], default=None)
+            if victim is None:
+                print(f"[{target_id}]🈲 Drop due to global memory budget")
+                record_drop(message, "global_bytes")
+                _forget_if_empty(target_id)
+                return False
+            _shed_lower(victim, priority)
+        queues[target_id][priority].append((ip, port, message, attempt, size))  # shedding may have reset the entry
+        queue_bytes[target_id] += size
+        total_queue_bytes += size
+    _wake_lane(target_id)
+    return True
+
+def message_size(message, codec=JSON_CODEC):
+    # Wire size of the message's frame in the codec used for its peer, charged to the memory budgets and emulated bandwidth.
+    # The frame is cached and reused when sending.
+    return len(encode_frame(message, codec))
+
+def record_drop(message, reason):
+    drop_stats[message["type"]] = drop_stats.get(message["type"], 0) + 1
+    drop_reasons[reason] += 1
+
+def _take(target_id, dq, index):
+    # Remove a queued item and release its bytes (caller holds `lock`).
+    global total_queue_bytes
+    item = dq[index]
+    del dq[index]
+    queue_bytes[target_id] -= item[4]
+    total_queue_bytes -= item[4]
+    return item
+
+def _remove_superseded(target_id, dq, msg_type):
+    for index in range(len(dq) - 1, -1, -1):
+        if dq[index][2]["type"] == msg_type:
+            record_drop(_take(target_id, dq, index)[2], "superseded")
+
+def _has_lower(target_id, priority):
+    return any(queues[target_id][p] for p in ("LOW", "MEDIUM") if PRIORITY_RANK[p] > PRIORITY_RANK[priority])
+
+def _shed_lower(target_id, priority):
+    # Drop the oldest queued message of the lowest priority below `priority`. Returns False if there is none.
+    for p in ("LOW", "MEDIUM"):
+        if PRIORITY_RANK[p] > PRIORITY_RANK[priority] and queues[target_id][p]:
+            record_drop(_take(target_id, queues[target_id][p], 0)[2], "shed")
+            _forget_if_empty(target_id)
+            return True
+    return False
+
+def _forget_if_empty(target_id):
+    # Do not keep queue entries for every peer ever seen (caller holds `lock`).
+    peer_queues = queues.get(target_id)
+    if peer_queues is not None and not any(peer_queues.values()):
+        del queues[target_id]
+        queue_bytes.pop(target_id, None)
+
+def is_saturated(target_id):
+    # Backpressure signal: the peer's backlog is close to its budget, or the outbox as a whole is.
+    return (queue_bytes.get(target_id, 0) >= SATURATION_RATIO * PEER_QUEUE_BYTES
+            or total_queue_bytes >= SATURATION_RATIO * GLOBAL_QUEUE_BYTES)
 
 def is_rate_limited(peer_id):
     # Check how many messages were sent from the peer to a target peer during the `TIME_WINDOW` that ends now.
@@ -123,54 +336,170 @@ def classify_priority(message):
         return "LOW"
     
 def send_from_queue(self_id):
-    def worker():
-        while True:  # 持续轮询
-            # Read the message in the queue. 
-            # Each time, read one message with the highest priority of a target peer. 
-            # After sending the message, read the message of the next target peer. 
-            # This ensures the fairness of sending messages to different target peers.
-            for target_id in list(queues.keys()):
-                with lock:
-                    if (queues[target_id]["HIGH"] or queues[target_id]["MEDIUM"] or queues[target_id]["LOW"]):
-                        ip, port, message = None, None, None
-                        if queues[target_id]["HIGH"]:
-                            ip, port, message = queues[target_id]["HIGH"].popleft()
-                        elif queues[target_id]["MEDIUM"]:
-                            ip, port, message = queues[target_id]["MEDIUM"].popleft()
-                        elif queues[target_id]["LOW"]:
-                            ip, port, message = queues[target_id]["LOW"].popleft()
-                        else:
-                            continue
-                        retries[target_id] = 0
-                    else:
-                        continue
-                
-                # Send the message using the function `relay_or_direct_send`, 
-                # which will decide whether to send the message to target peer directly or through a relaying peer.
-                success = relay_or_direct_send(self_id, target_id, message)
-
-                # Retry a message if it is sent unsuccessfully and drop the message if the retry times exceed the limit `MAX_RETRIES`.
-                if not success:
-                    if retries[target_id] < MAX_RETRIES:
-                        retries[target_id] += 1
-                        print(f"Retrying: {retries[target_id]}/3")
-                        time.sleep(RETRY_INTERVAL)
-                        enqueue_message(target_id, ip, port, message)
-                    else:
-                        drop_stats[message["type"]] += 1
-                        retries[target_id] = 0
-                else:
-                    retries[target_id] = 0
-            time.sleep(0.01)  # 防止空转占用CPU
-
-    threading.Thread(target=worker, daemon=True).start()
-
-def relay_or_direct_send(self_id, dst_id, message):
+    # Start the sender engine: one lane thread per target peer and one timer thread for retries.
+    # A slow or unreachable peer only stalls its own lane, so delivery to healthy peers keeps going.
+    global sender_self_id
+    sender_stop.clear()
+    sender_self_id = self_id
+    _start_thread(_retry_timer)
+    for target_id in list(queues.keys()):
+        _wake_lane(target_id)
+
+def stop_sender(timeout=2):
+    # Stop the sender engine: wake every lane and the retry timer so they exit, and wait for them.
+    global sender_self_id
+    sender_self_id = None
+    sender_stop.set()
+    with lock:
+        wakes = list(lanes.values())
+    for wake in wakes:
+        wake.set()
+    with retry_cv:
+        retry_cv.notify_all()
+    for thread in list(sender_threads):
+        thread.join(timeout)
+
+def _start_thread(target, *args):
+    def run():
+        try:
+            target(*args)
+        finally:
+            sender_threads.remove(thread)
+    thread = threading.Thread(target=run, daemon=True)
+    sender_threads.append(thread)
+    thread.start()
+
+def _wake_lane(target_id):
+    if sender_self_id is None:
+        return
+    with lock:
+        wake = lanes.get(target_id)
+        if wake is None:
+            wake = lanes[target_id] = threading.Event()
+            _start_thread(_lane_worker, sender_self_id, target_id, wake)
+    wake.set()
+
+def _retire_lane(target_id, wake):
+    # Remove an idle lane; `_push` queues before it wakes a lane, so a lane with nothing queued has nothing to miss.
+    with lock:
+        if not sender_stop.is_set() and (wake.is_set() or target_id in queues):
+            return False
+        if lanes.get(target_id) is wake:
+            del lanes[target_id]
+        return True
+
+def _pop_next(target_id):
+    # Read one message with the highest priority of the target peer.
+    batch = _pop_batch(target_id, max_messages=1)
+    return batch[0] if batch else None
+
+def _pop_batch(target_id, max_messages=None, max_bytes=None):
+    # Read up to `max_messages` / `max_bytes` of the target peer's messages, highest priority first (at least one if any).
+    max_messages = max_messages or BATCH_MAX_MESSAGES
+    max_bytes = max_bytes or BATCH_MAX_BYTES
+    batch, batch_bytes = [], 0
+    with lock:
+        peer_queues = queues.get(target_id)
+        if peer_queues is None:
+            return batch
+        for priority in ("HIGH", "MEDIUM", "LOW"):
+            dq = peer_queues[priority]
+            while dq and len(batch) < max_messages and (not batch or batch_bytes + dq[0][4] <= max_bytes):
+                batch.append(_take(target_id, dq, 0))
+                batch_bytes += batch[-1][4]
+        _forget_if_empty(target_id)
+    return batch
+
+def _head_priority(target_id):
+    # The priority of the most urgent queued message and the queued count, or (None, 0).
+    with lock:
+        peer_queues = queues.get(target_id)
+        if peer_queues is None:
+            return None, 0
+        count = sum(len(dq) for dq in peer_queues.values())
+        for priority in ("HIGH", "MEDIUM", "LOW"):
+            if peer_queues[priority]:
+                return priority, count
+    return None, 0
+
+def _wait_flush_delay(target_id, wake):
+    # Give MEDIUM/LOW messages a short delay to coalesce; a HIGH message or a full batch flushes right away.
+    priority, count = _head_priority(target_id)
+    if priority is None:
+        return
+    deadline = time.time() + BATCH_FLUSH_DELAY[priority]
+    while priority != "HIGH" and count < BATCH_MAX_MESSAGES and time.time() < deadline:
+        wake.wait(deadline - time.time())
+        wake.clear()
+        priority, count = _head_priority(target_id)
+
+def _lane_worker(self_id, target_id, wake):
+    while True:
+        if not wake.wait(LANE_IDLE_TIMEOUT) or sender_stop.is_set():
+            if _retire_lane(target_id, wake):
+                return
+        wake.clear()
+        while not sender_stop.is_set():
+            _wait_flush_delay(target_id, wake)
+            batch = _pop_batch(target_id)
+            if not batch:
+                break
+            messages = [item[2] for item in batch]
+
+            # Send the batch using the function `relay_or_direct_send_batch`,
+            # which will decide whether to send the messages to target peer directly or through a relaying peer.
+            # The emulated link may deliver later, and reports failed messages through `on_failure`.
+            def on_failure(failed, batch=batch):
+                _retry_failed(target_id, batch, failed)
+            try:
+                failed = relay_or_direct_send_batch(self_id, target_id, messages, on_failure)
+            except Exception as e:
+                print(f"🔴 Failed to send {len(messages)} messages to {target_id}: {e}")
+                failed = messages
+
+            if failed:
+                _retry_failed(target_id, batch, failed)
+
+def _retry_failed(target_id, batch, failed):
+    failed_ids = {id(message) for message in failed}
+    for ip, port, message, attempt, _ in batch:
+        if id(message) in failed_ids:
+            _schedule_retry(target_id, ip, port, message, attempt)
+
+def _schedule_retry(target_id, ip, port, message, attempt):
+    # Retry a message if it is sent unsuccessfully and drop the message if the retry times exceed the limit `MAX_RETRIES`.
+    # The retry is parked on `retry_heap` instead of sleeping, so the lane moves on to the next message at once.
+    if attempt >= MAX_RETRIES:
+        record_drop(message, "max_retries")
+        return
+    print(f"Retrying: {attempt + 1}/{MAX_RETRIES}")
+    with retry_cv:
+        heapq.heappush(retry_heap, (time.time() + RETRY_INTERVAL, next(retry_seq), target_id, ip, port, message, attempt + 1))
+        retry_cv.notify()
+
+def _retry_timer():
+    while not sender_stop.is_set():
+        with retry_cv:
+            while not sender_stop.is_set() and (not retry_heap or retry_heap[0][0] > time.time()):
+                retry_cv.wait(retry_heap[0][0] - time.time() if retry_heap else None)
+            if sender_stop.is_set():
+                return
+            _, _, target_id, ip, port, message, attempt = heapq.heappop(retry_heap)
+        _push(target_id, ip, port, message, classify_priority(message), attempt)
+
+def relay_or_direct_send(self_id, dst_id, message, on_failure=None):
+    # Single-message form of `relay_or_direct_send_batch`; `on_failure` receives the message if the emulated link drops it later.
+    return not relay_or_direct_send_batch(self_id, dst_id, [message], on_failure)
+
+def relay_or_direct_send_batch(self_id, dst_id, messages, on_failure=None):
+    # Send messages to one target peer in a single write. Returns the messages that failed right away;
+    # messages that fail later on the emulated link are passed to `on_failure`.
     from peer_discovery import known_peers, peer_flags, reachable_by
     from utils import generate_message_id
 
-    if message["type"] == "HELLO":
-        print(f"🟢 Sending HELLO to {dst_id}")
+    for message in messages:
+        if message["type"] == "HELLO":
+            print(f"🟢 Sending HELLO to {dst_id}")
 
     # Check if the target peer is NATed. 
     nat = peer_flags.get(dst_id, {}).get("nat", False)
@@ -178,26 +507,29 @@ def relay_or_direct_send(self_id, dst_id, message):
     # If the target peer is NATed, use the function `get_relay_peer` to find the best relaying peer. 
     # Define the JSON format of a `RELAY` message, which should include `{message type, sender's ID, target peer's ID, `payload`}`. 
     # `payload` is the sending message. 
-    # Send the `RELAY` message to the best relaying peer using the function `send_message`.
-    if self_id in reachable_by[dst_id]:
-        return send_message(known_peers[dst_id][0], known_peers[dst_id][1], message)
-    if nat:
-        relay_peer = get_relay_peer(self_id, dst_id) # (peer_id, ip, port) or None
-        if relay_peer:
-            relay_msg = {
-                "type": "RELAY",
-                "sender": self_id,
-                "target": dst_id,
-                "payload": message,
-                "message_id": generate_message_id()
-            }
-            return send_message(relay_peer[1], relay_peer[2], relay_msg)
-        else:
-            print(f"🟡 No relay peer found for {dst_id}")
-            return False
-    # If the target peer is non-NATed, send the message to the target peer using the function `send_message`.
-    else:
-        return send_message(known_peers[dst_id][0], known_peers[dst_id][1], message)
+    # Send the `RELAY` messages to the best relaying peer using the function `send_messages`.
+    if self_id in reachable_by[dst_id] or not nat:
+        # If the target peer is reachable or non-NATed, send the messages to the target peer directly.
+        return send_messages(known_peers[dst_id][0], known_peers[dst_id][1], messages, on_failure)
+    relay_peer = get_relay_peer(self_id, dst_id) # (peer_id, ip, port) or None
+    if not relay_peer:
+        print(f"🟡 No relay peer found for {dst_id}")
+        return messages
+    originals = {}
+    relay_msgs = []
+    for message in messages:
+        relay_msg = {
+            "type": "RELAY",
+            "sender": self_id,
+            "target": dst_id,
+            "payload": message,
+            "message_id": generate_message_id()
+        }
+        originals[id(relay_msg)] = message
+        relay_msgs.append(relay_msg)
+    unwrap = lambda failed: [originals[id(relay_msg)] for relay_msg in failed]
+    relay_failure = (lambda failed: on_failure(unwrap(failed))) if on_failure else None
+    return unwrap(send_messages(relay_peer[1], relay_peer[2], relay_msgs, relay_failure))
 
 def get_relay_peer(self_id, dst_id):
     from peer_manager import  rtt_tracker
@@ -213,43 +545,106 @@ def get_relay_peer(self_id, dst_id):
             best_peer = (relay_id, known_peers[relay_id][0], known_peers[relay_id][1])
     return best_peer  # (peer_id, ip, port) or None
 
-# wrapper for send_message，模拟真实网络状况
+def configure_network(config):
+    # Read the `network` section of config.json: `default` conditions and per-destination `links` keyed by peer ID.
+    network = config.get("network", {})
+    default_link.update(network.get("default", {}))
+    for peer_id, conditions in network.get("links", {}).items():
+        peer = config["peers"].get(peer_id)
+        if peer is not None:
+            link_conditions[(peer["ip"], peer["port"])] = dict(default_link, **conditions)
+
+def get_link_conditions(ip, port):
+    return link_conditions.get((ip, port), default_link)
+
+class DelayLink:
+    # A delay queue for one emulated link.
+    # Each message gets its own due time when it is submitted, so latency overlaps across messages instead of adding up.
+    # Due times never go backwards, which keeps the link FIFO like a TCP stream.
+    def __init__(self, send_func):
+        self.send_func = send_func
+        self.pending = deque()  # (due_time, ip, port, messages, on_failure)
+        self.busy_until = 0  # when the link finishes transmitting what is already queued
+        self.last_due = 0
+        self.cv = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, ip, port, messages, conditions, on_failure):
+        now = time.time()
+        with self.cv:
+            bandwidth = conditions["bandwidth_kbps"]
+            start = max(now, self.busy_until)
+            if bandwidth:
+                codec = codec_for(ip, port)
+                start += sum(message_size(message, codec) for message in messages) * 8 / (bandwidth * 1000)
+            self.busy_until = start
+            latency = random.uniform(conditions["latency_ms"] - conditions["jitter_ms"], conditions["latency_ms"] + conditions["jitter_ms"])
+            due = max(start + max(latency, 0) / 1000, self.last_due)
+            self.last_due = due
+            self.pending.append((due, ip, port, messages, on_failure))
+            self.cv.notify()
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self.pending or self.pending[0][0] > time.time():
+                    self.cv.wait(self.pending[0][0] - time.time() if self.pending else None)
+                _, ip, port, messages, on_failure = self.pending.popleft()
+            if not self.send_func(ip, port, messages) and on_failure is not None:
+                on_failure(messages)
+
+# wrapper for send_messages，模拟真实网络状况
 def apply_network_conditions(send_func):
-    def wrapper(ip, port, message):
-
-        # Use the function `rate_limiter.allow` to check if the peer's sending rate is out of limit. 
-        # If yes, drop the message and update the drop states (`drop_stats`).
-        if rate_limiter.allow() == False:
-            drop_stats[message["type"]] += 1
-            return False
-
-        # Generate a random number. If it is smaller than `DROP_PROB`, drop the message to simulate the random message drop in the channel. 
-        # Update the drop states (`drop_stats`).
-        if random.random() < DROP_PROB:
-            drop_stats[message["type"]] += 1
-            return False
-
-        # Add a random latency before sending the message to simulate message transmission delay.
-        # Send the message using the function `send_func`.
-        time.sleep(random.uniform(*LATENCY_MS) / 1000)
-        return send_func(ip, port, message)
+    def wrapper(ip, port, messages, on_failure=None):
+        # Return the messages dropped or failed right away; later delivery failures go to `on_failure`.
+        conditions = get_link_conditions(ip, port)
+        passed, failed = [], []
+        for message in messages:
+            # Use the function `rate_limiter.allow` to check if the peer's sending rate is out of limit. 
+            # If yes, drop the message and update the drop states (`drop_stats`).
+            if rate_limiter.allow() == False:
+                record_drop(message, "rate_limit")
+                failed.append(message)
+
+            # Generate a random number. If it is smaller than the link's `drop_prob`, drop the message to simulate the random message drop in the channel. 
+            # Update the drop states (`drop_stats`).
+            elif random.random() < conditions["drop_prob"]:
+                record_drop(message, "link_drop")
+                failed.append(message)
+            else:
+                passed.append(message)
+        if not passed:
+            return failed
+
+        # Without latency or bandwidth limits, send right away.
+        if not conditions["latency_ms"] and not conditions["jitter_ms"] and not conditions["bandwidth_kbps"]:
+            return failed if send_func(ip, port, passed) else failed + passed
+
+        # Otherwise hand the batch to the link's delay queue, which sends it at its due time.
+        with lock:
+            link = delay_links.get((ip, port))
+            if link is None:
+                link = delay_links[(ip, port)] = DelayLink(send_func)
+        link.submit(ip, port, passed, conditions, on_failure)
+        return failed
 
     return wrapper
 
-def send_message(ip, port, message):
-
-    # Send the message to the target peer. 
-    # Wrap the function `send_message` with the dynamic network condition in the function `apply_network_condition` of `link_simulator.py`.
+def send_messages(ip, port, messages):
+    # Send the messages to the target peer in one write over its pooled connection, encoded with the codec negotiated in HELLO.
+    # The receiver's FrameReader splits the frames again.
+    # Wrap the function `send_messages` with the dynamic network condition in the function `apply_network_condition`.
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((ip, port))
-        sock.sendall((json.dumps(message) + "\n").encode())
-        sock.close()
+        codec = codec_for(ip, port)
+        connection_pool.send(ip, port, b"".join(encode_frame(message, codec) for message in messages))
         return True
     except Exception as e:
-        print(f"🔴 Failed to send message to {ip}:{port}: {e}")
+        print(f"🔴 Failed to send {len(messages)} messages to {ip}:{port}: {e}")
         return False
-send_message = apply_network_conditions(send_message)
+send_messages = apply_network_conditions(send_messages)
+
+def send_message(ip, port, message):
+    return not send_messages(ip, port, [message])
 
 
 def start_dynamic_capacity_adjustment():
@@ -265,23 +660,32 @@ def start_dynamic_capacity_adjustment():
 
 def gossip_message(self_id, message, fanout=3):
 
-    from peer_discovery import known_peers, peer_config, peer_flags
+    from peer_discovery import known_peers
+
+    # Send the message to the selected target peers (`gossip_targets`) and put them in the outbox queue.
+    for peer in gossip_targets(self_id, message["type"], fanout):
+        enqueue_message(peer, known_peers[peer][0], known_peers[peer][1], message)
+
+def gossip_targets(self_id, msg_type, fanout=3):
+
+    from peer_discovery import peer_config, peer_flags
 
     # Read the configuration `fanout` of the peer in `peer_config` of `peer_discovery.py`.
     # Randomly select the number of target peer from `known_peers`, which is equal to `fanout`. If the gossip message is a transaction, skip the lightweight peers in the `know_peers`.
-    # Send the message to the selected target peer and put them in the outbox queue.
+    # Skip peers whose outbox backlog is saturated (`is_saturated`) and pick others instead.
     selected_peers = set()
     for peer in peer_config:
         if peer == self_id:
             continue
         light = peer_flags[peer].get("light", False)
-        if light and message["type"] == "TX":
+        if light and msg_type in TX_TYPES:
+            continue
+        if is_saturated(peer):
             continue
         selected_peers.add(peer)
         if len(selected_peers) == fanout:
             break
-    for peer in selected_peers:
-        enqueue_message(peer, known_peers[peer][0], known_peers[peer][1], message)
+    return selected_peers
 
 def get_outbox_status():
     # Return the message in the outbox queue.
@@ -289,5 +693,5 @@ def get_outbox_status():
 
 
 def get_drop_stats():
-    # Return the drop states (`drop_stats`).
-    return drop_stats
\ No newline at end of file
+    # Return the drop states (`drop_stats`), with the drop reasons and the outbox memory use.
+    return dict(drop_stats, reasons=dict(drop_reasons), queued_bytes=total_queue_bytes)
\ No newline at end of file
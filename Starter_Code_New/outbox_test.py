@@ -1 +1,301 @@
-# TODO: unit test for outbox.py
\ No newline at end of file
+import unittest
+import socket
+import threading
+import json
+import time
+from unittest.mock import patch
+
+import outbox
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        # 本地监听一个端口，记录收到的连接数和消息
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.accepted = []
+        self.lines = []
+        self.received = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+        self.pool = outbox.ConnectionPool(idle_timeout=30)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.close()
+        for conn in self.accepted:
+            conn.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.accepted.append(conn)
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        for line in conn.makefile():
+            self.lines.append(json.loads(line))
+            self.received.set()
+
+    def _wait_for(self, count):
+        for _ in range(50):
+            if len(self.lines) >= count:
+                return
+            self.received.wait(0.1)
+            self.received.clear()
+
+    def test_reuses_connection(self):
+        for i in range(5):
+            self.pool.send("127.0.0.1", self.port, (json.dumps({"n": i}) + "\n").encode())
+        self._wait_for(5)
+        self.assertEqual([m["n"] for m in self.lines], [0, 1, 2, 3, 4])
+        self.assertEqual(len(self.accepted), 1)
+
+    def test_reconnects_after_peer_close(self):
+        self.pool.send("127.0.0.1", self.port, b'{"n": 0}\n')
+        self._wait_for(1)
+        self.accepted[0].shutdown(socket.SHUT_RDWR)
+        self.accepted[0].close()
+        self.pool.send("127.0.0.1", self.port, b'{"n": 1}\n')
+        self._wait_for(2)
+        self.assertEqual([m["n"] for m in self.lines], [0, 1])
+        self.assertEqual(len(self.accepted), 2)
+
+    def test_evict_idle(self):
+        self.pool.send("127.0.0.1", self.port, b'{"n": 0}\n')
+        self.pool.idle_timeout = -1
+        self.pool.evict_idle()
+        self.assertEqual(self.pool.conns, {})
+
+    def test_send_to_closed_port_raises(self):
+        self.server.close()
+        with self.assertRaises(OSError):
+            self.pool.send("127.0.0.1", self.port, b'{"n": 0}\n')
+        self.assertEqual(self.pool.conns, {})
+
+class TestSenderEngine(unittest.TestCase):
+    def setUp(self):
+        outbox.queues.clear()
+        outbox.retry_heap.clear()
+        outbox.drop_stats["PING"] = 0
+        self.sent = []
+        # 每个用例使用独立的lane表，且默认不启动发送线程
+        for patcher in (patch.dict(outbox.lanes, clear=True), patch.object(outbox, "sender_self_id", None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        # 停掉本用例启动的lane线程和重试定时线程
+        outbox.stop_sender()
+        self.assertEqual(outbox.sender_threads, [])
+        outbox.retry_heap.clear()
+
+    def _start(self):
+        outbox.send_from_queue("self")
+
+    def _wait(self, predicate, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not predicate():
+            time.sleep(0.01)
+        return predicate()
+
+    def test_unreachable_peer_does_not_block_others(self):
+        def fake_send(self_id, target_id, messages, on_failure=None):
+            if target_id == "slow":
+                time.sleep(1)
+                return messages
+            self.sent += [(target_id, message["n"]) for message in messages]
+            return []
+        with patch("outbox.relay_or_direct_send_batch", side_effect=fake_send):
+            self._start()
+            outbox._push("slow", "10.0.0.1", 1, {"type": "PING", "n": 0}, "HIGH")
+            for i in range(5):
+                outbox._push("fast", "10.0.0.2", 2, {"type": "BLOCK", "n": i}, "HIGH")
+            self.assertTrue(self._wait(lambda: len(self.sent) == 5, timeout=0.5))
+        self.assertEqual(self.sent, [("fast", i) for i in range(5)])
+
+    def test_priority_order(self):
+        for msg_type, priority in (("RELAY", "LOW"), ("TX", "MEDIUM"), ("PING", "HIGH")):
+            outbox._push("peer", "10.0.0.1", 1, {"type": msg_type}, priority)
+        order = [outbox._pop_next("peer")[2]["type"] for _ in range(3)]
+        self.assertEqual(order, ["PING", "TX", "RELAY"])
+        self.assertIsNone(outbox._pop_next("peer"))
+
+    def test_failed_send_is_scheduled_not_slept(self):
+        with patch("outbox.relay_or_direct_send_batch", side_effect=lambda self_id, target_id, messages, on_failure: messages):
+            self._start()
+            start = time.time()
+            outbox._push("down", "10.0.0.1", 1, {"type": "PING"}, "HIGH")
+            self.assertTrue(self._wait(lambda: len(outbox.retry_heap) == 1, timeout=0.5))
+        self.assertLess(time.time() - start, outbox.RETRY_INTERVAL)
+        due, _, target_id, _, _, _, attempt = outbox.retry_heap[0]
+        self.assertEqual((target_id, attempt), ("down", 1))
+        self.assertGreater(due, time.time())
+
+    def test_batches_per_peer(self):
+        batches = []
+        def fake_send(self_id, target_id, messages, on_failure=None):
+            batches.append([message["n"] for message in messages])
+            return []
+        for i in range(5):
+            outbox._push("peer", "10.0.0.1", 1, {"type": "TX", "n": i}, "MEDIUM")
+        outbox._push("peer", "10.0.0.1", 1, {"type": "INV", "n": 5}, "HIGH")
+        with patch("outbox.relay_or_direct_send_batch", side_effect=fake_send):
+            self._start()
+            self.assertTrue(self._wait(lambda: sum(map(len, batches)) == 6, timeout=1))
+        # 高优先级在前，且一次写出
+        self.assertEqual(batches, [[5, 0, 1, 2, 3, 4]])
+
+    def test_pop_batch_limits(self):
+        for i in range(5):
+            outbox._push("peer", "10.0.0.1", 1, {"type": "TX", "n": i}, "MEDIUM")
+        self.assertEqual(len(outbox._pop_batch("peer", max_messages=3)), 3)
+        size = outbox.message_size({"type": "TX", "n": 0})
+        self.assertEqual(len(outbox._pop_batch("peer", max_bytes=size)), 1)
+        self.assertEqual(len(outbox._pop_batch("peer", max_bytes=1)), 1)  # 至少取一条
+        self.assertEqual(outbox._pop_batch("peer"), [])
+
+    def test_partial_batch_failure_retries_only_failed(self):
+        first, second = {"type": "TX", "n": 0}, {"type": "TX", "n": 1}
+        batch = [("10.0.0.1", 1, first, 0, 10), ("10.0.0.1", 1, second, 2, 10)]
+        outbox._retry_failed("peer", batch, [second])
+        self.assertEqual([(entry[5]["n"], entry[6]) for entry in outbox.retry_heap], [(1, 3)])
+
+    def test_drop_after_max_retries(self):
+        outbox._schedule_retry("down", "10.0.0.1", 1, {"type": "PING"}, outbox.MAX_RETRIES)
+        self.assertEqual(outbox.retry_heap, [])
+        self.assertEqual(outbox.drop_stats["PING"], 1)
+
+    def test_idle_lane_is_retired(self):
+        with patch("outbox.relay_or_direct_send_batch", return_value=[]), patch("outbox.LANE_IDLE_TIMEOUT", 0.05):
+            self._start()
+            outbox._push("peer", "10.0.0.1", 1, {"type": "PING"}, "HIGH")
+            self.assertTrue(self._wait(lambda: "peer" not in outbox.lanes, timeout=1))
+            self.assertEqual(len(outbox.sender_threads), 1)  # 只剩重试定时线程
+            # 有新消息时重新建立lane
+            outbox._push("peer", "10.0.0.1", 1, {"type": "PING"}, "HIGH")
+            self.assertIn("peer", outbox.lanes)
+
+    def test_single_send_passes_on_failure(self):
+        on_failure = lambda messages: None
+        with patch("outbox.relay_or_direct_send_batch", return_value=[]) as mock_batch:
+            self.assertTrue(outbox.relay_or_direct_send("self", "peer", {"type": "PING"}, on_failure))
+        mock_batch.assert_called_once_with("self", "peer", [{"type": "PING"}], on_failure)
+
+class TestOutboxBudget(unittest.TestCase):
+    def setUp(self):
+        outbox.queues.clear()
+        outbox.queue_bytes.clear()
+        outbox.total_queue_bytes = 0
+        outbox.drop_reasons.clear()
+        patcher = patch.object(outbox, "sender_self_id", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _msg(self, msg_type, size):
+        return {"type": msg_type, "data": "x" * size}
+
+    def test_bytes_accounted_and_released(self):
+        msg = self._msg("TX", 100)
+        outbox._push("peer", "10.0.0.1", 1, msg, "MEDIUM")
+        self.assertEqual(outbox.queue_bytes["peer"], outbox.message_size(msg))
+        self.assertEqual(outbox.total_queue_bytes, outbox.message_size(msg))
+        outbox._pop_next("peer")
+        self.assertEqual(outbox.total_queue_bytes, 0)
+        self.assertNotIn("peer", outbox.queues)
+
+    def test_bytes_charged_in_peer_codec(self):
+        import codec
+        msg = {"type": "BLOCK_HEADERS", "headers": [{"block_id": "ab" * 32, "previous_block_id": "cd" * 32}] * 20}
+        with patch.dict(codec.peer_codecs, {("10.0.0.2", 1): codec.BINARY_CODEC}):
+            outbox._push("json-peer", "10.0.0.1", 1, msg, "HIGH")
+            outbox._push("bin-peer", "10.0.0.2", 1, msg, "HIGH")
+        self.assertEqual(outbox.queue_bytes["json-peer"], len(codec.encode_frame(msg)))
+        self.assertEqual(outbox.queue_bytes["bin-peer"], len(codec.encode_frame(msg, codec.BINARY_CODEC)))
+        self.assertLess(outbox.queue_bytes["bin-peer"], outbox.queue_bytes["json-peer"] / 2)
+
+    def test_sheds_lower_priority_for_high(self):
+        with patch.object(outbox, "PEER_QUEUE_BYTES", 1000):
+            outbox._push("peer", "10.0.0.1", 1, self._msg("RELAY", 400), "LOW")
+            outbox._push("peer", "10.0.0.1", 1, self._msg("TX", 400), "MEDIUM")
+            self.assertTrue(outbox._push("peer", "10.0.0.1", 1, self._msg("BLOCK", 400), "HIGH"))
+            self.assertEqual(len(outbox.queues["peer"]["LOW"]), 0)
+            self.assertEqual(len(outbox.queues["peer"]["MEDIUM"]), 1)
+            # 没有更低优先级可丢弃时，丢弃新消息
+            self.assertFalse(outbox._push("peer", "10.0.0.1", 1, self._msg("TX", 400), "MEDIUM"))
+        self.assertEqual(outbox.drop_reasons["shed"], 1)
+        self.assertEqual(outbox.drop_reasons["peer_bytes"], 1)
+
+    def test_global_budget_sheds_largest_backlog(self):
+        with patch.object(outbox, "GLOBAL_QUEUE_BYTES", 1000):
+            outbox._push("a", "10.0.0.1", 1, self._msg("TX", 300), "MEDIUM")
+            outbox._push("b", "10.0.0.2", 2, self._msg("TX", 500), "MEDIUM")
+            self.assertTrue(outbox._push("c", "10.0.0.3", 3, self._msg("BLOCK", 400), "HIGH"))
+        self.assertNotIn("b", outbox.queues)
+        self.assertIn("a", outbox.queues)
+        self.assertLessEqual(outbox.total_queue_bytes, 1000)
+
+    def test_superseded_ping(self):
+        outbox._push("peer", "10.0.0.1", 1, {"type": "PING", "timestamp": 1}, "HIGH")
+        outbox._push("peer", "10.0.0.1", 1, {"type": "PING", "timestamp": 2}, "HIGH")
+        self.assertEqual([item[2]["timestamp"] for item in outbox.queues["peer"]["HIGH"]], [2])
+        self.assertEqual(outbox.drop_reasons["superseded"], 1)
+
+    def test_gossip_skips_saturated_peers(self):
+        with patch.dict("peer_discovery.peer_config", {"a": {}, "b": {}, "c": {}}, clear=True), \
+             patch.dict("peer_discovery.peer_flags", {"a": {}, "b": {}, "c": {}}, clear=True), \
+             patch.dict("peer_discovery.known_peers", {"a": ("10.0.0.1", 1), "b": ("10.0.0.2", 2), "c": ("10.0.0.3", 3)}, clear=True), \
+             patch("outbox.enqueue_message") as mock_enqueue:
+            outbox.queue_bytes["a"] = outbox.PEER_QUEUE_BYTES
+            outbox.gossip_message("self", {"type": "TX"}, fanout=2)
+        self.assertEqual({call[0][0] for call in mock_enqueue.call_args_list}, {"b", "c"})
+
+class TestLinkEmulation(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.conditions = {"latency_ms": 100, "jitter_ms": 0, "drop_prob": 0, "bandwidth_kbps": 0}
+
+    def _send(self, ip, port, messages):
+        self.delivered += [(time.time(), message["n"]) for message in messages]
+        return all(message["n"] >= 0 for message in messages)
+
+    def test_latency_overlaps_across_messages(self):
+        link = outbox.DelayLink(self._send)
+        start = time.time()
+        for i in range(50):
+            link.submit("10.0.0.1", 1, [{"type": "TX", "n": i}], self.conditions, None)
+        deadline = time.time() + 2
+        while len(self.delivered) < 50 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([n for _, n in self.delivered], list(range(50)))
+        # 50条消息总共只等待一个延迟，而不是50个
+        self.assertLess(self.delivered[-1][0] - start, 1)
+        self.assertGreaterEqual(self.delivered[0][0] - start, 0.09)
+
+    def test_failed_delivery_calls_on_failure(self):
+        failed = []
+        done = threading.Event()
+        def on_failure(messages):
+            failed.extend(messages)
+            done.set()
+        link = outbox.DelayLink(self._send)
+        link.submit("10.0.0.1", 1, [{"type": "TX", "n": -1}], self.conditions, on_failure)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(failed, [{"type": "TX", "n": -1}])
+
+    def test_configure_network(self):
+        config = {
+            "peers": {"5001": {"ip": "10.0.0.1", "port": 5001}},
+            "network": {"default": {"drop_prob": 0.5}, "links": {"5001": {"latency_ms": 5}}}
+        }
+        with patch.dict(outbox.default_link), patch.dict(outbox.link_conditions, clear=True):
+            outbox.configure_network(config)
+            link = outbox.get_link_conditions("10.0.0.1", 5001)
+            self.assertEqual((link["latency_ms"], link["drop_prob"]), (5, 0.5))
+            self.assertEqual(outbox.get_link_conditions("10.0.0.2", 5002)["drop_prob"], 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
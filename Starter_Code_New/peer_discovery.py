@@ -1,5 +1,6 @@
 import json, time, threading
 from utils import generate_message_id
+from codec import SUPPORTED_CODECS, JSON_CODEC, set_peer_codec
 
 
 known_peers = {}        # { peer_id: (ip, port) }
@@ -26,7 +27,8 @@ def start_peer_discovery(self_id, self_info):
             "port": self_port,
             "flags": {
                 "nat": nat_status,
-                "light": light_status
+                "light": light_status,
+                "codecs": SUPPORTED_CODECS
             },
             "localnetworkid": localnetworkid,
             "message_id": generate_message_id()
@@ -77,6 +79,7 @@ def handle_hello_message(msg, self_id):
     sender_ip = msg["ip"]
     sender_port = msg["port"]
     sender_nat, sender_light = msg["flags"]["nat"], msg["flags"]["light"]
+    sender_codecs = msg["flags"].get("codecs", [JSON_CODEC])  # old peers only speak newline JSON
 
     # If the sender is unknown, add it to the list of known peers (`known_peer`) and record their flags (`peer_flags`).
     if sender_id not in known_peers:
@@ -86,6 +89,10 @@ def handle_hello_message(msg, self_id):
             "light": sender_light
         }
         new_peers.append(sender_id)
+    peer_flags.setdefault(sender_id, {})["codecs"] = sender_codecs
+
+    # Use the most compact wire codec both sides support from now on.
+    set_peer_codec(sender_ip, sender_port, sender_codecs)
 
     # Update the set of reachable peers (`reachable_by`).
     if sender_id not in reachable_by[self_id]:
@@ -0,0 +1,195 @@
+import time
+import random
+import hashlib
+import threading
+from utils import generate_message_id
+from peer_discovery import known_peers, peer_config
+from outbox import enqueue_message, gossip_targets
+from transaction import tx_pool, create_txinv, handle_txinv, relay_lock, mark_known_txs, MAX_TXINV_IDS
+
+# === Mempool reconciliation ===
+# Every `reconcile_interval` seconds (per peer in config.json) a node sends one neighbour a RECONCILE message carrying
+# an invertible Bloom lookup table (IBLT) of its pool's tx_ids. The neighbour subtracts a sketch of its own pool and
+# peels the difference out of it: IDs only the sender has are fetched with GETTX, IDs only the neighbour has are
+# announced back with TXINV, so both sides end up with the union through the normal relay path.
+# A sketch needs about 1.5 cells per differing ID whatever the pool size, so bandwidth follows the difference.
+# If the sketch is too small to decode, the neighbour asks for a bigger one with GETSKETCH (doubling up to
+# MAX_SKETCH_CELLS); past that it simply announces its whole pool.
+RECONCILE_INTERVAL = 30  # seconds, default when the peer has no `reconcile_interval` in config.json
+SKETCH_HASHES = 3        # cells each tx_id is added to, one per sub-table
+MIN_SKETCH_CELLS = 30
+MAX_SKETCH_CELLS = 3000
+CELLS_PER_DIFF = 1.5     # cells needed per differing tx_id for the peeling to succeed with high probability
+
+sketch_sizes = {}  # {peer_id: cells of the last sketch the peer asked for}
+sketch_lock = threading.Lock()
+
+def _digest(tx_id):
+    # 一次哈希同时得到各子表的位置和校验值
+    return hashlib.sha256(b"iblt" + tx_id.encode()).digest()
+
+class IBLT:
+    # Cells of [count, XOR of keys, XOR of check values]; keys are 256-bit tx_ids held as ints.
+    # The table is split into SKETCH_HASHES sub-tables so a key never lands twice in the same cell.
+    def __init__(self, cells):
+        self.width = max(1, -(-cells // SKETCH_HASHES))
+        self.cells = [[0, 0, 0] for _ in range(self.width * SKETCH_HASHES)]
+
+    def _positions(self, digest):
+        return [j * self.width + int.from_bytes(digest[4 * j:4 * j + 4], "big") % self.width for j in range(SKETCH_HASHES)]
+
+    def _toggle(self, key, digest, sign):
+        check = int.from_bytes(digest[-4:], "big")
+        for i in self._positions(digest):
+            cell = self.cells[i]
+            cell[0] += sign
+            cell[1] ^= key
+            cell[2] ^= check
+
+    def add(self, tx_id):
+        self._toggle(int(tx_id, 16), _digest(tx_id), 1)
+
+    def subtract(self, other):
+        # 逐格相减，结果只剩两边的差集
+        if len(other.cells) != len(self.cells):
+            raise ValueError("Sketches of different sizes")
+        for cell, theirs in zip(self.cells, other.cells):
+            cell[0] -= theirs[0]
+            cell[1] ^= theirs[1]
+            cell[2] ^= theirs[2]
+
+    def decode(self):
+        # 剥离纯格子（count为±1且校验值匹配）；返回 (是否完全解开, count为+1的ID, count为-1的ID)
+        ours, theirs = [], []
+        pure = [i for i in range(len(self.cells)) if self._is_pure(self.cells[i])]
+        while pure:
+            cell = self.cells[pure.pop()]
+            if not self._is_pure(cell):
+                continue
+            sign, key = cell[0], cell[1]
+            tx_id = f"{key:064x}"
+            (ours if sign == 1 else theirs).append(tx_id)
+            digest = _digest(tx_id)
+            self._toggle(key, digest, -sign)
+            pure += [i for i in self._positions(digest) if self._is_pure(self.cells[i])]
+        return all(cell == [0, 0, 0] for cell in self.cells), ours, theirs
+
+    @staticmethod
+    def _is_pure(cell):
+        if cell[0] not in (1, -1) or cell[1] >> 256:
+            return False
+        return int.from_bytes(_digest(f"{cell[1]:064x}")[-4:], "big") == cell[2]
+
+    def to_list(self):
+        return [[count, f"{key:064x}", check] for count, key, check in self.cells]
+
+    @classmethod
+    def from_list(cls, cells):
+        # 解析对方发来的格子；格式或大小不对时抛出ValueError
+        sketch = cls(len(cells))
+        if len(sketch.cells) != len(cells) or len(cells) > MAX_SKETCH_CELLS + SKETCH_HASHES:
+            raise ValueError("Sketch size is not a multiple of the hash count")
+        sketch.cells = [[int(count), int(key, 16), int(check)] for count, key, check in cells]
+        return sketch
+
+def pool_sketch(cells):
+    sketch = IBLT(cells)
+    for tx_id in list(tx_pool.entries):
+        sketch.add(tx_id)
+    return sketch
+
+def create_reconcile(sender_id, cells):
+    # 构建RECONCILE消息：本地交易池的IBLT和交易数
+    return {
+        "type": "RECONCILE",
+        "sender": sender_id,
+        "cells": pool_sketch(cells).to_list(),
+        "count": len(tx_pool),
+        "message_id": generate_message_id()
+    }
+
+def create_getsketch(sender_id, cells):
+    # 构建GETSKETCH消息，请求指定大小的RECONCILE
+    return {
+        "type": "GETSKETCH",
+        "sender": sender_id,
+        "size": cells,
+        "message_id": generate_message_id()
+    }
+
+def _sketch_size(diff):
+    return max(MIN_SKETCH_CELLS, int(diff * CELLS_PER_DIFF) + SKETCH_HASHES)
+
+def _announce_all(peer_id, self_id):
+    # 差集太大无法用草图解出，直接公告整个交易池
+    tx_ids = list(tx_pool.entries)
+    with relay_lock:
+        mark_known_txs(peer_id, tx_ids)
+    return [create_txinv(tx_ids[i:i + MAX_TXINV_IDS], self_id) for i in range(0, len(tx_ids), MAX_TXINV_IDS)]
+
+def handle_reconcile(msg, self_id):
+    # 与对方的草图求差并解码；返回要发回给对方的消息（GETTX / TXINV / GETSKETCH）
+    sender = msg["sender"]
+    try:
+        theirs = IBLT.from_list(msg.get("cells", []))
+        count = int(msg.get("count", 0))
+    except (TypeError, ValueError):
+        return []
+    cells = len(theirs.cells)
+    # 两边交易数之差是差集大小的下界，草图明显不够大时不必尝试解码
+    if cells < _sketch_size(abs(count - len(tx_pool))):
+        wanted = _sketch_size(abs(count - len(tx_pool)))
+    else:
+        diff = theirs
+        diff.subtract(pool_sketch(cells))
+        complete, only_theirs, only_ours = diff.decode()
+        if complete:
+            replies = []
+            gettx_msg = handle_txinv(create_txinv(only_theirs, sender), self_id)
+            if gettx_msg:
+                replies.append(gettx_msg)
+            only_ours = [tx_id for tx_id in only_ours if tx_id in tx_pool]
+            if only_ours:
+                with relay_lock:
+                    mark_known_txs(sender, only_ours)
+                replies.append(create_txinv(only_ours, self_id))
+            print(f"[{self_id}] Reconciled with {sender}: {len(only_theirs)} to fetch, {len(only_ours)} to announce")
+            return replies
+        wanted = cells * 2
+    if wanted > MAX_SKETCH_CELLS:
+        return _announce_all(sender, self_id)
+    return [create_getsketch(self_id, wanted)]
+
+def handle_getsketch(msg, self_id):
+    # 对方需要更大的草图：记住这个大小供下一轮使用
+    try:
+        cells = min(max(int(msg.get("size", 0)), MIN_SKETCH_CELLS), MAX_SKETCH_CELLS)
+    except (TypeError, ValueError):
+        return None
+    with sketch_lock:
+        sketch_sizes[msg["sender"]] = cells
+    return create_reconcile(self_id, cells)
+
+def reconcile_with(peer_id, self_id):
+    # 每轮用完后把草图大小减半，差集变小后带宽随之回落；不够时对方会再用GETSKETCH要更大的
+    with sketch_lock:
+        cells = sketch_sizes.get(peer_id, MIN_SKETCH_CELLS)
+        sketch_sizes[peer_id] = max(MIN_SKETCH_CELLS, cells // 2)
+    enqueue_message(peer_id, known_peers[peer_id][0], known_peers[peer_id][1], create_reconcile(self_id, cells))
+
+def start_reconciliation(self_id):
+    # 按本节点配置的间隔，每轮随机挑一个全节点邻居对账
+    interval = peer_config.get(self_id, {}).get("reconcile_interval", RECONCILE_INTERVAL)
+    if not interval:
+        return
+    def loop():
+        while True:
+            time.sleep(interval)
+            peers = [peer for peer in gossip_targets(self_id, "RECONCILE", fanout=len(peer_config)) if peer in known_peers]
+            if not peers:
+                continue
+            try:
+                reconcile_with(random.choice(peers), self_id)
+            except Exception as e:
+                print(f"[{self_id}] Error reconciling the mempool: {e}")
+    threading.Thread(target=loop, daemon=True).start()
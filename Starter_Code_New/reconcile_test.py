@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import patch
+
+import reconcile
+import transaction
+from reconcile import IBLT
+from transaction import TransactionMessage, add_transaction, clear_pool
+
+def make_txs(count, start=0):
+    return [TransactionMessage("peerA", "peerB", i, 1700000000.0 + i) for i in range(start, start + count)]
+
+class TestIBLT(unittest.TestCase):
+    def test_decode_symmetric_difference(self):
+        shared, ours, theirs = make_txs(500), make_txs(10, 1000), make_txs(7, 2000)
+        a, b = IBLT(60), IBLT(60)
+        for tx in shared + ours:
+            a.add(tx.id)
+        for tx in shared + theirs:
+            b.add(tx.id)
+        diff = IBLT.from_list(a.to_list())
+        diff.subtract(b)
+        complete, only_a, only_b = diff.decode()
+        self.assertTrue(complete)
+        self.assertEqual(set(only_a), {tx.id for tx in ours})
+        self.assertEqual(set(only_b), {tx.id for tx in theirs})
+
+    def test_too_small_sketch_does_not_decode(self):
+        a, b = IBLT(30), IBLT(30)
+        for tx in make_txs(200):
+            a.add(tx.id)
+        a.subtract(b)
+        complete, _, _ = a.decode()
+        self.assertFalse(complete)
+
+    def test_rejects_malformed_cells(self):
+        with self.assertRaises(ValueError):
+            IBLT.from_list([[0, "00", 0]] * 4)
+        with self.assertRaises(ValueError):
+            IBLT.from_list([[0, "zz", 0]] * 3)
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        clear_pool()
+        transaction.peer_known_txs.clear()
+        transaction.tx_requests.clear()
+        reconcile.sketch_sizes.clear()
+        self.addCleanup(clear_pool)
+
+    def test_exchange_only_the_difference(self):
+        shared, ours, theirs = make_txs(300), make_txs(5, 1000), make_txs(4, 2000)
+        for tx in shared + theirs:
+            add_transaction(tx)
+        theirs_msg = reconcile.create_reconcile("peerB", 30)
+        self.assertEqual(theirs_msg["count"], 304)
+        clear_pool()
+        for tx in shared + ours:
+            add_transaction(tx)
+        replies = reconcile.handle_reconcile(theirs_msg, "self")
+        by_type = {msg["type"]: msg for msg in replies}
+        self.assertEqual(set(by_type["GETTX"]["tx_ids"]), {tx.id for tx in theirs})
+        self.assertEqual(set(by_type["TXINV"]["tx_ids"]), {tx.id for tx in ours})
+        # 草图大小与差集有关，与交易池大小无关
+        self.assertEqual(len(theirs_msg["cells"]), 30)
+
+    def test_small_sketch_asks_for_bigger_one(self):
+        for tx in make_txs(60):
+            add_transaction(tx)
+        msg = dict(reconcile.create_reconcile("peerB", 30), count=60)
+        clear_pool()
+        for tx in make_txs(60, 1000):
+            add_transaction(tx)
+        replies = reconcile.handle_reconcile(msg, "self")
+        self.assertEqual([reply["type"] for reply in replies], ["GETSKETCH"])
+        self.assertEqual(replies[0]["size"], 60)
+        bigger = reconcile.handle_getsketch(dict(replies[0], sender="peerB"), "self")
+        self.assertEqual(len(bigger["cells"]), 60)
+        self.assertEqual(reconcile.sketch_sizes["peerB"], 60)
+        # 交易数相差太大时直接公告整个交易池
+        replies = reconcile.handle_reconcile(dict(msg, count=10000), "self")
+        self.assertEqual([reply["type"] for reply in replies], ["TXINV"])
+        self.assertEqual(len(replies[0]["tx_ids"]), 60)
+
+    def test_interval_from_config(self):
+        with patch.dict("reconcile.peer_config", {"self": {"reconcile_interval": 0}}, clear=True), \
+             patch("reconcile.threading.Thread") as mock_thread:
+            reconcile.start_reconciliation("self")
+        mock_thread.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
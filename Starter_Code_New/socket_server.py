@@ -1,13 +1,46 @@
 import socket
 import threading
 import time
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from message_handler import dispatch_message
+from codec import FrameReader, FrameTooLarge
 
-RECV_BUFFER = 4096
+RECV_BUFFER = 64 * 1024  # initial size of each connection's receive buffer
+CONN_IDLE_TIMEOUT = 60  # seconds, senders keep pooled connections open between messages
+
+# === Asyncio server mode ===
+ASYNC_BACKLOG = 1024
+ASYNC_DISPATCH_WORKERS = 32
 
 def start_socket_server(self_id, self_ip, port):
 
+    def handle_connection(conn, addr):
+        # Read messages until the sender closes its (pooled) connection or it stays idle too long.
+        # Each message is either a JSON line or a binary frame, see `codec.py`.
+        conn.settimeout(CONN_IDLE_TIMEOUT)  # 防止死等
+        frames = FrameReader(RECV_BUFFER)
+        with conn:  # 使用with确保连接正确关闭
+            try:
+                while frames.recv_from(conn):
+                    while True:
+                        try:
+                            msg_dict = frames.next_message()
+                        except FrameTooLarge:
+                            raise
+                        except ValueError as e:
+                            print(f"从{addr}接收到无效数据: {e}")
+                            continue
+                        if msg_dict is None:
+                            break
+                        dispatch_message(msg_dict, self_id, self_ip)
+            except socket.timeout:
+                pass
+            except FrameTooLarge as e:
+                print(f"❌ Closing connection from {addr}: {e}")
+            except Exception as e:
+                print(f"❌ Error receiving message: {e} in peer {self_id} at {self_ip}:{port}")
+
     def listen_loop():
         # Create a TCP socket and bind it to the peer’s IP address and port.
         peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -16,25 +49,11 @@ def start_socket_server(self_id, self_ip, port):
         peer_socket.listen()
         print(f"Listening on {self_ip}:{port}")
         # When receiving messages, pass the messages to the function `dispatch_message` in `message_handler.py`.
+        # Each connection is long-lived, so read it on its own thread instead of blocking the accept loop.
         while True:
             try:
                 conn, addr = peer_socket.accept()
-                conn.settimeout(10)  # 防止死等
-                with conn:  # 使用with确保连接正确关闭
-                    try:
-                        # 用文件对象逐行读取
-                        f = conn.makefile()
-                        for line in f:
-                            line = line.strip()
-                            if not line:
-                                continue
-                            try:
-                                msg_dict = json.loads(line)
-                                dispatch_message(msg_dict, self_id, self_ip)
-                            except json.JSONDecodeError:
-                                print(f"从{addr}接收到无效JSON数据: {line}")
-                    except Exception as e:
-                        print(f"❌ Error receiving message: {e} in peer {self_id} at {self_ip}:{port}")
+                threading.Thread(target=handle_connection, args=(conn, addr), daemon=True).start()
             except Exception as e:
                 print(f"🔻 Error accepting connection: {e} in peer {self_id} at {self_ip}:{port}")
                 continue
@@ -42,3 +61,60 @@ def start_socket_server(self_id, self_ip, port):
     # ✅ Run listener in background
     threading.Thread(target=listen_loop, daemon=True).start()
 
+def start_async_socket_server(self_id, self_ip, port):
+    # Serve every inbound connection as its own coroutine on one event loop.
+    # Handlers run on a thread pool, so a slow handler only delays messages of the connection it came from.
+    dispatch_executor = ThreadPoolExecutor(max_workers=ASYNC_DISPATCH_WORKERS, thread_name_prefix="dispatch")
+
+    async def handle_connection(reader, writer):
+        addr = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        frames = FrameReader(RECV_BUFFER)
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(RECV_BUFFER), CONN_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    break
+                frames.feed(data)
+                while True:
+                    try:
+                        msg_dict = frames.next_message()
+                    except FrameTooLarge:
+                        raise
+                    except ValueError as e:
+                        print(f"从{addr}接收到无效数据: {e}")
+                        continue
+                    if msg_dict is None:
+                        break
+                    try:
+                        # Keep per-connection order by awaiting each message before parsing the next one.
+                        await loop.run_in_executor(dispatch_executor, dispatch_message, msg_dict, self_id, self_ip)
+                    except Exception as e:
+                        print(f"❌ Error handling message from {addr}: {e} in peer {self_id} at {self_ip}:{port}")
+        except FrameTooLarge as e:
+            print(f"❌ Closing connection from {addr}: {e}")
+        except Exception as e:
+            print(f"❌ Error receiving message: {e} in peer {self_id} at {self_ip}:{port}")
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(
+            handle_connection, self_ip, port,
+            backlog=ASYNC_BACKLOG, reuse_address=True
+        )
+        print(f"Listening on {self_ip}:{port} (asyncio)")
+        async with server:
+            await server.serve_forever()
+
+    def run():
+        try:
+            asyncio.run(serve())
+        except Exception as e:
+            print(f"🔻 Asyncio server stopped: {e} in peer {self_id} at {self_ip}:{port}")
+
+    # ✅ Run event loop in background
+    threading.Thread(target=run, daemon=True).start()
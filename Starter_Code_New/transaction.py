@@ -2,38 +2,63 @@ import time
 import json
 import hashlib
 import random
+import bisect
 import threading
+from collections import OrderedDict, defaultdict
 from peer_discovery import known_peers
-from outbox import gossip_message
+from outbox import enqueue_message, gossip_targets
+from utils import generate_message_id
 
 class TransactionMessage:
-    def __init__(self, sender, receiver, amount, timestamp=None):
-        self.type = "TX"
+    # 紧凑表示：__slots__去掉每个实例的__dict__；规范序列化、哈希和字典视图各只生成一次并缓存
+    # to_dict返回的字典被交易池、区块模板、转发和/transactions共享，调用方不能修改
+    __slots__ = ("from_peer", "to_peer", "amount", "timestamp", "id", "_bytes", "_hash", "_dict")
+    type = "TX"
+
+    def __init__(self, sender, receiver, amount, timestamp=None, tx_id=None):
         self.from_peer = sender
         self.to_peer = receiver
         self.amount = amount
         self.timestamp = timestamp if timestamp else time.time()
-        self.id = self.compute_hash()
+        self._bytes = None  # 规范序列化缓存
+        self._hash = None   # 哈希缓存
+        self._dict = None   # 字典视图缓存
+        # 收到的交易沿用其声明的tx_id，由`is_valid`校验；本地新建的交易在此计算一次
+        self.id = tx_id if tx_id else self.compute_hash()
+
+    def canonical_bytes(self):
+        # 交易的规范序列化（排序键的JSON），只生成一次
+        if self._bytes is None:
+            tx_data = {
+                "type": self.type,
+                "from": self.from_peer,
+                "to": self.to_peer,
+                "amount": self.amount,
+                "timestamp": self.timestamp
+            }
+            self._bytes = json.dumps(tx_data, sort_keys=True).encode()
+        return self._bytes
 
     def compute_hash(self):
-        tx_data = {
-            "type": self.type,
-            "from": self.from_peer,
-            "to": self.to_peer,
-            "amount": self.amount,
-            "timestamp": self.timestamp
-        }
-        return hashlib.sha256(json.dumps(tx_data, sort_keys=True).encode()).hexdigest()
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.canonical_bytes()).hexdigest()
+        return self._hash
+
+    def is_valid(self):
+        # 声明的tx_id与内容一致
+        return self.id == self.compute_hash()
 
     def to_dict(self):
-        return {
-            "type": self.type,
-            "tx_id": self.id,
-            "from": self.from_peer,
-            "to": self.to_peer,
-            "amount": self.amount,
-            "timestamp": self.timestamp
-        }
+        if self._dict is None:
+            self._dict = {
+                "type": self.type,
+                "tx_id": self.id,
+                "from": self.from_peer,
+                "to": self.to_peer,
+                "amount": self.amount,
+                "timestamp": self.timestamp
+            }
+        return self._dict
 
     @staticmethod
     def from_dict(data):
@@ -41,12 +66,149 @@ class TransactionMessage:
             sender=data["from"],
             receiver=data["to"],
             amount=data["amount"],
-            timestamp=data["timestamp"]
+            timestamp=data["timestamp"],
+            tx_id=data.get("tx_id")
         )
 
-# 本地交易池及其ID集合
-tx_pool = []
-tx_ids = set()
+# === Mempool ===
+# Entries are indexed three ways: by tx_id, by arrival order (for expiry) and by priority in a sorted list of
+# (priority, -seq, tx_id) keys, so the best transaction is at the end and the first to evict at the front.
+# Priority is the transferred amount; among equal amounts the older transaction ranks higher.
+MAX_POOL_TXS = 5000               # transactions kept in the pool
+MAX_POOL_BYTES = 2 * 1024 * 1024  # serialized bytes kept in the pool
+POOL_EXPIRY = 3600                # seconds an unconfirmed transaction stays in the pool
+MAX_BLOCK_TXS = 1000              # transactions per block template
+MAX_BLOCK_BYTES = 256 * 1024      # serialized transaction bytes per block template
+RECENT_CONFIRMED_SIZE = 20000     # tx_ids remembered after confirmation to drop late duplicates
+
+def tx_priority(tx):
+    try:
+        return float(tx.amount)
+    except (TypeError, ValueError):
+        return 0.0
+
+def tx_size(tx):
+    return len(tx.canonical_bytes()) + len(tx.id)
+
+class Mempool:
+    def __init__(self, max_txs=MAX_POOL_TXS, max_bytes=MAX_POOL_BYTES, expiry=POOL_EXPIRY):
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.entries = OrderedDict()  # {tx_id: (tx, key, size, added)}，按加入顺序
+        self.order = []               # 按优先级升序排列的key
+        self.bytes = 0
+        self.seq = 0
+        self.lock = threading.RLock()
+
+    def add(self, tx, now=None):
+        # 加入交易；已存在或优先级低于满池中所有交易时返回False
+        now = time.time() if now is None else now
+        with self.lock:
+            if tx.id in self.entries:
+                return False
+            self.expire(now)
+            self.seq += 1
+            key = (tx_priority(tx), -self.seq, tx.id)
+            size = tx_size(tx)
+            # 先从最低优先级开始算出需要淘汰的交易，新交易必须比其中每一笔都优先；放得下才真正淘汰
+            evict = []
+            count, total = len(self.entries), self.bytes
+            for lowest in self.order:
+                if count < self.max_txs and total + size <= self.max_bytes:
+                    break
+                if key < lowest:
+                    return False
+                evict.append(lowest[2])
+                count -= 1
+                total -= self.entries[lowest[2]][2]
+            if count >= self.max_txs or total + size > self.max_bytes:
+                return False  # 比整个交易池还大
+            for tx_id in evict:
+                self._remove(tx_id)
+            self.entries[tx.id] = (tx, key, size, now)
+            bisect.insort(self.order, key)
+            self.bytes += size
+            return True
+
+    def _remove(self, tx_id):
+        tx, key, size, _ = self.entries.pop(tx_id)
+        del self.order[bisect.bisect_left(self.order, key)]
+        self.bytes -= size
+        return tx
+
+    def remove(self, tx_ids):
+        # 移除给定ID的交易，返回被移除的交易
+        with self.lock:
+            return [self._remove(tx_id) for tx_id in tx_ids if tx_id in self.entries]
+
+    def expire(self, now=None):
+        # 丢弃超过POOL_EXPIRY仍未被确认的交易（按加入顺序从最旧开始）
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.entries:
+                tx_id, (_, _, _, added) = next(iter(self.entries.items()))
+                if now - added <= self.expiry:
+                    break
+                self._remove(tx_id)
+
+    def select(self, max_bytes=None, max_count=None):
+        # 区块模板：按优先级从高到低取交易，直到达到区块大小上限；只遍历被选中的部分
+        max_bytes = MAX_BLOCK_BYTES if max_bytes is None else max_bytes
+        max_count = MAX_BLOCK_TXS if max_count is None else max_count
+        selected = []
+        total = 0
+        with self.lock:
+            for key in reversed(self.order):
+                if len(selected) >= max_count:
+                    break
+                tx, _, size, _ = self.entries[key[2]]
+                if total + size > max_bytes:
+                    break
+                selected.append(tx)
+                total += size
+        return selected
+
+    def get(self, tx_id):
+        entry = self.entries.get(tx_id)
+        return entry[0] if entry else None
+
+    def count(self, tx):
+        return 1 if tx in self else 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.order.clear()
+            self.bytes = 0
+
+    def __contains__(self, tx):
+        return (tx.id if isinstance(tx, TransactionMessage) else tx) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            txs = [entry[0] for entry in self.entries.values()]
+        return iter(txs)
+
+# 本地交易池；tx_ids是其ID的实时视图
+tx_pool = Mempool()
+tx_ids = tx_pool.entries.keys()
+# 最近被主链区块确认的tx_id（有界，按确认顺序淘汰），迟到的重复交易无需哈希即可丢弃
+recently_confirmed = OrderedDict()
+confirmed_lock = threading.Lock()
+
+def configure_mempool(config):
+    # Read the optional `mempool` section of config.json: pool caps and block template limits.
+    global MAX_BLOCK_TXS, MAX_BLOCK_BYTES
+    mempool = config.get("mempool", {})
+    tx_pool.max_txs = mempool.get("max_txs", tx_pool.max_txs)
+    tx_pool.max_bytes = mempool.get("max_bytes", tx_pool.max_bytes)
+    tx_pool.expiry = mempool.get("expiry", tx_pool.expiry)
+    MAX_BLOCK_TXS = mempool.get("max_block_txs", MAX_BLOCK_TXS)
+    MAX_BLOCK_BYTES = mempool.get("max_block_bytes", MAX_BLOCK_BYTES)
 
 def transaction_generation(self_id, interval=60):
     def loop():
@@ -60,22 +222,167 @@ def transaction_generation(self_id, interval=60):
             amount = random.randint(1, 100)  # 随机金额
             tx = TransactionMessage(self_id, to_peer, amount)
             add_transaction(tx)  # 加入本地交易池
-            # 广播交易到所有已知节点
-            gossip_message([peer for peer in known_peers if peer != self_id], tx.to_dict())
+            # 只公告tx_id，由下一批TXINV发出，对方用GETTX取回完整交易
+            announce_transaction(tx.id)
             time.sleep(interval)
     threading.Thread(target=loop, daemon=True).start()
 
 def add_transaction(tx):
-    # 检查是否已存在
-    if tx.id not in tx_ids:
-        tx_pool.append(tx)
-        tx_ids.add(tx.id)
+    # 已存在或被容量上限拒绝时返回False
+    return tx_pool.add(tx)
 
 def get_recent_transactions():
-    # 返回所有交易（字典形式便于序列化和展示）
+    # 返回所有交易（字典形式便于序列化和展示，复用每笔交易缓存的字典）
     return [tx.to_dict() for tx in tx_pool]
 
+def get_block_template(max_bytes=None, max_count=None):
+    # 按优先级选出一个区块的交易（字典形式），不超过区块大小上限
+    return [tx.to_dict() for tx in tx_pool.select(max_bytes, max_count)]
+
+def remove_transactions(confirmed_ids):
+    # 移除已被区块确认的交易
+    tx_pool.remove(confirmed_ids)
+
+def confirm_transactions(confirmed_ids):
+    # 区块进入主链：移出交易池并记入最近确认过滤器，代价与区块大小成正比
+    confirmed_ids = [tx_id for tx_id in confirmed_ids if tx_id]
+    tx_pool.remove(confirmed_ids)
+    with confirmed_lock:
+        for tx_id in confirmed_ids:
+            recently_confirmed[tx_id] = None
+            recently_confirmed.move_to_end(tx_id)
+        while len(recently_confirmed) > RECENT_CONFIRMED_SIZE:
+            recently_confirmed.popitem(last=False)
+
+def is_known_transaction(tx_id):
+    # 已在交易池中或最近已被确认
+    return tx_id in tx_pool or tx_id in recently_confirmed
+
+def restore_transactions(txs):
+    # 重组时把被断开区块中的交易放回交易池（字典形式，无法解析的跳过）
+    for data in txs:
+        try:
+            tx = TransactionMessage.from_dict(data)
+        except (KeyError, TypeError):
+            continue
+        if tx.is_valid():
+            with confirmed_lock:
+                recently_confirmed.pop(tx.id, None)
+            add_transaction(tx)
+
 def clear_pool():
-    # 清空交易池和ID集合
+    # 清空交易池（tx_ids随之清空）和最近确认过滤器
     tx_pool.clear()
-    tx_ids.clear()
\ No newline at end of file
+    with confirmed_lock:
+        recently_confirmed.clear()
+
+# === Transaction relay ===
+# Transactions are announced by ID instead of pushed in full on every hop: IDs collected over TX_TRICKLE_INTERVAL
+# go out together in one TXINV, and the receiver fetches only the ones it does not know with GETTX
+# (the same announce-then-fetch pattern as INV / GETBLOCK for blocks).
+TX_TRICKLE_INTERVAL = 0.5  # seconds between TXINV batches
+MAX_TXINV_IDS = 1000       # tx_ids per TXINV message
+TX_REQUEST_TIMEOUT = 5     # seconds before a tx_id requested with GETTX may be requested from another peer
+PEER_KNOWN_TXS = 5000      # tx_ids remembered per peer as already known to it
+
+pending_announcements = []                 # tx_ids waiting for the next TXINV
+peer_known_txs = defaultdict(OrderedDict)  # {peer_id: {tx_id: None}} announced by or sent to the peer
+tx_requests = {}                           # {tx_id: (peer_id, deadline)} GETTX in flight
+relay_lock = threading.Lock()
+
+def create_txinv(tx_ids, sender_id):
+    # 构建TXINV消息
+    return {
+        "type": "TXINV",
+        "sender": sender_id,
+        "tx_ids": tx_ids,
+        "message_id": generate_message_id()
+    }
+
+def create_gettx(sender_id, tx_ids):
+    # 构建GETTX消息
+    return {
+        "type": "GETTX",
+        "sender": sender_id,
+        "tx_ids": tx_ids,
+        "message_id": generate_message_id()
+    }
+
+def create_txs(sender_id, transactions):
+    # 构建TXS消息：响应GETTX，一条消息带回多笔交易，sender为转发它们的节点
+    return {
+        "type": "TXS",
+        "sender": sender_id,
+        "transactions": transactions,
+        "message_id": generate_message_id()
+    }
+
+def mark_known_txs(peer_id, tx_ids):
+    # 记录对方已有的交易，之后不再向其公告（调用方持有relay_lock）
+    known = peer_known_txs[peer_id]
+    for tx_id in tx_ids:
+        known[tx_id] = None
+        known.move_to_end(tx_id)
+    while len(known) > PEER_KNOWN_TXS:
+        known.popitem(last=False)
+
+def announce_transaction(tx_id):
+    # 新进入交易池的交易，等待下一批TXINV
+    with relay_lock:
+        tx_requests.pop(tx_id, None)
+        pending_announcements.append(tx_id)
+
+def flush_announcements(self_id):
+    # 把积攒的tx_id分批发给转发目标，每个节点只收到它还不知道的ID
+    now = time.time()
+    with relay_lock:
+        tx_ids = [tx_id for tx_id in pending_announcements if tx_id in tx_pool]
+        pending_announcements.clear()
+        for tx_id in [tx_id for tx_id, (_, deadline) in tx_requests.items() if deadline <= now]:
+            del tx_requests[tx_id]  # 未被响应的请求
+    if not tx_ids:
+        return 0
+    sent = 0
+    for peer in gossip_targets(self_id, "TXINV"):
+        with relay_lock:
+            unknown = [tx_id for tx_id in tx_ids if tx_id not in peer_known_txs[peer]]
+            mark_known_txs(peer, unknown)
+        for i in range(0, len(unknown), MAX_TXINV_IDS):
+            enqueue_message(peer, known_peers[peer][0], known_peers[peer][1], create_txinv(unknown[i:i + MAX_TXINV_IDS], self_id))
+            sent += 1
+    return sent
+
+def start_tx_relay(self_id, interval=TX_TRICKLE_INTERVAL):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                flush_announcements(self_id)
+            except Exception as e:
+                print(f"[{self_id}] Error announcing transactions: {e}")
+    threading.Thread(target=loop, daemon=True).start()
+
+def handle_txinv(msg, self_id, now=None):
+    # 只请求本地没有、也没有正在向别的节点请求的交易；返回GETTX消息，无需请求时返回None
+    now = time.time() if now is None else now
+    sender = msg.get("sender")
+    tx_ids = [tx_id for tx_id in msg.get("tx_ids", []) if isinstance(tx_id, str)]
+    with relay_lock:
+        mark_known_txs(sender, tx_ids)
+        wanted = []
+        for tx_id in tx_ids:
+            request = tx_requests.get(tx_id)
+            if is_known_transaction(tx_id) or (request and request[1] > now):
+                continue
+            tx_requests[tx_id] = (sender, now + TX_REQUEST_TIMEOUT)
+            wanted.append(tx_id)
+    return create_gettx(self_id, wanted) if wanted else None
+
+def get_requested_transactions(msg, self_id):
+    # 响应GETTX：把交易池中被请求的交易（字典形式）分批装进TXS消息，交易池中没有的跳过
+    txs = [tx_pool.get(tx_id) for tx_id in msg.get("tx_ids", []) if isinstance(tx_id, str)]
+    txs = [tx for tx in txs if tx is not None]
+    with relay_lock:
+        mark_known_txs(msg.get("sender"), [tx.id for tx in txs])
+    txs = [tx.to_dict() for tx in txs]
+    return [create_txs(self_id, txs[i:i + MAX_TXINV_IDS]) for i in range(0, len(txs), MAX_TXINV_IDS)]
@@ -1,5 +1,7 @@
 import unittest
 import time
+import hashlib
+from unittest.mock import patch
 
 from transaction import (
     TransactionMessage,
@@ -8,7 +10,14 @@ from transaction import (
     add_transaction,
     get_recent_transactions,
     clear_pool,
+    Mempool,
+    tx_size,
+    confirm_transactions,
+    restore_transactions,
+    is_known_transaction,
+    recently_confirmed,
 )
+import transaction
 
 class TestTransaction(unittest.TestCase):
     def setUp(self):
@@ -60,5 +69,146 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(tx.amount, tx2.amount)
         self.assertEqual(tx.timestamp, tx2.timestamp)
 
+    def test_hash_is_computed_once(self):
+        tx = TransactionMessage("peerA", "peerB", 7)
+        data = tx.to_dict()
+        received = TransactionMessage.from_dict(data)
+        with patch("transaction.hashlib.sha256", wraps=hashlib.sha256) as mock_sha:
+            self.assertTrue(received.is_valid())
+            self.assertTrue(received.is_valid())
+            self.assertEqual(mock_sha.call_count, 1)
+        forged = TransactionMessage.from_dict(dict(data, amount=8))
+        self.assertFalse(forged.is_valid())
+
+    def test_slots_and_cached_views(self):
+        tx = TransactionMessage("peerA", "peerB", 9)
+        self.assertFalse(hasattr(tx, "__dict__"))
+        self.assertEqual(tx.type, "TX")
+        self.assertIs(tx.to_dict(), tx.to_dict())
+        self.assertIs(tx.canonical_bytes(), tx.canonical_bytes())
+        add_transaction(tx)
+        self.assertIs(get_recent_transactions()[0], tx.to_dict())
+
+class TestMempool(unittest.TestCase):
+    def test_select_by_priority_within_block_size(self):
+        pool = Mempool()
+        txs = [TransactionMessage("peerA", "peerB", amount, 1700000000.0 + i) for i, amount in enumerate([5, 50, 20, 50, 1])]
+        for tx in txs:
+            self.assertTrue(pool.add(tx))
+        # 金额高的优先，金额相同时先到的优先
+        self.assertEqual(pool.select(), [txs[1], txs[3], txs[2], txs[0], txs[4]])
+        self.assertEqual(pool.select(max_count=2), [txs[1], txs[3]])
+        self.assertEqual(pool.select(max_bytes=tx_size(txs[1]) * 2), [txs[1], txs[3]])
+        pool.remove([txs[1].id, "unknown"])
+        self.assertEqual(pool.select(max_count=1), [txs[3]])
+        self.assertEqual(len(pool), 4)
+
+    def test_caps_evict_lowest_priority(self):
+        pool = Mempool(max_txs=3)
+        low, mid, high = (TransactionMessage("peerA", "peerB", amount) for amount in (1, 10, 100))
+        for tx in (low, mid, high):
+            pool.add(tx)
+        self.assertFalse(pool.add(TransactionMessage("peerA", "peerB", 0)))
+        self.assertTrue(pool.add(TransactionMessage("peerA", "peerB", 50)))
+        self.assertEqual(len(pool), 3)
+        self.assertNotIn(low, pool)
+        pool = Mempool(max_bytes=tx_size(mid) + tx_size(high))
+        for tx in (low, mid, high):
+            pool.add(tx)
+        self.assertEqual(list(pool), [mid, high])
+        self.assertEqual(pool.bytes, tx_size(mid) + tx_size(high))
+
+    def test_byte_cap_evicts_only_if_admitted(self):
+        small = [TransactionMessage("peerA", "peerB", amount) for amount in (1, 2)]
+        big = TransactionMessage("peerA" * 40, "peerB", 50)
+        high = TransactionMessage("peerA", "peerB", 100)
+        pool = Mempool(max_bytes=sum(tx_size(tx) for tx in small + [high]))
+        for tx in small + [high]:
+            self.assertTrue(pool.add(tx))
+        # 淘汰两笔小交易仍放不下，剩下的那笔优先级更高：什么都不淘汰
+        self.assertGreater(tx_size(big), tx_size(small[0]) + tx_size(small[1]))
+        self.assertFalse(pool.add(big))
+        self.assertEqual(list(pool), small + [high])
+        # 放得下时一次淘汰多笔
+        fits = TransactionMessage("peerA" * 5, "peerB", 50)
+        self.assertLessEqual(tx_size(fits), tx_size(small[0]) + tx_size(small[1]))
+        self.assertTrue(pool.add(fits))
+        self.assertNotIn(small[0], pool)
+        self.assertLessEqual(pool.bytes, pool.max_bytes)
+
+    def test_expiry_drops_oldest(self):
+        pool = Mempool(expiry=60)
+        old, new = TransactionMessage("peerA", "peerB", 100), TransactionMessage("peerA", "peerB", 1)
+        pool.add(old, now=1000)
+        pool.add(new, now=1050)
+        pool.expire(now=1100)
+        self.assertEqual(list(pool), [new])
+        self.assertEqual(pool.select(), [new])
+
+class TestConfirmedFilter(unittest.TestCase):
+    def setUp(self):
+        clear_pool()
+
+    def test_confirm_and_restore(self):
+        txs = [TransactionMessage("peerA", "peerB", i) for i in range(3)]
+        for tx in txs:
+            add_transaction(tx)
+        confirm_transactions([txs[0].id, txs[1].id])
+        self.assertEqual(list(tx_pool), [txs[2]])
+        self.assertTrue(is_known_transaction(txs[0].id))
+        self.assertFalse(is_known_transaction("unknown"))
+        # 重组断开区块后交易回到交易池，不再被过滤
+        restore_transactions([txs[0].to_dict()])
+        self.assertIn(txs[0].id, tx_ids)
+        self.assertNotIn(txs[0].id, recently_confirmed)
+
+    def test_filter_is_bounded(self):
+        with patch("transaction.RECENT_CONFIRMED_SIZE", 3):
+            confirm_transactions([str(i) for i in range(5)])
+        self.assertEqual(list(recently_confirmed), ["2", "3", "4"])
+
+class TestTxRelay(unittest.TestCase):
+    def setUp(self):
+        clear_pool()
+        transaction.pending_announcements.clear()
+        transaction.peer_known_txs.clear()
+        transaction.tx_requests.clear()
+
+    def test_announcements_are_batched_per_peer(self):
+        txs = [TransactionMessage("peerA", "peerB", i) for i in range(3)]
+        for tx in txs:
+            add_transaction(tx)
+            transaction.announce_transaction(tx.id)
+        # peerB 已经公告过第一笔交易
+        transaction.handle_txinv(transaction.create_txinv([txs[0].id], "peerB"), "self")
+        peers = {"peerB": ("127.0.0.1", 5001), "peerC": ("127.0.0.1", 5002)}
+        with patch("transaction.known_peers", peers), \
+             patch("transaction.gossip_targets", return_value={"peerB", "peerC"}), \
+             patch("transaction.enqueue_message") as mock_enqueue:
+            self.assertEqual(transaction.flush_announcements("self"), 2)
+            self.assertEqual(transaction.flush_announcements("self"), 0)
+        sent = {call[0][0]: call[0][3] for call in mock_enqueue.call_args_list}
+        self.assertEqual(sent["peerB"]["type"], "TXINV")
+        self.assertEqual(sent["peerB"]["tx_ids"], [txs[1].id, txs[2].id])
+        self.assertEqual(sent["peerC"]["tx_ids"], [tx.id for tx in txs])
+
+    def test_fetch_only_unknown_transactions(self):
+        pooled, confirmed, new = (TransactionMessage("peerA", "peerB", i) for i in range(3))
+        add_transaction(pooled)
+        confirm_transactions([confirmed.id])
+        inv = transaction.create_txinv([pooled.id, confirmed.id, new.id], "peerB")
+        gettx = transaction.handle_txinv(inv, "self", now=100)
+        self.assertEqual(gettx["type"], "GETTX")
+        self.assertEqual(gettx["tx_ids"], [new.id])
+        # 请求未超时前不向其他节点重复请求，超时后可以
+        self.assertIsNone(transaction.handle_txinv(dict(inv, sender="peerC"), "self", now=101))
+        gettx = transaction.handle_txinv(dict(inv, sender="peerC"), "self", now=100 + transaction.TX_REQUEST_TIMEOUT)
+        self.assertEqual(gettx["tx_ids"], [new.id])
+        # 对方响应GETTX：只返回交易池中有的交易
+        replies = transaction.get_requested_transactions(transaction.create_gettx("peerC", [pooled.id, new.id]), "self")
+        self.assertEqual([(reply["type"], reply["sender"]) for reply in replies], [("TXS", "self")])
+        self.assertEqual(replies[0]["transactions"], [pooled.to_dict()])
+        self.assertIn(pooled.id, transaction.peer_known_txs["peerC"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
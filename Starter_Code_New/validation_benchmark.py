@@ -0,0 +1,53 @@
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import message_handler
+from transaction import TransactionMessage
+from block_handler import compute_block_hash, block_merkle_root
+
+# === Validation stage benchmark ===
+# Times `message_handler.validate_batch` on a batch of full blocks, serially, on a thread pool and on a process pool.
+# python validation_benchmark.py --blocks 8 --txs 1000 --workers 4
+
+def make_blocks(count, txs_per_block):
+    blocks = []
+    for b in range(count):
+        txs = [dict(TransactionMessage("a", "b", i, b + i / 1e6).to_dict()) for i in range(txs_per_block)]
+        block = {"type": "BLOCK", "sender": "miner", "timestamp": b, "previous_block_id": "GENESIS",
+                 "merkle_root": block_merkle_root(txs), "transactions": txs}
+        block["block_id"] = compute_block_hash(block)
+        blocks.append(block)
+    return blocks
+
+def best_time(blocks, pool, rounds):
+    message_handler.validation_pool = pool
+    message_handler.validate_batch(blocks)  # warm up, starts the pool's workers
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        results = message_handler.validate_batch(blocks)
+        times.append(time.perf_counter() - started)
+        assert all(results), results
+    return min(times) * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=8)
+    parser.add_argument("--txs", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=message_handler.VALIDATION_WORKERS)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    blocks = make_blocks(args.blocks, args.txs)
+    print(f"{args.blocks} blocks x {args.txs} txs, {args.workers} workers, {multiprocessing.cpu_count()} CPUs")
+    serial = best_time(blocks, None, args.rounds)
+    print(f"serial:       {serial:7.1f} ms")
+    with ThreadPoolExecutor(args.workers) as pool:
+        print(f"thread pool:  {best_time(blocks, pool, args.rounds):7.1f} ms")
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        parallel = best_time(blocks, pool, args.rounds)
+    print(f"process pool: {parallel:7.1f} ms ({serial / parallel:.2f}x)")
+    message_handler.validation_pool = None
+
+if __name__ == "__main__":
+    main()